@@ -1,10 +1,15 @@
-# import various
-from . import dataproc
-from . import generators
-from . import callbacks
-from . import plot
-from . import metrics
-from . import inits
-from . import models
-from . import utils
-from . import layers
+# import various, lazily, so that e.g. neuron.dataproc does not load keras and tensorflow
+import importlib
+
+__all__ = ['dataproc', 'generators', 'callbacks', 'plot', 'metrics', 'inits', 'models', 'utils', 'layers']
+
+
+def __getattr__(name):
+    """ import the submodules on first access (PEP 562) """
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -13,26 +13,32 @@ We'd like the following callback actions for neuron:
 --- new callback, PlotSlices
 
 '''
+import os
 import sys
+import json
+import time
+import collections
+import queue
+import threading
 
 import keras
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
+import tensorflow as tf
 import warnings
-from imp import reload
 import pytool.timer as timer
 
 import pynd.ndutils as nd
 import pynd.segutils as su
 
 # the neuron folder should be on the path
-import neuron.plot as nrn_plt
 import neuron.utils as nrn_utils
 
 class ModelWeightCheck(keras.callbacks.Callback):
     """
         check model weights for nan and infinite entries
+
+        this copies all weights to the host at every check, see ModelHealthCheck
+        for an in-graph check
     """
 
     def __init__(self,
@@ -82,6 +88,73 @@ class ModelWeightCheck(keras.callbacks.Callback):
             logs['max_diff'] = diff
             # print("max diff", diff)
 
+
+class ModelHealthCheck(keras.callbacks.Callback):
+    """
+    in-graph check of model weights and gradients, a cheaper ModelWeightCheck.
+
+    Every `every` train steps, the train step itself also computes whether all weights and
+    gradients are finite (one fused reduce_all) and the largest norm of the step's update of a
+    weight tensor. Only these two scalars are returned to python, as the metrics
+    'health_finite' (1 or 0) and 'health_max_update', which hold the last checked values
+    between checks. On check steps, the weights are copied before the optimizer's update ops
+    and read again after them; no copy is kept in between.
+
+    Must be constructed after model.compile and before training, since it hooks into the
+    optimizer's gradients and updates when keras builds the train function. The metrics are
+    added through model.metrics_tensors, so it needs keras 2.2.
+    """
+
+    def __init__(self, model, every=100, max_update=None, stop_training=True):
+        """
+        Parameters:
+            model: the compiled model that will be trained
+            every: number of train steps between checks
+            max_update: optional bound on health_max_update, which is then also an error
+            stop_training: stop training on an error, rather than only print it
+        """
+        super(ModelHealthCheck, self).__init__()
+        assert hasattr(model, 'metrics_tensors'), \
+            'ModelHealthCheck needs a model compiled with keras 2.2 (model.metrics_tensors), ' + \
+            'use ModelWeightCheck with other keras versions'
+        self.every = every
+        self.max_update = max_update
+        self.stop_training = stop_training
+        self.errors = []
+
+        optimizer = model.optimizer
+        get_gradients = optimizer.get_gradients
+        get_updates = optimizer.get_updates
+        grads = []
+
+        def health_gradients(loss, params):
+            grads[:] = get_gradients(loss, params)
+            return grads
+
+        def health_updates(loss, params):
+            updates, finite, max_update = _health_updates(get_updates, loss, params, grads, every)
+            model.metrics_names.extend(['health_finite', 'health_max_update'])
+            model.metrics_tensors.extend([finite, max_update])
+            return updates
+
+        optimizer.get_gradients = health_gradients
+        optimizer.get_updates = health_updates
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        err = None
+        if logs.get('health_finite', 1) < 1:
+            err = 'Found nan or infinite weights or gradients at batch %d' % (batch + 1)
+        elif self.max_update is not None and logs.get('health_max_update', 0) > self.max_update:
+            err = 'Found weight update of norm %f > %f at batch %d' % \
+                (logs['health_max_update'], self.max_update, batch + 1)
+
+        if err is not None:
+            self.errors.append(err)
+            print(err, file=sys.stderr)
+            if self.stop_training:
+                self.model.stop_training = True
+
 class CheckLossTrend(keras.callbacks.Callback):
     """
         check model weights for nan and infinite entries
@@ -207,7 +280,7 @@ class PlotTestSlices(keras.callbacks.Callback):
         # has to be here, can't be at the top, due to cyclical imports (??)
         # TODO: should just pass the function to compute the figures given the model and generator
         import neuron.sandbox as nrn_sandbox
-        reload(nrn_sandbox)
+        import matplotlib.pyplot as plt
 
         with timer.Timer('plot callback', self.verbose):
             if len(self.run.grid_size) == 3:
@@ -593,10 +666,523 @@ class ModelCheckpointParallel(keras.callbacks.Callback):
                     else:
                         self.model.layers[-(num_outputs+1)].save(filepath, overwrite=True)
 
+class AsyncModelCheckpoint(keras.callbacks.Callback):
+    """
+    save model weights without blocking training on disk I/O.
+
+    At a save, the weights are copied to host memory in one session call, and written to
+    filepath (in keras' save_weights format, so model.load_weights works) by a background
+    thread, via a temporary file and an atomic rename. The optimizer state is not saved.
+
+    Retention: after each write, older checkpoints are deleted unless they are among the
+    last keep_last ones, their epoch is a multiple of keep_every, or (keep_best) they have
+    the best monitored value so far.
+
+    The time each save blocked training (the weight copy, plus waiting for the previous
+    write if it has not finished) is stored in block_times, and the write times in write_times.
+    """
+
+    def __init__(self, filepath,
+                 keep_last=None,
+                 keep_every=None,
+                 keep_best=False,
+                 monitor='loss',
+                 mode='min',
+                 save_model=None,
+                 at_batch_end=None,
+                 at_epoch_end=True,
+                 period=1,
+                 verbose=False):
+        """
+        Parameters:
+            filepath: filepath, e.g. 'model_dir/{epoch:02d}.h5'. Like keras' ModelCheckpoint,
+                epoch is formatted as epoch + 1. Can also include {iter} and keys of logs
+            keep_last: number of most recent checkpoints to keep (None: keep all)
+            keep_every: also keep the checkpoints of every keep_every epochs
+            keep_best: also keep the checkpoint with the best monitored value
+            monitor: quantity to monitor for keep_best
+            mode: 'min' or 'max', for keep_best
+            save_model: model to save, if not the trained one (e.g. the template model
+                of a multi_gpu_model)
+            at_batch_end=None: None or number indicate when to execute
+                (i.e. at_batch_end = 10 means execute every 10 batches)
+            at_epoch_end=True: logical, whether to execute at epoch end
+            period: Interval (number of epochs) between checkpoints.
+        """
+        super(AsyncModelCheckpoint, self).__init__()
+        assert mode in ['min', 'max'], 'mode should be min or max'
+        self.filepath = filepath
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self.monitor_op = np.less if mode == 'min' else np.greater
+        self.save_model = save_model
+        self.at_batch_end = at_batch_end
+        self.at_epoch_end = at_epoch_end
+        self.period = period
+        self.verbose = verbose
+
+        self.current_epoch = 0
+        self.saved = []  # (epoch, filepath, monitored value) of the files on disk
+        self.best = None
+        self.block_times = []
+        self.write_times = []
+
+        # a single pending write: a new save waits for the previous one
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.current_epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        if self.at_batch_end is not None and np.mod(batch + 1, self.at_batch_end) == 0:
+            self.on_model_save(self.current_epoch, batch + 1, logs=logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.at_epoch_end and np.mod(epoch + 1, self.period) == 0:
+            self.on_model_save(epoch, 0, logs=logs)
+        self.current_epoch = epoch + 1
+
+    def on_train_end(self, logs=None):
+        self.flush()
+
+    def save_initial(self, initial_epoch=0):
+        """
+        queue the weights before training as the checkpoint of initial_epoch (e.g. 00.h5),
+        written and retained like the others. Needs save_model, or the model set.
+        """
+        self.on_model_save(initial_epoch - 1, 0)
+
+    def on_model_save(self, epoch, iter, logs=None):
+        """ snapshot the weights and queue them for writing """
+        if self._error is not None:
+            raise self._error
+
+        tstart = time.perf_counter()
+        logs = logs or {}
+        model = self.model if self.save_model is None else self.save_model
+        filepath = self.filepath.format(epoch=epoch + 1, iter=iter, **logs)
+
+        # the weights of all layers, in one session call
+        with timer.Timer('async checkpoint snapshot', False):
+            layout = []
+            weights = []
+            for layer in model.layers:
+                layout.append((layer.name, [w.name for w in layer.weights]))
+                weights.extend(layer.weights)
+            values = keras.backend.batch_get_value(weights)
+
+        self._queue.put((epoch + 1, filepath, logs.get(self.monitor), layout, values))
+        self.block_times.append(time.perf_counter() - tstart)
+        if self.verbose:
+            print('Epoch %05d: queued %s, training blocked for %.3f sec' %
+                  (epoch + 1, filepath, self.block_times[-1]))
+
+    def flush(self):
+        """ wait for the pending write """
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def _writer(self):
+        while True:
+            task = self._queue.get()
+            try:
+                tstart = time.perf_counter()
+                epoch, filepath, value, layout, values = task
+                with timer.Timer('async checkpoint write', False):
+                    _save_weights_h5(filepath, layout, values)
+                self.write_times.append(time.perf_counter() - tstart)
+                self._retain(epoch, filepath, value)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _retain(self, epoch, filepath, value):
+        """ delete the checkpoints that are no longer kept """
+        self.saved = [s for s in self.saved if s[1] != filepath] + [(epoch, filepath, value)]
+        if value is not None and (self.best is None or self.monitor_op(value, self.best[2])):
+            self.best = (epoch, filepath, value)
+
+        if self.keep_last is None:
+            return
+        keep = set(s[1] for s in self.saved[-self.keep_last:]) if self.keep_last > 0 else set()
+        if self.keep_every is not None:
+            keep |= set(s[1] for s in self.saved if np.mod(s[0], self.keep_every) == 0)
+        if self.keep_best and self.best is not None:
+            keep.add(self.best[1])
+
+        for s in self.saved:
+            if s[1] not in keep and os.path.isfile(s[1]):
+                os.remove(s[1])
+        self.saved = [s for s in self.saved if s[1] in keep]
+
+
+class SamplerCheckpoint(keras.callbacks.Callback):
+    """
+    save the state of a data sampler (e.g. voxelmorph's datagenerators.EpochSampler) 
+    at the end of epochs, next to the model checkpoints.
+
+    Since generators are consumed ahead of training (fit_generator's queue), the saved
+    state is computed from the number of trained examples, (epoch + 1) * examples_per_epoch,
+    rather than from the sampler's current position.
+    """
+
+    def __init__(self, filepath, sampler, examples_per_epoch, period=1):
+        """
+        Parameters:
+            filepath: filepath with epoch, e.g. 'model_dir/{epoch:02d}_sampler.json'.
+                like keras' ModelCheckpoint, epoch is formatted as epoch + 1
+            sampler: object with a save(filename, nb_drawn) method
+            examples_per_epoch: steps_per_epoch * batch_size
+            period: Interval (number of epochs) between saves
+        """
+        super(SamplerCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.sampler = sampler
+        self.examples_per_epoch = examples_per_epoch
+        self.period = period
+
+    def on_epoch_end(self, epoch, logs=None):
+        if np.mod(epoch + 1, self.period) == 0:
+            filename = self.filepath.format(epoch=epoch + 1)
+            self.sampler.save(filename, nb_drawn=(epoch + 1) * self.examples_per_epoch)
+
+
+class StepProfiler(keras.callbacks.Callback):
+    """
+    per-step profile of a fit_generator training loop.
+
+    The profiler wraps the other callbacks so it can time them, and records for every step:
+    - wait: time from the end of the previous step to the start of this one, i.e. waiting on
+      the generator (or its queue)
+    - train: time of the train step
+    - callbacks, checkpoint: time in the wrapped callbacks' batch (and, on the last step of
+      an epoch, epoch) hooks, with checkpoint callbacks (class name containing 'Checkpoint')
+      counted separately
+    - load: time the generator spent producing the batch, if it is wrapped by profile_generator
+    - voxels_per_sec: batch voxels / (wait + train), and rss: the process' resident memory in MB
+
+    Steps are written to filepath, as csv if it ends with .csv and json lines otherwise. Every
+    summary_every steps, percentiles of the phase times are printed and kept in self.summaries.
+    A large wait fraction means the node is I/O (data) bound, a large train fraction that it is
+    compute bound.
+
+    Use:
+        callbacks = [StepProfiler('profile.jsonl', callbacks=callbacks)]
+    """
+
+    def __init__(self, filepath, callbacks=None, summary_every=100, voxels_per_example=None,
+                 percentiles=(50, 90, 99), verbose=True):
+        """
+        Parameters:
+            filepath: output csv or json lines file
+            callbacks: list of callbacks to run (and time)
+            summary_every: number of steps between summaries
+            voxels_per_example: default: the number of voxels of the model's first input
+            percentiles: percentiles of the summaries
+        """
+        super(StepProfiler, self).__init__()
+        self.filepath = filepath
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        self.summary_every = summary_every
+        self.voxels_per_example = voxels_per_example
+        self.percentiles = percentiles
+        self.verbose = verbose
+
+        self.fields = ['epoch', 'step', 'wait', 'load', 'train', 'callbacks', 'checkpoint',
+                       'batch_size', 'voxels_per_sec', 'rss']
+        self.records = []
+        self.summaries = []
+        self.load_times = collections.deque()
+        self.current_epoch = 0
+        self._file = None
+        self._last_end = None
+        self._step_begin = None
+        self._wait = 0
+
+    def set_params(self, params):
+        super(StepProfiler, self).set_params(params)
+        for cb in self.callbacks:
+            cb.set_params(params)
+
+    def set_model(self, model):
+        super(StepProfiler, self).set_model(model)
+        for cb in self.callbacks:
+            cb.set_model(model)
+        if self.voxels_per_example is None:
+            self.voxels_per_example = int(np.prod(keras.backend.int_shape(model.inputs[0])[1:-1]))
+
+    def on_train_begin(self, logs=None):
+        self._file = open(self.filepath, 'w')
+        if self.filepath.endswith('.csv'):
+            self._file.write(','.join(self.fields) + '\n')
+        self._call('on_train_begin', logs)
+        self._last_end = time.perf_counter()
+
+    def on_train_end(self, logs=None):
+        self._call('on_train_end', logs)
+        nb_left = np.mod(len(self.records), self.summary_every)
+        if nb_left > 0:
+            self._summarize(self.records[-nb_left:])
+        self._file.close()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.current_epoch = epoch
+        self._call('on_epoch_begin', epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # attributed to the last step of the epoch
+        cb_time, ckpt_time = self._call('on_epoch_end', epoch, logs)
+        if len(self.records) > 0:
+            self.records[-1]['callbacks'] += cb_time
+            self.records[-1]['checkpoint'] += ckpt_time
+        self._last_end = time.perf_counter()
+
+    def on_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        self._wait = now - self._last_end
+        self._call('on_batch_begin', batch, logs)
+        self._step_begin = time.perf_counter()
+
+    def on_batch_end(self, batch, logs=None):
+        train_time = time.perf_counter() - self._step_begin
+        logs = logs or {}
+        cb_time, ckpt_time = self._call('on_batch_end', batch, logs)
+
+        batch_size = int(logs.get('size', 1))
+        record = {'epoch': self.current_epoch,
+                  'step': batch,
+                  'wait': self._wait,
+                  'load': self.load_times.popleft() if len(self.load_times) > 0 else None,
+                  'train': train_time,
+                  'callbacks': cb_time,
+                  'checkpoint': ckpt_time,
+                  'batch_size': batch_size,
+                  'voxels_per_sec': batch_size * self.voxels_per_example / (self._wait + train_time),
+                  'rss': _process_rss()}
+        self._write(record)
+        self.records.append(record)
+        if np.mod(len(self.records), self.summary_every) == 0:
+            self._summarize()
+        self._last_end = time.perf_counter()
+
+    def summary(self, records=None):
+        """ percentiles of the phase times (in seconds) and mean fractions of the step time """
+        records = self.records[-self.summary_every:] if records is None else records
+        summ = {'nb_steps': len(records)}
+        total = 0
+        for key in ['wait', 'load', 'train', 'callbacks', 'checkpoint']:
+            vals = np.array([r[key] for r in records if r[key] is not None])
+            if len(vals) == 0:
+                continue
+            for p, v in zip(self.percentiles, np.percentile(vals, self.percentiles)):
+                summ['%s_p%d' % (key, p)] = v
+            summ['%s_mean' % key] = np.mean(vals)
+            if key != 'load':  # load overlaps with the others
+                total += summ['%s_mean' % key]
+        for key in ['wait', 'train', 'callbacks', 'checkpoint']:
+            summ['%s_frac' % key] = summ['%s_mean' % key] / total
+        summ['voxels_per_sec'] = np.mean([r['voxels_per_sec'] for r in records])
+        summ['rss'] = records[-1]['rss']
+        return summ
+
+    def _summarize(self, records=None):
+        summ = self.summary(records)
+        self.summaries.append(summ)
+        if self.verbose:
+            pstr = '/'.join('p%d' % p for p in self.percentiles)
+            phases = ', '.join('%s %s %s sec (%2.0f%%)' %
+                               (key, pstr, '/'.join('%.3f' % summ['%s_p%d' % (key, p)] for p in self.percentiles),
+                                100 * summ['%s_frac' % key])
+                               for key in ['wait', 'train', 'callbacks', 'checkpoint'])
+            bound = 'data' if summ['wait_frac'] > summ['train_frac'] else 'compute'
+            print('\nsteps %d-%d: %s; %.3g voxels/s, rss %.0f MB: %s bound' %
+                  (len(self.records) - summ['nb_steps'] + 1, len(self.records), phases,
+                   summ['voxels_per_sec'], summ['rss'], bound))
+
+    def _call(self, hook, *args):
+        """ call hook on the wrapped callbacks. Returns (callback time, checkpoint time) """
+        cb_time, ckpt_time = 0, 0
+        for cb in self.callbacks:
+            tstart = time.perf_counter()
+            getattr(cb, hook)(*args)
+            t = time.perf_counter() - tstart
+            if 'Checkpoint' in cb.__class__.__name__:
+                ckpt_time += t
+            else:
+                cb_time += t
+        return cb_time, ckpt_time
+
+    def _write(self, record):
+        if self.filepath.endswith('.csv'):
+            self._file.write(','.join('' if record[f] is None else str(record[f]) for f in self.fields) + '\n')
+        else:
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+
+def profile_generator(gen, profiler):
+    """
+    wrap a batch generator to record the time it spends producing each batch in
+    profiler (a StepProfiler), whichever thread the generator runs in
+    """
+    while True:
+        tstart = time.perf_counter()
+        batch = next(gen)
+        profiler.load_times.append(time.perf_counter() - tstart)
+        yield batch
+
+
+class StepTracer(keras.callbacks.Callback):
+    """
+    full tensorflow trace (RunMetadata) of a window of train steps.
+
+    For nb_steps steps from start_step (counted over the whole training), the model's train
+    function is swapped for a traced copy (see neuron.utils.traced_function). Each traced step
+    is written to trace_dir as a chrome trace (chrome://tracing), and at the end of the window
+    the per (layer, op type) table of time and memory is written to trace_dir/train_ops.csv
+    and printed.
+    """
+
+    def __init__(self, trace_dir, start_step=10, nb_steps=3, layer_names=None):
+        """
+        Parameters:
+            trace_dir: output directory
+            start_step: first traced step, after the warm-up steps
+            nb_steps: number of traced steps
+            layer_names: names to group ops by (default: the layers of the model, and of
+                its nested models)
+        """
+        super(StepTracer, self).__init__()
+        self.trace_dir = trace_dir
+        self.start_step = start_step
+        self.nb_steps = nb_steps
+        self.layer_names = layer_names
+        self.step = 0
+        self.run_metadatas = []
+        self._run_metadata = None
+        self._train_function = None
+
+    def on_train_begin(self, logs=None):
+        if not os.path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        if self.layer_names is None:
+            self.layer_names = _layer_names(self.model)
+
+    def on_batch_begin(self, batch, logs=None):
+        if self.step == self.start_step:
+            self._train_function = self.model.train_function
+            self._run_metadata = tf.RunMetadata()
+            self.model.train_function = nrn_utils.traced_function(self._train_function, self._run_metadata)
+
+    def on_batch_end(self, batch, logs=None):
+        if self.start_step <= self.step < self.start_step + self.nb_steps:
+            run_metadata = tf.RunMetadata()
+            run_metadata.CopyFrom(self._run_metadata)
+            self._run_metadata.Clear()
+            self.run_metadatas.append(run_metadata)
+            nrn_utils.write_trace(run_metadata, os.path.join(self.trace_dir, 'train_%d.trace.json' % self.step))
+
+            if self.step == self.start_step + self.nb_steps - 1:
+                self.model.train_function = self._train_function
+                rows = nrn_utils.trace_op_table(self.run_metadatas, self.layer_names)
+                nrn_utils.write_op_table(rows, os.path.join(self.trace_dir, 'train_ops.csv'))
+        self.step += 1
+
+
 ##################################################################################################
 # helper functions
 ##################################################################################################
 
+def _save_weights_h5(filepath, layout, values):
+    """
+    write weight values in keras' save_weights hdf5 layout, via a temporary file
+    and an atomic rename
+
+    Parameters:
+        filepath: h5 filename
+        layout: list of (layer name, list of weight names), in model.layers order
+        values: list of weight arrays, in the order of layout
+    """
+    import h5py
+
+    tmp_filepath = filepath + '.tmp'
+    with h5py.File(tmp_filepath, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _ in layout]
+        f.attrs['backend'] = keras.backend.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+
+        pos = 0
+        for layer_name, weight_names in layout:
+            g = f.create_group(layer_name)
+            g.attrs['weight_names'] = [name.encode('utf8') for name in weight_names]
+            for name in weight_names:
+                g.create_dataset(name, data=values[pos])
+                pos += 1
+    os.replace(tmp_filepath, filepath)
+
+
+def _layer_names(model):
+    """ names of the layers of a model, and of the layers of its nested models """
+    names = []
+    for layer in model.layers:
+        names.append(layer.name)
+        if isinstance(layer, keras.models.Model):
+            names.extend(_layer_names(layer))
+    return names
+
+
+def _process_rss():
+    """ resident memory of this process, in MB (peak resident memory if /proc is unavailable) """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, IOError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _health_updates(get_updates, loss, params, grads, every):
+    """
+    the optimizer's updates (from get_updates(loss=loss, params=params)), and the scalar
+    tensors (all finite, max update norm of the step) of ModelHealthCheck, computed every
+    `every` evaluations and held in variables in between.
+    """
+    step = tf.Variable(0, dtype=tf.int64, trainable=False, name='health_step')
+    last_finite = tf.Variable(1., trainable=False, name='health_finite')
+    last_update = tf.Variable(0., trainable=False, name='health_max_update')
+    step_update = tf.assign_add(step, 1)
+    do_check = tf.equal(tf.mod(step_update, every), 0)
+
+    # copies of the weights before the update ops, on check steps only. (the multiplication
+    # makes a copy: a tf.identity of a variable can alias its buffer, which the optimizer
+    # updates in place)
+    old_weights = tf.cond(do_check, lambda: [p * 1. for p in params],
+                          lambda: [tf.zeros([0], dtype=p.dtype) for p in params])
+    with tf.control_dependencies(old_weights):
+        updates = get_updates(loss=loss, params=params)
+
+    with tf.control_dependencies(updates):
+        new_weights = [tf.identity(p) for p in params]
+
+    def check():
+        tensors = new_weights + [g for g in grads if g is not None]
+        finite = tf.reduce_all(tf.stack([tf.reduce_all(tf.is_finite(t)) for t in tensors]))
+        update = tf.reduce_max(tf.stack([tf.norm(w - o) for w, o in zip(new_weights, old_weights)]))
+        return tf.group(tf.assign(last_finite, tf.cast(finite, tf.float32)),
+                        tf.assign(last_update, update))
+
+    checked = tf.cond(do_check, check, tf.no_op)
+    with tf.control_dependencies([checked]):
+        return updates, tf.identity(last_finite), tf.identity(last_update)
+
+
 def _generate_predictions(model, data_generator, batch_size, nb_samples, vol_params):
     # whole volumes
     if vol_params is not None:
@@ -5,23 +5,17 @@ import sys
 import os
 import shutil
 import six
+import json
+import time
+import zipfile
+import hashlib
+import concurrent.futures
 
 # third party
-import nibabel as nib
+# nibabel, PIL, matplotlib and tqdm are imported where they are used, to keep this module
+# (and the tools using it) quick to import
 import numpy as np
 import scipy.ndimage.interpolation
-from tqdm import tqdm_notebook as tqdm # for verbosity for forloops
-from PIL import Image
-import matplotlib.pyplot as plt
-
-
-
-# note sure if tqdm_notebook reverts back to 
-try:
-    get_ipython
-    from tqdm import tqdm_notebook as tqdm
-except:
-    from tqdm import tqdm as tqdm
 
 from subprocess import call
 
@@ -30,17 +24,13 @@ from subprocess import call
 import pynd.ndutils as nd
 import re
 
-from imp import reload
-reload(nd)
-
-# from imp import reload # for re-loading modules, since some of the modules are still in development
-# reload(nd)
-
 
 def proc_mgh_vols(inpath,
                   outpath,
                   ext='.mgz',
                   label_idx=None,
+                  out_dtype=None,
+                  out_labels=False,
                   **kwargs): 
     ''' process mgh data from mgz format and save to numpy format
 
@@ -49,6 +39,12 @@ def proc_mgh_vols(inpath,
     3. resize
     4. save as python block
 
+    **kwargs are vol_proc arguments, e.g. resize_shape=..., resize_method='separable'
+    to resize with the multi-threaded resize_separable instead of scipy's zoom.
+
+    out_dtype optionally saves reduced-precision volumes, and out_labels indicates
+    whether the volumes are segmentations, see pack_vol.
+
     TODO: check header info and such.?
     '''
 
@@ -57,16 +53,10 @@ def proc_mgh_vols(inpath,
 
     # go through each file
     list_skipped_files = ()
-    for fileidx in tqdm(range(len(files)), ncols=80):
+    for fileidx in _tqdm()(range(len(files)), ncols=80):
 
         # load nifti volume
-        volnii = nib.load(os.path.join(inpath, files[fileidx]))
-
-        # get the data out
-        vol_data = volnii.get_data().astype(float)
-
-        if ('dim' in volnii.header) and volnii.header['dim'][4] > 1:
-            vol_data = vol_data[:, :, :, -1]
+        vol_data = _load_mgh_vol(os.path.join(inpath, files[fileidx]))
 
         # process volume
         try:
@@ -81,12 +71,60 @@ def proc_mgh_vols(inpath,
 
         # save numpy file
         outname = os.path.splitext(os.path.join(outpath, files[fileidx]))[0] + '.npz'
-        np.savez_compressed(outname, vol_data=vol_data)
+        np.savez_compressed(outname, **pack_vol(vol_data, out_dtype, labels=out_labels))
 
     for file in list_skipped_files:
         print("Skipped: %s" % file, file=sys.stderr)
 
 
+def proc_mgh_vols_parallel(inpath,
+                           outpath,
+                           ext='.mgz',
+                           label_idx=None,
+                           nb_workers=None,
+                           shard_idx=0,
+                           nb_shards=1,
+                           manifest_check='mtime',
+                           compress_level=6,
+                           out_dtype=None,
+                           out_labels=False,
+                           verbose=True,
+                           **kwargs):
+    ''' process mgh data from mgz format and save to numpy format, in parallel and resumable
+
+    same processing as proc_mgh_vols, but:
+    1. the (sorted) file list is sharded (files[shard_idx::nb_shards]), so that several
+       nodes can split one dataset, and each shard is processed with a pool of processes
+    2. a manifest (outpath/.proc_manifest_<shard_idx>.json) records, for each input file,
+       a key of the input (mtime and size, or a sha1 of its content) and of the vol_proc
+       arguments. Files whose output exists and whose key matches are skipped, so a crashed
+       or interrupted run can simply be restarted.
+    3. outputs are written to a temporary file and renamed, so a partial npz is never left
+       behind in outpath.
+
+    Parameters:
+        inpath, outpath, ext, label_idx: see proc_mgh_vols
+        nb_workers: number of worker processes (default: os.cpu_count())
+        shard_idx, nb_shards: process only files[shard_idx::nb_shards]
+        manifest_check: 'mtime' (mtime and size of the input) or 'hash' (sha1 of the input content)
+        compress_level: zlib level (0-9) of the saved npz. None to save an uncompressed npz.
+        out_dtype, out_labels: optional reduced-precision storage, see pack_vol
+        verbose: print per-file timing
+        **kwargs: vol_proc arguments
+
+    Returns:
+        list of per-file dictionaries with keys 'file', 'status' ('done', 'skipped' or 'failed')
+        and, for processed files, the 'load', 'proc', 'save' and 'total' times in seconds
+    '''
+    # the vol_proc arguments are part of the key, so changing them re-processes the data
+    proc_key = _args_key(label_idx=label_idx, compress_level=compress_level, out_dtype=out_dtype,
+                         out_labels=out_labels, **kwargs)
+    return _run_resumable(inpath, outpath, ext, 'proc', _proc_mgh_file,
+                          (label_idx, compress_level, (out_dtype, out_labels), kwargs), proc_key,
+                          nb_workers=nb_workers, shard_idx=shard_idx, nb_shards=nb_shards,
+                          manifest_check=manifest_check, verbose=verbose)
+
+
 def scans_to_slices(inpath, outpath, slice_nrs,
                     ext='.mgz',
                     label_idx=None,
@@ -95,25 +133,21 @@ def scans_to_slices(inpath, outpath, slice_nrs,
                     slice_pad=0,
                     vol_inner_pad_for_slice_nrs=0,
                     **kwargs):  # vol_proc args
+    ''' extract slices of the processed volumes, as png images or nifti volumes (see
+    scans_to_slices_parallel for a parallel and resumable version) '''
+
+    if slice_pad > 0:
+        assert (out_ext != '.png'), "slice pad can only be used with volumes"
 
     # get files in input directory
     files = [f for f in os.listdir(inpath) if f.endswith(ext)]
 
     # go through each file
     list_skipped_files = ()
-    for fileidx in tqdm(range(len(files)), ncols=80):
+    for fileidx in _tqdm()(range(len(files)), ncols=80):
 
         # load nifti volume
-        volnii = nib.load(os.path.join(inpath, files[fileidx]))
-
-        # get the data out
-        vol_data = volnii.get_data().astype(float)
-
-        if ('dim' in volnii.header) and volnii.header['dim'][4] > 1:
-            vol_data = vol_data[:, :, :, -1]
-
-        if slice_pad > 0:
-            assert (out_ext != '.png'), "slice pad can only be used with volumes"
+        vol_data = _load_mgh_vol(os.path.join(inpath, files[fileidx]))
 
         # process volume
         try:
@@ -122,41 +156,52 @@ def scans_to_slices(inpath, outpath, slice_nrs,
             list_skipped_files += (files[fileidx], )
             print("Skipping %s\nError: %s" % (files[fileidx], str(e)), file=sys.stderr)
             continue
-            
-        mult_fact = 255
-        if label_idx is not None:
-            vol_data = (vol_data == label_idx).astype(int)
-            mult_fact = 1
 
-        # extract slice
-        if slice_nrs is None:
-            slice_nrs_sel = range(vol_inner_pad_for_slice_nrs+slice_pad, vol_data.shape[dim_idx]-slice_pad-vol_inner_pad_for_slice_nrs)
-        else:
-            slice_nrs_sel = slice_nrs
-
-        for slice_nr in slice_nrs_sel:
-            slice_nr_out = range(slice_nr - slice_pad, slice_nr + slice_pad + 1)
-            if dim_idx == 2:  # TODO: fix in one line
-                vol_img = np.squeeze(vol_data[:, :, slice_nr_out])
-            elif dim_idx == 1:
-                vol_img = np.squeeze(vol_data[:, slice_nr_out, :])
-            else:
-                vol_img = np.squeeze(vol_data[slice_nr_out, :, :])
-           
-            # save file
-            if out_ext == '.png':
-                # save png file
-                img = (vol_img*mult_fact).astype('uint8')
-                outname = os.path.splitext(os.path.join(outpath, files[fileidx]))[0] + '_slice%d.png' % slice_nr
-                Image.fromarray(img).convert('RGB').save(outname)
-            else:
-                if slice_pad == 0:  # dimenion has collapsed
-                    assert vol_img.ndim == 2
-                    vol_img = np.expand_dims(vol_img, dim_idx)
-                # assuming nibabel saving image
-                nii = nib.Nifti1Image(vol_img, np.diag([1,1,1,1]))
-                outname = os.path.splitext(os.path.join(outpath, files[fileidx]))[0] + '_slice%d.nii.gz' % slice_nr
-                nib.save(nii, outname)
+        outbase = os.path.splitext(os.path.join(outpath, files[fileidx]))[0]
+        _save_slices(vol_data, outbase, slice_nrs, label_idx, dim_idx, out_ext, slice_pad,
+                     vol_inner_pad_for_slice_nrs)
+
+    for file in list_skipped_files:
+        print("Skipped: %s" % file, file=sys.stderr)
+
+
+def scans_to_slices_parallel(inpath, outpath, slice_nrs,
+                             ext='.mgz',
+                             label_idx=None,
+                             dim_idx=2,
+                             out_ext='.png',
+                             slice_pad=0,
+                             vol_inner_pad_for_slice_nrs=0,
+                             nb_workers=None,
+                             shard_idx=0,
+                             nb_shards=1,
+                             manifest_check='mtime',
+                             verbose=True,
+                             **kwargs):
+    ''' extract slices of the processed volumes, in parallel and resumable
+
+    same processing as scans_to_slices, with the sharding, pool of processes and manifest
+    (outpath/.slices_manifest_<shard_idx>.json) of proc_mgh_vols_parallel. The slices are
+    written to temporary files and renamed, and a volume is up to date if its key matches
+    and all the slices recorded for it exist.
+
+    Parameters:
+        inpath, outpath, slice_nrs, ext, label_idx, dim_idx, out_ext, slice_pad,
+            vol_inner_pad_for_slice_nrs: see scans_to_slices
+        nb_workers, shard_idx, nb_shards, manifest_check, verbose: see proc_mgh_vols_parallel
+        **kwargs: vol_proc arguments
+
+    Returns:
+        list of per-file dictionaries, see proc_mgh_vols_parallel
+    '''
+    if slice_pad > 0:
+        assert (out_ext != '.png'), "slice pad can only be used with volumes"
+
+    slice_args = (slice_nrs, label_idx, dim_idx, out_ext, slice_pad, vol_inner_pad_for_slice_nrs)
+    proc_key = _args_key(slice_args=slice_args, **kwargs)
+    return _run_resumable(inpath, outpath, ext, 'slices', _scan_slices_file, (slice_args, kwargs), proc_key,
+                          nb_workers=nb_workers, shard_idx=shard_idx, nb_shards=nb_shards,
+                          manifest_check=manifest_check, verbose=verbose)
 
 
 def vol_proc(vol_data,
@@ -165,14 +210,21 @@ def vol_proc(vol_data,
              interp_order=None,
              rescale=None,
              rescale_prctle=None,
+             rescale_prctle_nb_bins=None,  # None (exact np.percentile) or nb of bins of hist_percentile
              resize_slices=None,
              resize_slices_dim=None,
+             resize_method='zoom',  # 'zoom' (scipy) or 'separable' (see resize_separable)
+             resize_nb_threads=None,  # number of threads for resize_method='separable'
              offset=None,
              clip=None,
              extract_nd=None,  # extracts a particular section
              force_binary=None,  # forces anything > 0 to be 1
              permute=None):
-    ''' process a volume with a series of intensity rescale, resize and crop rescale'''
+    ''' process a volume with a series of intensity rescale, resize and crop rescale
+
+    resizing is done with scipy's zoom by default. resize_method='separable' uses the
+    multi-threaded float32 resize_separable instead (spline orders 0 to 3, default 3 like zoom).
+    '''
 
     if offset is not None:
         vol_data = vol_data + offset
@@ -184,9 +236,12 @@ def vol_proc(vol_data,
     if rescale_prctle is not None:
         # print("max:", np.max(vol_data.flat))
         # print("test")
-        rescale = np.percentile(vol_data.flat, rescale_prctle)
+        if rescale_prctle_nb_bins is None:
+            rescale = np.percentile(vol_data.flat, rescale_prctle)
+        else:
+            rescale = hist_percentile(vol_data, rescale_prctle, nb_bins=rescale_prctle_nb_bins)
         # print("rescaling by 1/%f" % (rescale))
-        vol_data = np.multiply(vol_data.astype(float), 1/rescale)
+        vol_data = np.multiply(vol_data, 1/rescale, dtype=float)
 
     if resize_slices is not None:
         resize_slices = [*resize_slices]
@@ -205,8 +260,14 @@ def vol_proc(vol_data,
         if resize_shape[-1] is None:
             resize_ratio = np.divide(resize_shape[0], vol_data.shape[0])
             resize_shape[-1] = np.round(resize_ratio * vol_data.shape[-1]).astype('int')
-        resize_ratio = np.divide(resize_shape, vol_data.shape)
-        vol_data = scipy.ndimage.interpolation.zoom(vol_data, resize_ratio, order=interp_order)
+        if resize_method == 'separable':
+            order = 3 if interp_order is None else interp_order
+            vol_data = resize_separable(vol_data, resize_shape, interp_order=order,
+                                        nb_threads=resize_nb_threads)
+        else:
+            assert resize_method == 'zoom', "unknown resize_method %s" % resize_method
+            resize_ratio = np.divide(resize_shape, vol_data.shape)
+            vol_data = scipy.ndimage.interpolation.zoom(vol_data, resize_ratio, order=interp_order)
 
     # crop data if necessary
     if crop is not None:
@@ -230,6 +291,246 @@ def vol_proc(vol_data,
     return vol_data
 
 
+def hist_percentile(vol_data, prctle, nb_bins=4096, chunk_size=2**22, vol_range=None):
+    '''
+    streaming, histogram-based estimate of np.percentile(vol_data, prctle)
+
+    the volume is visited in flat chunks of chunk_size voxels (no full-volume copy or sort):
+    one pass for the range (unless vol_range is given), one pass to accumulate a histogram
+    of nb_bins equal bins. The percentile is then linearly interpolated inside the bin that
+    holds the requested rank (same rank definition as np.percentile's 'linear').
+
+    Error: np.percentile interpolates between two adjacent order statistics x[k] <= x[k+1].
+    The estimate lies in the bin holding x[k], so it is within one bin width,
+    (max - min) / nb_bins, of x[k]. For volumes with millions of voxels x[k] and x[k+1] are
+    essentially equal, and the error w.r.t. np.percentile is bounded by (max - min) / nb_bins.
+
+    Parameters:
+        vol_data: nd array
+        prctle: percentile or list of percentiles, in [0, 100]
+        nb_bins: number of histogram bins
+        chunk_size: number of voxels processed at a time
+        vol_range: optional (min, max) of the data, to skip the range pass
+
+    Returns:
+        percentile estimate(s), a scalar if prctle is a scalar
+    '''
+    flat = np.reshape(vol_data, -1)
+    nb_vox = flat.size
+    assert nb_vox > 0, "hist_percentile needs a non-empty volume"
+
+    # range pass
+    if vol_range is None:
+        vmin, vmax = np.inf, -np.inf
+        for i in range(0, nb_vox, chunk_size):
+            chunk = flat[i:i + chunk_size]
+            vmin = min(vmin, chunk.min())
+            vmax = max(vmax, chunk.max())
+    else:
+        vmin, vmax = vol_range
+    vmin, vmax = float(vmin), float(vmax)
+
+    # histogram pass
+    width = (vmax - vmin) / nb_bins
+    if width == 0:
+        counts = np.zeros(nb_bins, np.int64)
+        counts[0] = nb_vox
+    else:
+        counts = np.zeros(nb_bins, np.int64)
+        for i in range(0, nb_vox, chunk_size):
+            chunk = flat[i:i + chunk_size]
+            idx = ((chunk - vmin) * (1 / width)).astype(np.int64)
+            np.clip(idx, 0, nb_bins - 1, out=idx)
+            counts += np.bincount(idx, minlength=nb_bins)
+
+    # locate each requested rank in the cumulative histogram
+    cdf = np.cumsum(counts)
+    prctles = np.atleast_1d(prctle).astype(float)
+    ranks = prctles / 100 * (nb_vox - 1)
+    bins = np.searchsorted(cdf, ranks, side='right')
+    bins = np.minimum(bins, nb_bins - 1)
+    before = cdf[bins] - counts[bins]
+    frac = (ranks - before + 0.5) / np.maximum(counts[bins], 1)
+    vals = vmin + (bins + np.clip(frac, 0, 1)) * width
+    vals = np.clip(vals, vmin, vmax)
+
+    if np.ndim(prctle) == 0:
+        return vals[0]
+    return vals
+
+
+def prctle_scale_factors(inpath, outfile, prctle,
+                         ext='.npz',
+                         nb_bins=4096,
+                         nb_workers=None,
+                         verbose=True):
+    '''
+    dataset-level percentile normalization pass.
+
+    computes, for each volume in inpath, the scale factor 1/hist_percentile(vol, prctle)
+    (the same factor as vol_proc(rescale_prctle=prctle)), and saves the factors in a json side
+    file {filename: scale}. Loading code can then normalize with a single multiply,
+    e.g. via load_scale_factors and voxelmorph's datagenerators.load_volfile(..., scale_factors=...)
+
+    Parameters:
+        inpath: folder of volumes
+        outfile: json file to write
+        prctle: percentile in [0, 100]
+        ext: extension of the volume files ('.npz' with 'vol_data', or nifti/mgh)
+        nb_bins: histogram bins, see hist_percentile for the error bound
+        nb_workers: number of processes (default: os.cpu_count())
+
+    Returns:
+        dictionary of scale factors
+    '''
+    files = sorted([f for f in os.listdir(inpath) if f.endswith(ext)])
+    infiles = [os.path.join(inpath, f) for f in files]
+
+    scales = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        for file, scale in zip(files, executor.map(_prctle_scale, infiles,
+                                                   [prctle] * len(files), [nb_bins] * len(files))):
+            scales[file] = scale
+            if verbose:
+                print('%s: %f' % (file, scale))
+
+    _atomic_json_dump(scales, outfile)
+    return scales
+
+
+def load_scale_factors(filename):
+    ''' load the {filename: scale} dictionary saved by prctle_scale_factors '''
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def resize_separable(vol_data, resize_shape, interp_order=1, nb_threads=None, dtype='float32'):
+    '''
+    resize a volume by resampling one axis at a time with precomputed 1-D interpolation weights
+
+    uses the same sampling grid as scipy.ndimage.zoom (output voxel i of an axis samples input
+    coordinate i * (n_in - 1) / (n_out - 1)) and B-spline interpolation of order 0 (nearest),
+    1 (linear), 2 or 3. For orders > 1 the volume is spline-prefiltered along each axis, like zoom.
+    The axes that shrink the most are resampled first, and every pass is split across
+    nb_threads threads along another axis. Computations are done in dtype (float32 by default).
+
+    see resize_accuracy to compare against zoom.
+
+    Parameters:
+        vol_data: nd array
+        resize_shape: output shape, same number of dimensions as vol_data
+        interp_order: spline order in [0, 1, 2, 3]
+        nb_threads: number of threads (default: os.cpu_count())
+        dtype: computation and output dtype
+
+    Returns:
+        resized volume of shape resize_shape
+    '''
+    assert interp_order in [0, 1, 2, 3], "interp_order should be 0, 1, 2 or 3, found %s" % interp_order
+    assert len(resize_shape) == vol_data.ndim, "resize_shape should have %d entries" % vol_data.ndim
+    if nb_threads is None:
+        nb_threads = os.cpu_count() or 1
+
+    vol_data = np.asarray(vol_data, dtype=dtype)
+    resize_shape = [int(f) for f in resize_shape]
+
+    # resample the axes with the smallest ratio first, so that later passes work on less data
+    axes = [d for d in np.argsort(np.divide(resize_shape, vol_data.shape)) if resize_shape[d] != vol_data.shape[d]]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        for axis in axes:
+            if interp_order > 1:
+                vol_data = scipy.ndimage.spline_filter1d(vol_data, order=interp_order, axis=axis,
+                                                         mode='mirror', output=vol_data.dtype)
+            idx, wts = _resize_weights(vol_data.shape[axis], resize_shape[axis], interp_order)
+            vol_data = _resample_axis(vol_data, axis, idx, wts.astype(dtype), executor, nb_threads)
+
+    return vol_data
+
+
+def resize_accuracy(vol_data, resize_shape, orders=(0, 1, 3), nb_threads=None):
+    '''
+    compare resize_separable to scipy.ndimage.zoom for several interpolation orders
+
+    Returns:
+        dictionary {order: stats} where stats has the maximum and mean absolute difference
+        (max_abs_diff, mean_abs_diff), the mean absolute difference relative to the intensity
+        range (rel_mean_abs_diff), the fraction of voxels that differ by more than 1e-3 of the
+        intensity range (frac_diff), and the run times of both methods (time_zoom, time_separable)
+    '''
+    vol_data = np.asarray(vol_data, dtype=float)
+    vol_range = max(np.max(vol_data) - np.min(vol_data), np.finfo(float).eps)
+    resize_ratio = np.divide(resize_shape, vol_data.shape)
+
+    stats = {}
+    for order in orders:
+        tstart = time.perf_counter()
+        vol_zoom = scipy.ndimage.interpolation.zoom(vol_data, resize_ratio, order=order)
+        tzoom = time.perf_counter() - tstart
+
+        tstart = time.perf_counter()
+        vol_sep = resize_separable(vol_data, resize_shape, interp_order=order, nb_threads=nb_threads)
+        tsep = time.perf_counter() - tstart
+
+        assert vol_zoom.shape == vol_sep.shape, "shape mismatch %s vs %s" % (vol_zoom.shape, vol_sep.shape)
+        diff = np.abs(vol_zoom - vol_sep)
+        stats[order] = {'max_abs_diff': float(np.max(diff)),
+                        'mean_abs_diff': float(np.mean(diff)),
+                        'rel_mean_abs_diff': float(np.mean(diff) / vol_range),
+                        'frac_diff': float(np.mean(diff > 1e-3 * vol_range)),
+                        'time_zoom': tzoom,
+                        'time_separable': tsep}
+    return stats
+
+
+def pack_vol(vol_data, dtype=None, labels=False):
+    '''
+    reduced-precision representation of a volume, as a dictionary of arrays for np.savez
+
+    Parameters:
+        vol_data: nd array
+        dtype: None (keep vol_data as is), 'uint8', 'uint16' or 'float16'
+        labels: whether vol_data is a segmentation. Labels are stored as is in 'uint8'
+            or 'uint16' (and have to fit the type). Intensities stored as 'uint8' are
+            quantized to 256 levels between the volume's min and max, with a per-volume
+            scale and offset.
+
+    Returns:
+        dictionary with 'vol_data' and, for quantized intensities, the float32 scalars
+        'vol_scale' and 'vol_offset' such that vol ~= vol_data * vol_scale + vol_offset
+        (see unpack_vol)
+    '''
+    if dtype is None:
+        return {'vol_data': vol_data}
+
+    assert dtype in ['uint8', 'uint16', 'float16'], "unknown pack dtype %s" % dtype
+    if labels:
+        assert dtype != 'float16', "labels should be packed as uint8 or uint16"
+        assert np.min(vol_data) >= 0 and np.max(vol_data) <= np.iinfo(dtype).max, \
+            "labels do not fit in %s" % dtype
+        return {'vol_data': np.round(vol_data).astype(dtype)}
+
+    if dtype == 'float16':
+        return {'vol_data': vol_data.astype('float16')}
+
+    vmin, vmax = float(np.min(vol_data)), float(np.max(vol_data))
+    scale = (vmax - vmin) / np.iinfo(dtype).max if vmax > vmin else 1.0
+    q = np.round((vol_data - vmin) * (1 / scale)).astype(dtype)
+    return {'vol_data': q, 'vol_scale': np.float32(scale), 'vol_offset': np.float32(vmin)}
+
+
+def unpack_vol(arrays, dtype='float32'):
+    '''
+    volume from a pack_vol dictionary, or a loaded npz file, upcast to dtype.
+    Files without 'vol_scale' are only cast.
+    '''
+    vol_data = arrays['vol_data'].astype(dtype)
+    if 'vol_scale' in arrays:
+        vol_data *= arrays['vol_scale']
+        vol_data += arrays['vol_offset']
+    return vol_data
+
+
 def prior_to_weights(prior_filename, nargout=1, min_freq=0, force_binary=False, verbose=False):
     
     ''' transform a 4D prior (3D + nb_labels) into a class weight vector '''
@@ -268,6 +569,7 @@ def prior_to_weights(prior_filename, nargout=1, min_freq=0, force_binary=False,
 
     # a bit of verbosity
     if verbose:
+        import matplotlib.pyplot as plt
         f, (ax1, ax2, ax3) = plt.subplots(1, 3)
         ax1.bar(range(prior.size), np.log(prior))
         ax1.set_title('log class freq')
@@ -322,7 +624,7 @@ def filestruct_change(in_path, out_path, re_map,
         os.mkdir(out_path)
 
     # go through folders
-    for subj in tqdm(os.listdir(in_path), desc=name):
+    for subj in _tqdm()(os.listdir(in_path), desc=name):
 
         # go through files in a folder
         files = os.listdir(os.path.join(in_path, subj))
@@ -363,10 +665,11 @@ def ml_split(in_path, out_path,
              cat_prop=[0.5, 0.3, 0.2],
              use_symlinks=False,
              seed=None,
-             tqdm=tqdm):
+             tqdm=None):
     """
     split dataset 
     """
+    tqdm = _tqdm() if tqdm is None else tqdm
 
     if seed is not None:
         np.random.seed(seed)
@@ -411,10 +714,331 @@ def ml_split(in_path, out_path,
         
 
 
+def _tqdm():
+    ''' tqdm_notebook in ipython, and tqdm otherwise '''
+    try:
+        get_ipython
+        from tqdm import tqdm_notebook as tqdm
+    except NameError:
+        from tqdm import tqdm as tqdm
+    return tqdm
 
 
+def _resize_weights(n_in, n_out, order):
+    '''
+    1-D interpolation taps for resize_separable
 
+    Returns:
+        idx: [order+1, n_out] int array of input indices (mirrored at the borders)
+        wts: [order+1, n_out] array of B-spline weights
+    '''
+    if n_out > 1:
+        x = np.arange(n_out) * ((n_in - 1) / (n_out - 1))
+    else:
+        x = np.zeros(1)
 
+    if order == 0:
+        idx = np.round(x)[np.newaxis, :]
+        wts = np.ones((1, n_out))
 
+    elif order == 1:
+        x0 = np.floor(x)
+        t = x - x0
+        idx = np.stack([x0, x0 + 1])
+        wts = np.stack([1 - t, t])
 
+    elif order == 2:
+        x0 = np.round(x)
+        t = x - x0
+        idx = np.stack([x0 - 1, x0, x0 + 1])
+        wts = np.stack([(0.5 - t) ** 2 / 2, 0.75 - t ** 2, (0.5 + t) ** 2 / 2])
 
+    else:
+        assert order == 3
+        x0 = np.floor(x)
+        t = x - x0
+        idx = np.stack([x0 - 1, x0, x0 + 1, x0 + 2])
+        wts = np.stack([(1 - t) ** 3 / 6,
+                        (3 * t ** 3 - 6 * t ** 2 + 4) / 6,
+                        (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6,
+                        t ** 3 / 6])
+
+    # mirror indices outside the volume (d c b | a b c d | c b a)
+    idx = idx.astype(np.int64)
+    if n_in == 1:
+        idx[:] = 0
+    else:
+        period = 2 * (n_in - 1)
+        idx = np.mod(idx, period)
+        idx = np.where(idx >= n_in, period - idx, idx)
+    return idx, wts
+
+
+def _resample_axis(vol_data, axis, idx, wts, executor, nb_threads):
+    ''' apply 1-D interpolation taps along axis, splitting the work along another axis '''
+    out_shape = list(vol_data.shape)
+    out_shape[axis] = idx.shape[1]
+    out = np.empty(out_shape, vol_data.dtype)
+
+    # weights broadcast along axis
+    wshape = [1] * vol_data.ndim
+    wshape[axis] = idx.shape[1]
+    wts = [np.reshape(w, wshape) for w in wts]
+
+    # split along the largest other axis
+    if vol_data.ndim == 1:
+        split_axis = None
+        nb_blocks = 1
+    else:
+        other_axes = [d for d in range(vol_data.ndim) if d != axis]
+        split_axis = other_axes[np.argmax([vol_data.shape[d] for d in other_axes])]
+        nb_blocks = min(nb_threads, vol_data.shape[split_axis])
+    bounds = np.linspace(0, 1 if split_axis is None else vol_data.shape[split_axis], nb_blocks + 1).astype(int)
+
+    def block(start, end):
+        sl = [slice(None)] * vol_data.ndim
+        if split_axis is not None:
+            sl[split_axis] = slice(start, end)
+        sl = tuple(sl)
+        src = vol_data[sl]
+        dst = out[sl]
+        np.multiply(np.take(src, idx[0], axis=axis), wts[0], out=dst)
+        for k in range(1, len(wts)):
+            dst += np.take(src, idx[k], axis=axis) * wts[k]
+
+    futures = [executor.submit(block, bounds[b], bounds[b + 1]) for b in range(nb_blocks)]
+    for future in futures:
+        future.result()
+    return out
+
+
+def _load_mgh_vol(filename):
+    ''' load the (last frame of the) volume in a nifti/mgh file as a float array '''
+    import nibabel as nib
+    volnii = nib.load(filename)
+    vol_data = volnii.get_data().astype(float)
+
+    if ('dim' in volnii.header) and volnii.header['dim'][4] > 1:
+        vol_data = vol_data[:, :, :, -1]
+    return vol_data
+
+
+def _prctle_scale(filename, prctle, nb_bins):
+    ''' scale factor of a single volume. Run in a worker process by prctle_scale_factors '''
+    if filename.endswith('.npz'):
+        vol_data = np.load(filename)['vol_data']
+    else:
+        import nibabel as nib
+        vol_data = nib.load(filename).get_data()
+    return 1 / float(hist_percentile(vol_data, prctle, nb_bins=nb_bins))
+
+
+def _proc_mgh_file(infile, outbase, label_idx, compress_level, pack_args, proc_kwargs):
+    ''' load, process and save a single file. Run in a worker process by proc_mgh_vols_parallel '''
+    outfile = outbase + '.npz'
+    tstart = time.perf_counter()
+    vol_data = _load_mgh_vol(infile)
+    tload = time.perf_counter()
+
+    vol_data = vol_proc(vol_data, **proc_kwargs)
+    if label_idx is not None:
+        vol_data = (vol_data == label_idx).astype(int)
+    tproc = time.perf_counter()
+
+    savez_atomic(outfile, compress_level=compress_level, **pack_vol(vol_data, *pack_args))
+    tsave = time.perf_counter()
+
+    return {'load': tload - tstart, 'proc': tproc - tload, 'save': tsave - tproc, 'total': tsave - tstart,
+            'outputs': [outfile]}
+
+
+def _scan_slices_file(infile, outbase, slice_args, proc_kwargs):
+    ''' load, process and save the slices of a single file. Run in a worker process by scans_to_slices_parallel '''
+    tstart = time.perf_counter()
+    vol_data = _load_mgh_vol(infile)
+    tload = time.perf_counter()
+
+    vol_data = vol_proc(vol_data, **proc_kwargs)
+    tproc = time.perf_counter()
+
+    outputs = _save_slices(vol_data, outbase, *slice_args)
+    tsave = time.perf_counter()
+
+    return {'load': tload - tstart, 'proc': tproc - tload, 'save': tsave - tproc, 'total': tsave - tstart,
+            'outputs': outputs}
+
+
+def _save_slices(vol_data, outbase, slice_nrs, label_idx, dim_idx, out_ext, slice_pad,
+                 vol_inner_pad_for_slice_nrs):
+    ''' save the slices of a processed volume (see scans_to_slices), each one atomically. Returns the filenames '''
+    mult_fact = 255
+    if label_idx is not None:
+        vol_data = (vol_data == label_idx).astype(int)
+        mult_fact = 1
+
+    # extract slice
+    if slice_nrs is None:
+        slice_nrs_sel = range(vol_inner_pad_for_slice_nrs+slice_pad, vol_data.shape[dim_idx]-slice_pad-vol_inner_pad_for_slice_nrs)
+    else:
+        slice_nrs_sel = slice_nrs
+
+    outputs = []
+    for slice_nr in slice_nrs_sel:
+        slice_nr_out = range(slice_nr - slice_pad, slice_nr + slice_pad + 1)
+        if dim_idx == 2:  # TODO: fix in one line
+            vol_img = np.squeeze(vol_data[:, :, slice_nr_out])
+        elif dim_idx == 1:
+            vol_img = np.squeeze(vol_data[:, slice_nr_out, :])
+        else:
+            vol_img = np.squeeze(vol_data[slice_nr_out, :, :])
+
+        # save file, via a temporary file with the same extension (which selects the format)
+        if out_ext == '.png':
+            from PIL import Image
+            img = (vol_img*mult_fact).astype('uint8')
+            outname = outbase + '_slice%d.png' % slice_nr
+            tmp_name = outbase + '_slice%d.tmp%d.png' % (slice_nr, os.getpid())
+            Image.fromarray(img).convert('RGB').save(tmp_name)
+        else:
+            import nibabel as nib
+            if slice_pad == 0:  # dimenion has collapsed
+                assert vol_img.ndim == 2
+                vol_img = np.expand_dims(vol_img, dim_idx)
+            nii = nib.Nifti1Image(vol_img, np.diag([1,1,1,1]))
+            outname = outbase + '_slice%d.nii.gz' % slice_nr
+            tmp_name = outbase + '_slice%d.tmp%d.nii.gz' % (slice_nr, os.getpid())
+            nib.save(nii, tmp_name)
+        os.replace(tmp_name, outname)
+        outputs.append(outname)
+    return outputs
+
+
+def _run_resumable(inpath, outpath, ext, manifest_name, worker, worker_args, proc_key,
+                   nb_workers=None, shard_idx=0, nb_shards=1, manifest_check='mtime', verbose=True):
+    '''
+    sharded, parallel and resumable processing of the files of inpath, shared by
+    proc_mgh_vols_parallel and scans_to_slices_parallel.
+
+    worker(infile, outbase, *worker_args) processes one file in a worker process, writes its
+    outputs atomically and returns its 'load', 'proc', 'save' and 'total' times and its
+    'outputs' filenames. The manifest outpath/.<manifest_name>_manifest_<shard_idx>.json
+    records the key (input key and proc_key) and the outputs of each processed file.
+    '''
+    assert manifest_check in ['mtime', 'hash'], \
+        "manifest_check should be 'mtime' or 'hash', found: %s" % manifest_check
+    assert 0 <= shard_idx < nb_shards, "shard_idx %d out of range for %d shards" % (shard_idx, nb_shards)
+
+    if not os.path.isdir(outpath):
+        os.makedirs(outpath)
+
+    # get files in input directory, and this shard
+    files = sorted([f for f in os.listdir(inpath) if f.endswith(ext)])[shard_idx::nb_shards]
+
+    # load the manifest of previous runs, if any
+    manifest_file = os.path.join(outpath, '.%s_manifest_%d.json' % (manifest_name, shard_idx))
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+    # decide which files are up to date
+    stats = []
+    todo = []
+    for file in files:
+        infile = os.path.join(inpath, file)
+        outbase = os.path.splitext(os.path.join(outpath, file))[0]
+        key = _file_key(infile, manifest_check) + '/' + proc_key
+        entry = manifest.get(file, None)
+        # entries without outputs are from proc_mgh_vols_parallel manifests that only had the npz
+        outputs = None if entry is None else entry.get('outputs', [os.path.basename(outbase) + '.npz'])
+        if entry is not None and entry['key'] == key and \
+                all(os.path.isfile(os.path.join(outpath, o)) for o in outputs):
+            stats.append({'file': file, 'status': 'skipped'})
+        else:
+            todo.append((file, infile, outbase, key))
+
+    if verbose:
+        print('%d files, %d up to date, processing %d' % (len(files), len(stats), len(todo)))
+
+    # process the remaining files in a pool of processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        futures = {executor.submit(worker, infile, outbase, *worker_args): \
+                   (file, key) for (file, infile, outbase, key) in todo}
+        for future in concurrent.futures.as_completed(futures):
+            file, key = futures[future]
+            try:
+                file_stats = future.result()
+            except Exception as e:
+                stats.append({'file': file, 'status': 'failed'})
+                print("Skipping %s\nError: %s" % (file, str(e)), file=sys.stderr)
+                continue
+
+            file_stats['file'] = file
+            file_stats['status'] = 'done'
+            outputs = [os.path.basename(o) for o in file_stats.pop('outputs')]
+            stats.append(file_stats)
+            if verbose:
+                print('%s: load %.3fs, proc %.3fs, save %.3fs, total %.3fs' % \
+                      (file, file_stats['load'], file_stats['proc'], file_stats['save'], file_stats['total']))
+
+            # update the manifest after every file, so that we can resume at any point
+            manifest[file] = {'key': key, 'time': file_stats['total'], 'outputs': outputs}
+            _atomic_json_dump(manifest, manifest_file)
+
+    for file_stats in stats:
+        if file_stats['status'] == 'failed':
+            print("Skipped: %s" % file_stats['file'], file=sys.stderr)
+
+    return stats
+
+
+def savez_atomic(filename, compress_level=6, **arrays):
+    '''
+    save arrays to a npz file (readable by np.load) via a temporary file and a rename,
+    so that filename is either the complete new file or untouched.
+
+    Parameters:
+        filename: output filename
+        compress_level: zlib level (0-9), or None for an uncompressed npz (like np.savez)
+        **arrays: the variables to save
+    '''
+    if compress_level is None:
+        zip_kwargs = {'compression': zipfile.ZIP_STORED}
+    else:
+        zip_kwargs = {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': compress_level}
+
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    try:
+        with zipfile.ZipFile(tmp_filename, mode='w', allowZip64=True, **zip_kwargs) as zipf:
+            for name, arr in arrays.items():
+                with zipf.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def _file_key(filename, manifest_check='mtime'):
+    ''' key identifying the content of a file, either via its mtime and size or its sha1 '''
+    if manifest_check == 'mtime':
+        st = os.stat(filename)
+        return '%d-%d' % (st.st_mtime_ns, st.st_size)
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _args_key(**kwargs):
+    ''' short key of processing arguments '''
+    return hashlib.sha1(repr(sorted(kwargs.items())).encode()).hexdigest()[:16]
+
+
+def _atomic_json_dump(obj, filename):
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.replace(tmp_filename, filename)
@@ -6,7 +6,6 @@ import os
 
 # third party imports
 import numpy as np
-import nibabel as nib
 import scipy
 from keras.utils import np_utils 
 import keras
@@ -19,10 +18,6 @@ import pynd.ndutils as nd
 import pytool.patchlib as pl
 import pytool.timer as timer
 
-# reload patchlib (it's often updated right now...)
-from imp import reload
-reload(pl)
-
 # other neuron (this project) packages
 from . import dataproc as nrn_proc
 from . import models as nrn_models
@@ -73,6 +68,7 @@ def vol(volpath,
         relabel=None,       # relabeling array
         nb_labels_reshape=0,  # reshape to categorial format for keras, need # labels
         keep_vol_size=False,  # whether to keep the volume size on categorical resizing
+        sparse_labels=False,  # keep integer labels instead of categorical (see _categorical_prep)
         name='single_vol',  # name, optional
         nb_restart_cycle=None,  # number of files to restart after
         patch_size=None,     # split the volume in patches? if so, get patch_size
@@ -137,6 +133,11 @@ def vol(volpath,
     if verbose:
         print('nb_restart_cycle:', nb_restart_cycle)
 
+    # relabeling lookup table, computed once for all files
+    lut = None
+    if relabel is not None:
+        lut = relabel_lut(relabel)
+
     # iterate through files
     fileidx = -1
     batch_idx = -1
@@ -167,7 +168,7 @@ def vol(volpath,
         # the original segmentation files have non-sequential relabel (i.e. some relabel are
         # missing to avoid exploding our model, we only care about the relabel that exist.
         if relabel is not None:
-            vol_data = _relabel(vol_data, relabel)
+            vol_data = _relabel(vol_data, relabel, lut=lut)
 
         # split volume into patches if necessary and yield
         if patch_size is None:
@@ -192,7 +193,8 @@ def vol(volpath,
                           collapse_2d=collapse_2d,
                           patch_rand=patch_rand,
                           patch_rand_seed=patch_rand_seed,
-                          keep_vol_size=keep_vol_size)
+                          keep_vol_size=keep_vol_size,
+                          sparse_labels=sparse_labels)
 
         empty_gen = True
         patch_idx = -1
@@ -255,6 +257,7 @@ def patch(vol_data,             # the volume
           patch_rand=False,
           patch_rand_seed=None,
           variable_batch_size=False,
+          sparse_labels=False,  # keep integer labels instead of categorical
           infinite=False):      # whether the generator should continue (re)-generating patches
     """
     generate patches from volume for keras package
@@ -290,7 +293,8 @@ def patch(vol_data,             # the volume
             empty_gen = False
             # reshape output layer as categorical and prep proper size
             # print(lpatch.shape, nb_labels_reshape, keep_vol_size, patch_size)
-            lpatch = _categorical_prep(lpatch, nb_labels_reshape, keep_vol_size, patch_size)
+            lpatch = _categorical_prep(lpatch, nb_labels_reshape, keep_vol_size, patch_size,
+                                       sparse_labels=sparse_labels)
 
             if collapse_2d is not None:
                 lpatch = np.squeeze(lpatch, collapse_2d + 1)  # +1 due to batch in first dim
@@ -300,7 +304,9 @@ def patch(vol_data,             # the volume
                 if batch_size == 1:
                     patch_data_batch = lpatch
                 else:
-                    patch_data_batch = np.zeros([batch_size, *lpatch.shape[1:]])
+                    # integer labels stay compact in the batch
+                    batch_dtype = lpatch.dtype if sparse_labels else float
+                    patch_data_batch = np.zeros([batch_size, *lpatch.shape[1:]], batch_dtype)
                     patch_data_batch[0, :] = lpatch
 
             else:
@@ -339,6 +345,7 @@ def vol_seg(volpath,
             relabel=None,
             vol_rand_seed=None,
             seg_binary=False,
+            sparse_seg=False,
             vol_subname='norm',  # subname of volume
             seg_subname='aseg',  # subname of segmentation
             **kwargs):
@@ -347,6 +354,10 @@ def vol_seg(volpath,
 
     verbose is passed down to the base generators.py primitive generator (e.g. vol, here)
 
+    if sparse_seg, segmentations are yielded as integer labels [..., 1] (uint8 or uint16)
+    instead of float16 one-hot volumes of nb_labels_reshape channels. Use onehot_batches to
+    convert them per batch, or neuron.utils.sparse_to_onehot to convert them in the graph.
+
     ** kwargs are any named arguments for vol(...),
         except verbose, data_proc_fn, ext, nb_labels_reshape and name
             (which this function will control when calling vol())
@@ -365,18 +376,33 @@ def vol_seg(volpath,
     seg_gen = vol(segpath, **kwargs, ext=ext, nb_restart_cycle=nb_restart_cycle, collapse_2d=collapse_2d,
                   force_binary=force_binary, relabel=relabel, vol_rand_seed=vol_rand_seed,
                   data_proc_fn=proc_seg_fn, nb_labels_reshape=nb_labels_reshape, keep_vol_size=True,
-                  expected_files=vol_files, name=name+' seg', binary=seg_binary, verbose=False)
+                  expected_files=vol_files, name=name+' seg', binary=seg_binary, verbose=False,
+                  sparse_labels=sparse_seg)
 
     # on next (while):
     while 1:
         # get input and output (seg) vols
         input_vol = next(vol_gen).astype('float16')
-        output_vol = next(seg_gen).astype('float16')  # was int8. Why? need float possibility...
+        output_vol = next(seg_gen)
+        if not sparse_seg:
+            output_vol = output_vol.astype('float16')  # was int8. Why? need float possibility...
 
         # output input and output
         yield (input_vol, output_vol)
 
 
+def onehot_batches(gen, nb_labels, dtype='float16'):
+    """
+    convert the integer label batches of a (input, labels) generator to one-hot batches,
+    e.g. for vol_seg(..., sparse_seg=True). The dense representation then only exists
+    for the batch being fed to the model.
+    """
+    while 1:
+        input_vol, output_vol = next(gen)
+        output_vol = _to_categorical(output_vol[..., 0], nb_labels).astype(dtype)
+        yield (input_vol, output_vol)
+
+
 # def seg_seg(volpath,
 #             segpath,
 #             crop=None, resize_shape=None, rescale=None, # processing parameters
@@ -1308,10 +1334,14 @@ def _load_medical_volume(filename, ext, verbose=False):
     with timer.Timer('load_vol', verbose >= 2):
         if ext == '.npz':
             vol_file = np.load(filename)
-            vol_data = vol_file['vol_data']
+            if 'vol_scale' in vol_file:  # reduced-precision file, see dataproc.pack_vol
+                vol_data = nrn_proc.unpack_vol(vol_file)
+            else:
+                vol_data = vol_file['vol_data']
         elif ext == 'npy':
             vol_data = np.load(filename)
         elif ext == '.mgz' or ext == '.nii' or ext == '.nii.gz':
+            import nibabel as nib
             vol_med = nib.load(filename)
             vol_data = vol_med.get_data()
         else:
@@ -1320,9 +1350,13 @@ def _load_medical_volume(filename, ext, verbose=False):
     return vol_data
 
 
-def _categorical_prep(vol_data, nb_labels_reshape, keep_vol_size, patch_size):
+def _categorical_prep(vol_data, nb_labels_reshape, keep_vol_size, patch_size, sparse_labels=False):
+
+    if nb_labels_reshape > 1 and sparse_labels:
+        # compact categorical: integer labels, one-hot conversion is deferred
+        lpatch = np.expand_dims(vol_data.astype(_label_dtype(nb_labels_reshape)), axis=-1)
 
-    if nb_labels_reshape > 1:
+    elif nb_labels_reshape > 1:
         
         lpatch = _to_categorical(vol_data, nb_labels_reshape, keep_vol_size)
         # if keep_vol_size:
@@ -1367,18 +1401,43 @@ def _to_categorical(y, num_classes=None, reshape=True):
     
     return categorical
 
-def _relabel(vol_data, labels, forcecheck=False):
+def relabel_lut(labels):
+    """
+    lookup table for _relabel: lut[labels[i]] = i, and 0 for any other value.
+    The last entry is a 0 sentinel that values above max(labels) are clipped to.
+    """
+    labels = np.asarray(labels).ravel()
+    assert np.all(labels >= 0) and np.all(np.mod(labels, 1) == 0), \
+        "relabel_lut needs non-negative integer labels"
+    labels = labels.astype(np.int64)
+    lut = np.zeros(labels.max() + 2, np.int64)
+    lut[labels] = np.arange(len(labels))
+    return lut
+
+
+def _relabel(vol_data, labels, forcecheck=False, lut=None):
+    """
+    relabel vol_data so that labels[i] becomes i, and any label not in labels becomes 0
+
+    done with a single np.take through a lookup table (see relabel_lut), which can be
+    precomputed and passed via lut. Assumes non-negative (integer valued) labels in vol_data.
+    """
     
     if forcecheck:
         vd = np.unique(vol_data.flat)
         assert len(vd) == len(labels), "number of given labels does not match number of actual labels"
     
-    # by doing zeros, any label not in labels gets left to 0
-    new_vol_data = np.zeros(vol_data.shape, vol_data.dtype)
-    for idx, val in np.ndenumerate(labels):
-        new_vol_data[vol_data == val] = idx
-    
-    return new_vol_data
+    if lut is None:
+        lut = relabel_lut(labels)
+
+    # values above max(labels) are clipped to the 0 sentinel at the end of the lut
+    idx = vol_data if np.issubdtype(vol_data.dtype, np.integer) else vol_data.astype(np.int64)
+    return np.take(lut.astype(vol_data.dtype), idx, mode='clip')
+
+
+def _label_dtype(nb_labels):
+    """ smallest unsigned integer type for nb_labels labels """
+    return np.uint8 if nb_labels <= 256 else np.uint16
 
 
 
@@ -25,7 +25,7 @@ from keras.layers import Layer
 import tensorflow as tf
 
 # local
-from .utils import transform, integrate_vec, affine_to_shift
+from .utils import transform, integrate_vec, affine_to_shift, recompute_grad
 
 
 class SpatialTransformer(Layer):
@@ -51,15 +51,18 @@ class SpatialTransformer(Layer):
     dimensions, and along the way wrote grid and interpolation functions
     """
 
-    def __init__(self, interp_method='linear', indexing='ij', **kwargs):
+    def __init__(self, interp_method='linear', indexing='ij', recompute=False, **kwargs):
         """
         Parameters: 
             interp_method: 'linear' or 'nearest'
             indexing (default: 'ij'): 'ij' (matrix) or 'xy' (cartesian)
                 'xy' indexing will have the first two entries of the flow 
                 (along last axis) flipped compared to 'ij' indexing
+            recompute: recompute the interpolation (locations, weights and gathered
+                corners) during backprop instead of keeping it, see utils.recompute_grad
         """
         self.interp_method = interp_method
+        self.recompute = recompute
         self.ndims = None
         self.inshape = None
 
@@ -165,6 +168,11 @@ class SpatialTransformer(Layer):
 
         # print(vol.shape) (?, 160, 192, 224, 1)
         # print(trf.shape) (?, 160, 192, 224, 3)
+        if self.recompute:
+            return recompute_grad(self._batch_transform)(vol, trf)
+        return self._batch_transform(vol, trf)
+
+    def _batch_transform(self, vol, trf):
         return tf.map_fn(self._single_transform, [vol, trf], dtype=tf.float32)
 
     def _single_aff_to_shift(self, trf, volshape):
@@ -197,16 +205,20 @@ class VecInt(Layer):
       MICCAI 2018.
     """
 
-    def __init__(self, indexing='ij', method='ode', int_steps=7, **kwargs):
+    def __init__(self, indexing='ij', method='ode', int_steps=7, recompute=False, **kwargs):
         """        
         Parameters:
             method can be any of the methods in neuron.utils.integrate_vec
+            recompute: for scaling and squaring, recompute the warp of each step during
+                backprop instead of keeping it (only the int_steps fields are kept),
+                see utils.recompute_grad
         """
 
         assert indexing in ['ij', 'xy'], "indexing has to be 'ij' (matrix) or 'xy' (cartesian)"
         self.indexing = indexing
         self.method = method
         self.int_steps = int_steps
+        self.recompute = recompute
         self.inshape = None
         super(self.__class__, self).__init__(**kwargs)
 
@@ -227,6 +239,14 @@ class VecInt(Layer):
             loc_shift_lst = [loc_shift_split[1], loc_shift_split[0], *loc_shift_split[2:]]
             loc_shift = tf.concat(loc_shift_lst, -1)
 
+        # scaling and squaring across the batch, with each step's warp recomputed in backprop
+        if self.recompute and self.method in ['ss', 'scaling_and_squaring']:
+            warp = recompute_grad(lambda v: tf.map_fn(lambda x: transform(x, x), v, dtype=tf.float32))
+            vec = loc_shift / (2 ** self.int_steps)
+            for _ in range(self.int_steps):
+                vec = vec + warp(vec)
+            return vec
+
         # map transform across batch
         return tf.map_fn(self._single_int, loc_shift, dtype=tf.float32)
 
@@ -294,6 +314,129 @@ class LocalLinearLayer(Layer):
         return input_shape
  
 
+class Recompute(Layer):
+    """
+    block of keras layers whose intermediate outputs are recomputed during backprop instead
+    of being kept (gradient checkpointing, see utils.recompute_grad): only the block's inputs
+    and output stay in memory during training.
+
+    The block is given as fn(apply, inputs), which calls each of its layers as apply(layer, x),
+    e.g. for an upsampling, concatenation and convolution block:
+        fn = lambda apply, x: apply(conv, apply(concat, [apply(up, x[0]), x[1]]))
+        y = Recompute(fn, [up, concat, conv])([x, skip])
+    fn(lambda layer, x: layer(x), [x, skip]) builds the same block without recomputation.
+
+    The weights are those of block_layers, in order, so a block with a single weighted layer
+    saves and loads (by topology) the same weights as the plain block.
+    """
+
+    def __init__(self, fn, block_layers, **kwargs):
+        self.fn = fn
+        self.block_layers = block_layers
+        self.block_shapes = []
+        super(Recompute, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        # build the layers, and keep their input and output shapes (e.g. for planning)
+        self.block_shapes = []
+
+        def build_layer(layer, shape):
+            if not layer.built:
+                layer.build(shape)
+                layer.built = True
+            out_shape = layer.compute_output_shape(shape)
+            self.block_shapes.append((layer, shape, out_shape))
+            return out_shape
+
+        self.fn(build_layer, input_shape)
+        super(Recompute, self).build(input_shape)
+
+    @property
+    def trainable_weights(self):
+        if not self.trainable:
+            return []
+        return [w for layer in self.block_layers for w in layer.trainable_weights]
+
+    @property
+    def non_trainable_weights(self):
+        weights = [w for layer in self.block_layers for w in layer.non_trainable_weights]
+        if not self.trainable:
+            weights = [w for layer in self.block_layers for w in layer.trainable_weights] + weights
+        return weights
+
+    def call(self, inputs):
+        is_list = isinstance(inputs, list)
+        inputs = inputs if is_list else [inputs]
+
+        def block(*x):
+            return self.fn(lambda layer, y: layer.call(y), list(x) if is_list else x[0])
+
+        return recompute_grad(block, weights=self.trainable_weights)(*inputs)
+
+    def compute_output_shape(self, input_shape):
+        return self.fn(lambda layer, shape: layer.compute_output_shape(shape), input_shape)
+
+
+class DepthwiseConv3D(Layer):
+    """
+    3D depthwise convolution: one kernel per input channel, with 'same' padding,
+    as keras' DepthwiseConv2D (which has no 3D version). Followed by a 1x1x1 Conv3D, it makes
+    a depthwise-separable 3D convolution.
+
+    Computed as depthwise 2D convolutions of the (strided) depth slices, one per kernel depth
+    offset, which are summed. Needs static spatial input sizes.
+    """
+
+    def __init__(self, kernel_size=3, strides=1, use_bias=True, kernel_initializer='he_normal', **kwargs):
+        self.kernel_size = (kernel_size,) * 3 if isinstance(kernel_size, int) else tuple(kernel_size)
+        self.strides = (strides,) * 3 if isinstance(strides, int) else tuple(strides)
+        self.use_bias = use_bias
+        self.kernel_initializer = kernel_initializer
+        super(DepthwiseConv3D, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super(DepthwiseConv3D, self).get_config()
+        config.update({'kernel_size': self.kernel_size, 'strides': self.strides,
+                       'use_bias': self.use_bias, 'kernel_initializer': self.kernel_initializer})
+        return config
+
+    def build(self, input_shape):
+        assert len(input_shape) == 5, 'DepthwiseConv3D needs 3D inputs [batch, *vol_shape, nb_feats]'
+        nb_feats = input_shape[-1]
+        self.kernel = self.add_weight(name='depthwise_kernel',
+                                      shape=(*self.kernel_size, nb_feats, 1),
+                                      initializer=self.kernel_initializer,
+                                      trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', shape=(nb_feats,), initializer='zeros', trainable=True)
+        super(DepthwiseConv3D, self).build(input_shape)
+
+    def call(self, x):
+        vol_shape = x.get_shape().as_list()[1:-1]
+        nb_feats = x.get_shape().as_list()[-1]
+        out_shape = self.compute_output_shape([None, *vol_shape, nb_feats])[1:-1]
+
+        # 'same' padding of the depth axis, as tensorflow pads the strided convolutions
+        kd, sd = self.kernel_size[0], self.strides[0]
+        pad = max((out_shape[0] - 1) * sd + kd - vol_shape[0], 0)
+        x = tf.pad(x, [[0, 0], [pad // 2, pad - pad // 2], [0, 0], [0, 0], [0, 0]])
+
+        out = 0
+        for k in range(kd):
+            x_k = x[:, k:k + sd * (out_shape[0] - 1) + 1:sd]
+            x_k = tf.reshape(x_k, [-1, *vol_shape[1:], nb_feats])
+            out += tf.nn.depthwise_conv2d(x_k, self.kernel[k], strides=[1, *self.strides[1:], 1],
+                                          padding='SAME')
+        out = tf.reshape(out, [-1, *out_shape, nb_feats])
+        if self.use_bias:
+            out = out + self.bias
+        return out
+
+    def compute_output_shape(self, input_shape):
+        vol_shape = [None if s is None else -(-s // st) for s, st in zip(input_shape[1:-1], self.strides)]
+        return (input_shape[0], *vol_shape, input_shape[-1])
+
+
 class LocallyConnected3D(Layer):
     """
     code based on LocallyConnected3D from keras layers:
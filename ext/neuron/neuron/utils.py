@@ -17,11 +17,11 @@ License: GPLv3
 """
 
 # python imports
+import os
 import itertools
 
 # third party imports
 import numpy as np
-from tqdm import tqdm_notebook as tqdm
 from pprint import pformat
 
 import pytool.patchlib as pl
@@ -30,12 +30,9 @@ import pytool.timer as timer
 # local imports
 import pynd.ndutils as nd
 
-# often changed file
-from imp import reload
 import keras
 import keras.backend as K
 import tensorflow as tf
-reload(pl)
 
 def interpn(vol, loc, interp_method='linear'):
     """
@@ -456,6 +453,49 @@ def integrate_vec(vec, time_dep=False, method='ss', **kwargs):
     return disp
 
 
+def recompute_grad(fn, weights=None):
+    """
+    gradient checkpointing: wrap fn(*inputs) -> Tensor so that its intermediate tensors are
+    not kept for the gradients, but recomputed from the inputs during backprop. fn then runs
+    twice per training step, but only its inputs and output stay in memory.
+
+    Parameters:
+        fn: function of Tensors, returning a Tensor
+        weights: variables read by fn (e.g. the kernels of keras layers, built before the call).
+            Their gradients are computed through the recomputation.
+
+    Returns:
+        function of the same inputs as fn
+    """
+    weights = [] if weights is None else list(weights)
+
+    def wrapper(*inputs):
+        nb_inputs = len(inputs)
+
+        @tf.custom_gradient
+        def checkpointed(*args):
+            output = fn(*args[:nb_inputs])
+
+            def grad(dy):
+                # recompute once the output gradient is available, so that the forward
+                # pass does not keep the recomputed tensors either.
+                # grad must not take a `variables` argument: with the (non-resource) keras
+                # variables, tf.custom_gradient then raises. The weight gradients are returned
+                # as those of the weight inputs instead.
+                with tf.control_dependencies([dy]):
+                    inputs_again = [tf.identity(x) for x in args[:nb_inputs]]
+                output_again = fn(*inputs_again)
+                grads = tf.gradients(output_again, inputs_again + weights, grad_ys=dy)
+                return grads[:nb_inputs + len(weights)]
+
+            return output, grad
+
+        # the weights are passed as inputs, so that their gradients go through grad
+        return checkpointed(*inputs, *[tf.identity(w) for w in weights])
+
+    return wrapper
+
+
 def volshape_to_ndgrid(volshape, **kwargs):
     """
     compute Tensor ndgrid from a volume size
@@ -916,6 +956,7 @@ def copy_model_weights(src_model, dst_model):
         dst_model: destination keras model to copy to
     """
 
+    from tqdm import tqdm_notebook as tqdm
     for layer in tqdm(dst_model.layers):
         try:
             wts = src_model.get_layer(layer.name).get_weights()
@@ -953,6 +994,141 @@ def robust_multi_gpu_model(model, gpus, verbose=True):
 
 
 
+def sparse_to_onehot(y, nb_labels, dtype='float32'):
+    """
+    in-graph one-hot conversion of integer labels
+
+    e.g. for the compact label batches of neuron.generators.vol_seg(..., sparse_seg=True),
+    which can be fed to the model as integers and expanded only inside the graph,
+    via a Lambda layer or inside a loss.
+
+    Parameters:
+        y: Tensor of integer labels of shape [..., 1] 
+        nb_labels: number of labels
+        dtype: output dtype
+
+    Returns:
+        Tensor of shape [..., nb_labels]
+    """
+    y = tf.cast(y[..., 0], 'int32')
+    return tf.one_hot(y, nb_labels, dtype=dtype)
+
+
+def traced_function(function, run_metadata):
+    """
+    a copy of a keras backend function (e.g. model.train_function) that runs with a full
+    trace into run_metadata. It shares the original's inputs, outputs and update op, so
+    swapping it in (e.g. model.train_function = traced) does not change training.
+    """
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    return K.function(function.inputs, function.outputs, updates=[function.updates_op],
+                      fetches=function.fetches, feed_dict=function.feed_dict,
+                      options=run_options, run_metadata=run_metadata)
+
+
+def write_trace(run_metadata, filename):
+    """ write the chrome trace (chrome://tracing) timeline of a traced run, with memory """
+    from tensorflow.python.client import timeline
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(filename, 'w') as f:
+        f.write(trace.generate_chrome_trace_format(show_memory=True))
+
+
+def trace_op_table(run_metadatas, layer_names, graph=None):
+    """
+    aggregate traced runs into a per (layer, op type) table of time and memory
+
+    each op is assigned to the first keras layer name in its name scope (e.g. 'flow', 'flow-int'
+    or 'diffflow' of the voxelmorph networks), with ' (grad)' for the ops of the gradients,
+    or to 'other'.
+
+    Parameters:
+        run_metadatas: list of tf.RunMetadata of traced runs
+        layer_names: names of the keras layers
+        graph: the graph of the runs (default: the default graph)
+
+    Returns:
+        list of dicts with 'layer', 'op', 'count', 'time_ms' (total over all runs),
+        'time_ms_per_run' and 'bytes_per_run' (output allocations), sorted by decreasing time
+    """
+    graph = tf.get_default_graph() if graph is None else graph
+    layer_names = set(layer_names)
+    table = {}
+    for run_metadata in run_metadatas:
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                node_name = node.node_name.split(':')[0]
+                try:
+                    op_type = graph.get_operation_by_name(node_name).type
+                except KeyError:
+                    # e.g. _SOURCE, or device stream records
+                    continue
+                scopes = node_name.split('/')
+                layer = next((s for s in scopes if s in layer_names), 'other')
+                if 'gradients' in scopes and layer != 'other':
+                    layer += ' (grad)'
+
+                key = (layer, op_type)
+                if key not in table:
+                    table[key] = {'layer': layer, 'op': op_type, 'count': 0, 'time_ms': 0, 'bytes': 0}
+                table[key]['count'] += 1
+                table[key]['time_ms'] += (node.all_end_rel_micros) / 1000
+                table[key]['bytes'] += sum(o.tensor_description.allocation_description.requested_bytes
+                                           for o in node.output)
+
+    nb_runs = max(len(run_metadatas), 1)
+    rows = sorted(table.values(), key=lambda r: -r['time_ms'])
+    for row in rows:
+        row['time_ms_per_run'] = row['time_ms'] / nb_runs
+        row['bytes_per_run'] = row.pop('bytes') / nb_runs
+    return rows
+
+
+def write_op_table(rows, filename=None, nb_print=20):
+    """ write a trace_op_table to a csv file and print its top nb_print rows """
+    fields = ['layer', 'op', 'count', 'time_ms', 'time_ms_per_run', 'bytes_per_run']
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(','.join(fields) + '\n')
+            for row in rows:
+                f.write(','.join(str(row[k]) for k in fields) + '\n')
+
+    total = sum(r['time_ms'] for r in rows)
+    print('%-30s %-25s %8s %12s %7s %12s' % ('layer', 'op', 'count', 'ms/run', '%', 'MB/run'))
+    for row in rows[:nb_print]:
+        print('%-30s %-25s %8d %12.3f %6.1f%% %12.2f' %
+              (row['layer'], row['op'], row['count'], row['time_ms_per_run'],
+               100 * row['time_ms'] / max(total, 1e-9), row['bytes_per_run'] / 2**20))
+
+
+def trace_predict(model, inputs, trace_dir, nb_runs=1, name='predict'):
+    """
+    trace model.predict on a batch of inputs, writing chrome traces and the per-op table
+    of model's layers to trace_dir. The first, untraced, run warms up the model.
+
+    Returns:
+        the model's prediction
+    """
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+
+    pred = model.predict(inputs)
+    model._make_predict_function()
+    ins = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+    if model._uses_dynamic_learning_phase():
+        ins = ins + [0.]
+
+    run_metadatas = [tf.RunMetadata() for _ in range(nb_runs)]
+    for i, run_metadata in enumerate(run_metadatas):
+        fn = traced_function(model.predict_function, run_metadata)
+        pred = fn(ins)
+        write_trace(run_metadata, os.path.join(trace_dir, '%s_%d.trace.json' % (name, i)))
+
+    rows = trace_op_table(run_metadatas, [l.name for l in model.layers])
+    write_op_table(rows, os.path.join(trace_dir, '%s_ops.csv' % name))
+    return pred[0] if len(pred) == 1 else pred
+
+
 def logtanh(x, a=1):
     """
     log * tanh
@@ -1109,6 +1285,8 @@ def predict_volume_stack(models,
     nb_batches = ((nb_patches - 1) // batch_size) + 1
 
     # go through the patches
+    if verbose:
+        from tqdm import tqdm_notebook as tqdm
     batch_gen = tqdm(range(nb_batches)) if verbose else range(nb_batches)
     for batch_idx in batch_gen:
         sample = next(data_generator)
@@ -1,2 +1,15 @@
-from . import ndutils
-from . import segutils
\ No newline at end of file
+# submodules are imported lazily
+import importlib
+
+__all__ = ['ndutils', 'segutils']
+
+
+def __getattr__(name):
+    """ import the submodules on first access (PEP 562) """
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -9,7 +9,6 @@ import builtins
 import numpy as np
 import scipy as sp
 import scipy.ndimage
-from scipy.spatial import ConvexHull
 
 
 def boundingbox(bwvol):
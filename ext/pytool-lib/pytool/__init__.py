@@ -1,4 +1,15 @@
-from . import iniparse
-from . import patchlib
-from . import timer
-from . import plotting
+# submodules are imported lazily: plotting loads matplotlib
+import importlib
+
+__all__ = ['iniparse', 'patchlib', 'timer', 'plotting']
+
+
+def __getattr__(name):
+    """ import the submodules on first access (PEP 562) """
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -17,8 +17,6 @@ import numpy as np
 
 # local
 import pynd.ndutils as nd
-from imp import reload
-reload(nd)
 
 
 
@@ -169,14 +167,14 @@ def stack(patches, patch_size, grid_size, patch_stride=1, nargout=1):
             sub = [*grid_sub[pidx, :], 0]
             endsub = np.array(sub) + np.array([*patch_size, K])
             rge = nd.slice(sub, endsub)
-            layer_stack[rge] = patch
+            layer_stack[tuple(rge)] = patch
 
             # update input matching matrix
             if nargout >= 2:
                 # the linear index of the patch in the grid
                 locidx = np.ones([2, *patch_size, K]) * all_idx[pidx]
                 locidx[1, :] = np.matlib.repmat(list(range(np.prod(patch_size))), 1, K)
-                layer_idxmat[rge] = locidx
+                layer_idxmat[tuple(rge)] = locidx
 
         # update layer
         layers[layer_idx, :] = np.reshape(layer_stack.flatten(), [*target_size, K])
@@ -367,7 +365,7 @@ def grid(vol_size, patch_size, patch_stride=1, start_sub=0, nargout=1, grid_type
         # if want index, this is the faster way to compute (rather than sub -> sub2ind
         all_idx = np.array(list(range(0, np.prod(vol_size))))
         all_idx = np.reshape(all_idx, vol_size)
-        idx = all_idx[idx]
+        idx = all_idx[tuple(idx)]
 
     if nargout == 1:
         return idx
@@ -1,6 +1,20 @@
 ''' A collection of general python utilities '''
 
+import os
 import time
+import threading
+import collections
+import functools
+
+import numpy as np
+
+
+# process-wide registry of named timers, off unless enabled (or PYTOOL_TIMERS=1)
+_enabled = os.environ.get('PYTOOL_TIMERS', '0') == '1'
+_registry = {}
+_lock = threading.Lock()
+_local = threading.local()
+
 
 class Timer(object):
     """
@@ -11,21 +25,158 @@ class Timer(object):
     with Timer('foo_stuff'):
     # do some foo
     # do some stuff
-    as an alternative to 
+    as an alternative to
     t = time.time()
     # do stuff
     elapsed = time.time() - t
+
+    When the registry is enabled (see enable()), named timers are also aggregated in it,
+    under their nesting path: a Timer('b') inside a Timer('a') is recorded as 'a/b'.
+    When it is disabled and verbose is False, a Timer does no timing at all.
     """
 
     def __init__(self, name=None, verbose=True):
         self.name = name
         self.verbose = verbose
+        self.elapsed = None
 
     def __enter__(self):
-        self.tstart = time.time()
+        self.record = _enabled and self.name is not None
+        if self.record:
+            stack = _stack()
+            stack.append(self.name)
+            self.path = '/'.join(stack)
+        if self.record or self.verbose:
+            self.tstart = time.perf_counter()
+        return self
 
     def __exit__(self, type, value, traceback):
+        if not (self.record or self.verbose):
+            return
+        self.elapsed = time.perf_counter() - self.tstart
+
+        if self.record:
+            _stack().pop()
+            add(self.path, self.elapsed)
+
         if self.verbose:
             if self.name:
                 print('[%s]' % self.name, end="")
-            print('Elapsed: %6.4s' % (time.time() - self.tstart))
+            print('Elapsed: %6.4f' % self.elapsed)
+
+
+class TimerStats(object):
+    """
+    aggregate of the durations of a named timer: count, total, max, and the last
+    max_samples durations for percentiles
+    """
+
+    def __init__(self, max_samples=10000):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.samples = collections.deque(maxlen=max_samples)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.samples.append(elapsed)
+
+    def summary(self):
+        p50, p95 = np.percentile(self.samples, [50, 95]) if self.count > 0 else (0, 0)
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / max(self.count, 1),
+                'p50': p50,
+                'p95': p95,
+                'max': self.max}
+
+
+def enable(on=True):
+    """ enable (or disable) the aggregation of named timers """
+    global _enabled
+    _enabled = on
+
+
+def disable():
+    enable(False)
+
+
+def is_enabled():
+    return _enabled
+
+
+def add(name, elapsed):
+    """ add a duration (in seconds) to the named timer of the registry """
+    with _lock:
+        if name not in _registry:
+            _registry[name] = TimerStats()
+        _registry[name].add(elapsed)
+
+
+def reset():
+    """ clear the registry """
+    with _lock:
+        _registry.clear()
+
+
+def stats():
+    """ dict of name: summary dict (count, total, mean, p50, p95, max, in seconds) """
+    with _lock:
+        return {name: s.summary() for name, s in _registry.items()}
+
+
+def timed(name=None, verbose=False):
+    """ decorator timing each call of a function, by default under the function's name """
+    def decorator(func):
+        timer_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Timer(timer_name, verbose):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report(sort='path', file=None):
+    """
+    table of the registry's timers, nested timers indented under their parent
+
+    Parameters:
+        sort: 'path' (the nesting tree) or a stat to sort by, in decreasing order (e.g. 'total')
+        file: optional file to also write the report to
+
+    Returns:
+        the report string
+    """
+    summ = stats()
+    if sort == 'path':
+        names = sorted(summ.keys())
+    else:
+        names = sorted(summ.keys(), key=lambda n: -summ[n][sort])
+
+    width = max([len(n) for n in names] + [4])
+    lines = ['%-*s %8s %10s %10s %10s %10s %10s' % (width, 'name', 'count', 'total', 'mean', 'p50', 'p95', 'max')]
+    for name in names:
+        s = summ[name]
+        label = name
+        if sort == 'path':
+            depth = name.count('/')
+            label = '  ' * depth + name.split('/')[-1]
+        lines.append('%-*s %8d %10.4f %10.4f %10.4f %10.4f %10.4f' %
+                     (width, label, s['count'], s['total'], s['mean'], s['p50'], s['p95'], s['max']))
+    txt = '\n'.join(lines)
+
+    if file is not None:
+        with open(file, 'w') as f:
+            f.write(txt + '\n')
+    return txt
+
+
+def _stack():
+    """ this thread's stack of open named timers """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
@@ -0,0 +1,222 @@
+"""
+FLOPs, CPU latency and Dice of the efficient unet_core variants
+
+each variant of the cvpr2018 network (see VARIANTS: depthwise-separable or factorized
+convolutions, channel-reduced skip connections, a half resolution flow head, and combinations)
+is planned (parameters and FLOPs, see planner.py), trained for a fixed number of steps with a
+fixed seed on synthetic pairs (see benchtools.synthetic_pairs), and then timed and evaluated on
+held-out synthetic pairs. The synthetic segmentations are intensity classes of the atlas, warped
+with the known fields, so the Dice is that of the learned registrations. E.g.:
+    python bench_arch.py --model vm2 --vol_size 64 --nb_steps 300 --out arch_vm2.jsonl
+
+The Dice only compares the variants after the same short training on easy synthetic data, not
+their accuracy on brain MRI after full training.
+"""
+
+# python imports
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+import tensorflow as tf
+import keras
+from keras.backend.tensorflow_backend import set_session
+from keras.optimizers import Adam
+
+# project imports
+import benchtools
+import datagenerators
+import networks
+import losses
+import npinfer
+import planner
+from bench_train import pool_gen
+sys.path.append('../ext/medipy-lib')
+from medipy.metrics import dice
+
+
+# cvpr2018_net keyword arguments of each variant
+VARIANTS = {'dense': {},
+            'separable': {'conv_type': 'separable'},
+            'factorized': {'conv_type': 'factorized'},
+            'skip8': {'skip_nf': 8},
+            'half': {'full_size': False},
+            'separable_skip8_half': {'conv_type': 'separable', 'skip_nf': 8, 'full_size': False},
+            'factorized_skip8_half': {'conv_type': 'factorized', 'skip_nf': 8, 'full_size': False}}
+
+FILTERS = {'vm1': ([16, 32, 32, 32], [32, 32, 32, 32, 8, 8]),
+           'vm2': ([16, 32, 32, 32], [32, 32, 32, 32, 32, 16, 16]),
+           'vm2double': ([32, 64, 64, 64], [64, 64, 64, 64, 64, 32, 32])}
+
+
+def synthetic_segs(atlas, fields, nb_labels=4):
+    """
+    synthetic segmentations: the atlas intensity quantile classes (labels 1 to nb_labels), and
+    their warps by the fields (as the moving images are warped from the atlas)
+
+    Returns:
+        atlas segmentation [*vol_size], moving segmentations [nb_pairs, *vol_size, 1]
+    """
+    quantiles = np.percentile(atlas, np.linspace(0, 100, nb_labels + 1)[1:-1])
+    atlas_seg = (np.digitize(atlas[0, ..., 0], quantiles) + 1).astype('int32')
+    moving_segs = np.stack([npinfer.transform(atlas_seg, field, interp_method='nearest') for field in fields])
+    return atlas_seg, moving_segs
+
+
+def bench_variant(variant, model, atlas, moving, fields, nb_train, nb_steps=300, batch_size=1,
+                  lr=1e-4, reg_param=0.01, nb_repeats=10, nb_threads=None, seed=0):
+    """
+    plan, train and evaluate one variant, in a session of its own
+
+    Returns:
+        result record
+    """
+    vol_size = atlas.shape[1:-1]
+    nf_enc, nf_dec = FILTERS[model]
+
+    keras.backend.clear_session()
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    config = tf.ConfigProto()
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    set_session(tf.Session(config=config))
+
+    net = networks.cvpr2018_net(vol_size, nf_enc, nf_dec, **VARIANTS[variant])
+    _, summary = planner.plan(net)
+
+    # train on the first nb_train pairs
+    net.compile(optimizer=Adam(lr=lr), loss=['mse', losses.Grad('l2').loss], loss_weights=[1.0, reg_param])
+    atlas_vol_bs = np.repeat(atlas, batch_size, axis=0)
+    train_gen = datagenerators.cvpr2018_gen(pool_gen(moving[:nb_train], batch_size=batch_size, seed=seed),
+                                            atlas_vol_bs, batch_size=batch_size)
+    tstart = time.perf_counter()
+    net.fit_generator(train_gen, epochs=1, steps_per_epoch=nb_steps, verbose=0)
+    train_time = time.perf_counter() - tstart
+
+    # latency and Dice on the held-out pairs
+    flow_net = keras.models.Model(net.inputs, net.outputs[1])
+    test = moving[nb_train:]
+    stats = benchtools.measure(lambda: flow_net.predict([test[:1], atlas]), nb_repeats=nb_repeats)
+    atlas_seg, moving_segs = synthetic_segs(atlas, fields[nb_train:])
+    labels = np.unique(atlas_seg)
+    dice_vals = []
+    for i in range(test.shape[0]):
+        flow = flow_net.predict([test[i:i + 1], atlas])[0]
+        warp_seg = npinfer.transform(moving_segs[i], flow, interp_method='nearest')[..., 0]
+        dice_vals.append(np.mean(dice(warp_seg, atlas_seg, labels=labels)))
+    dice_before = np.mean([np.mean(dice(s[..., 0], atlas_seg, labels=labels)) for s in moving_segs])
+
+    record = {'name': 'arch_%s_%s_%s' % (model, variant, 'x'.join(str(s) for s in vol_size)),
+              'model': model,
+              'variant': variant,
+              'vol_shape': list(vol_size),
+              'nb_params': summary['nb_params'],
+              'flops_per_example': summary['flops_per_example'],
+              'infer_bytes_per_example': summary['infer_bytes_per_example'],
+              'train_step_sec': train_time / nb_steps,
+              'nb_steps': nb_steps,
+              'dice': float(np.mean(dice_vals)),
+              'dice_before': float(dice_before)}
+    record.update(stats)
+    return record
+
+
+def bench_arch(model='vm2',
+               variants=None,
+               vol_size=(64, 64, 64),
+               nb_steps=300,
+               batch_size=1,
+               nb_pairs=16,
+               nb_test=4,
+               lr=1e-4,
+               reg_param=0.01,
+               nb_repeats=10,
+               nb_threads=None,
+               seed=0,
+               out=None):
+    """
+    benchmark the variants of a cvpr2018 model
+
+    :param model: base filters, vm1, vm2 or vm2double
+    :param variants: names of VARIANTS to run, by default all
+    :param vol_size: volume size
+    :param nb_steps: number of training steps per variant
+    :param batch_size: batch size
+    :param nb_pairs: number of synthetic training pairs
+    :param nb_test: number of synthetic held-out pairs, for the Dice
+    :param lr: learning rate
+    :param reg_param: smoothness loss weight
+    :param nb_repeats: timed predictions per variant
+    :param nb_threads: optional number of tensorflow threads
+    :param seed: seed of the synthetic data, the weights and the batch order
+    :param out: optional results file (json lines, see benchtools.py)
+    """
+    variants = list(VARIANTS.keys()) if variants is None else variants
+    vol_size = tuple(vol_size)
+    atlas, moving, fields = benchtools.synthetic_pairs(vol_size, nb_pairs=nb_pairs + nb_test, seed=seed)
+
+    writer = benchtools.ResultsWriter(out, verbose=False)
+    print('%-24s %10s %10s %12s %12s %12s %8s' %
+          ('variant', 'params', 'GFLOPs', 'latency ms', 'act MB', 'step ms', 'dice'))
+    for variant in variants:
+        record = bench_variant(variant, model, atlas, moving, fields, nb_pairs, nb_steps=nb_steps,
+                               batch_size=batch_size, lr=lr, reg_param=reg_param, nb_repeats=nb_repeats,
+                               nb_threads=nb_threads, seed=seed)
+        writer.write(record)
+        print('%-24s %10d %10.2f %12.1f %12.1f %12.1f %8.4f' %
+              (variant, record['nb_params'], record['flops_per_example'] / 1e9, 1000 * record['time_median'],
+               record['infer_bytes_per_example'] / 2**20, 1000 * record['train_step_sec'], record['dice']))
+    writer.close()
+    print('dice before registration: %.4f' % writer.records[0]['dice_before'])
+    return writer.records
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, dest="model",
+                        choices=list(FILTERS.keys()), default='vm2',
+                        help="base filters")
+    parser.add_argument("--variants", type=str, nargs='+',
+                        dest="variants", default=None, choices=list(VARIANTS.keys()),
+                        help="variants to run (default: all)")
+    parser.add_argument("--vol_size", type=benchtools.parse_size,
+                        dest="vol_size", default=(64, 64, 64),
+                        help="volume size, e.g. 64 or 160x192x224")
+    parser.add_argument("--nb_steps", type=int,
+                        dest="nb_steps", default=300,
+                        help="number of training steps per variant")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=1,
+                        help="batch size")
+    parser.add_argument("--nb_pairs", type=int,
+                        dest="nb_pairs", default=16,
+                        help="number of synthetic training pairs")
+    parser.add_argument("--nb_test", type=int,
+                        dest="nb_test", default=4,
+                        help="number of synthetic held-out pairs")
+    parser.add_argument("--lr", type=float,
+                        dest="lr", default=1e-4, help="learning rate")
+    parser.add_argument("--lambda", type=float,
+                        dest="reg_param", default=0.01,
+                        help="regularization parameter")
+    parser.add_argument("--nb_repeats", type=int,
+                        dest="nb_repeats", default=10,
+                        help="timed predictions per variant")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of tensorflow CPU threads")
+    parser.add_argument("--seed", type=int,
+                        dest="seed", default=0,
+                        help="random seed")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines)")
+
+    args = parser.parse_args()
+    bench_arch(**vars(args))
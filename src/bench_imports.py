@@ -0,0 +1,114 @@
+"""
+import time of the VoxelMorph modules, and the heavy dependencies each one loads
+
+every module is imported in fresh processes (cold), and its import time and the heavy
+modules (tensorflow, keras, matplotlib, nibabel, PIL, tqdm) it pulls in are recorded. With
+--check, the run fails if a module loads a dependency it should not (see FORBIDDEN), so
+e.g. Dice evaluation and data conversion, and the CPU-only NumPy inference and int8
+evaluation tools (npinfer.py, quantize.py) stay free of tensorflow. E.g.:
+    python bench_imports.py --check --out imports.jsonl
+"""
+
+# python imports
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+
+# project imports
+import benchtools
+
+
+HEAVY = ['tensorflow', 'keras', 'matplotlib', 'nibabel', 'PIL', 'tqdm', 'scipy.spatial']
+
+# module: heavy dependencies it must not load
+NO_TF = ['tensorflow', 'keras', 'matplotlib', 'nibabel', 'PIL', 'tqdm']
+FORBIDDEN = {'medipy.metrics': NO_TF,
+             'datagenerators': NO_TF,
+             'npinfer': NO_TF,
+             'quantize': NO_TF,
+             'benchtools': NO_TF,
+             'planner': NO_TF,
+             'parallel': NO_TF,
+             'pynd.ndutils': NO_TF + ['scipy.spatial'],
+             'pytool.patchlib': NO_TF,
+             'pytool.timer': NO_TF,
+             'neuron.dataproc': NO_TF,
+             'losses': ['matplotlib', 'nibabel', 'PIL', 'tqdm'],
+             'neuron.utils': ['matplotlib', 'nibabel', 'PIL', 'tqdm'],
+             'neuron.layers': ['matplotlib', 'nibabel', 'PIL', 'tqdm'],
+             'networks': ['matplotlib', 'nibabel', 'PIL', 'tqdm'],
+             'neuron.callbacks': ['matplotlib', 'nibabel', 'PIL', 'tqdm']}
+
+_CHILD = '''
+import sys, time, json
+sys.path += ['../ext/neuron', '../ext/pytool-lib', '../ext/pynd-lib', '../ext/medipy-lib']
+tstart = time.perf_counter()
+try:
+    import %s
+    error = None
+except Exception as e:
+    error = '%%s: %%s' %% (e.__class__.__name__, e)
+elapsed = time.perf_counter() - tstart
+print(json.dumps({'time': elapsed, 'error': error, 'loaded': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def import_once(module):
+    """ import module in a fresh python process. Returns dict of time, error and loaded heavy modules """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, '-c', _CHILD % (module, HEAVY)],
+                                     cwd=src_dir, stderr=subprocess.DEVNULL).decode()
+    return json.loads(output.strip().split('\n')[-1])
+
+
+def bench_imports(modules=None, nb_runs=5, out=None, check=False):
+    """
+    time the cold import of modules, and check the heavy modules they load
+
+    :param modules: modules to import, by default those of FORBIDDEN
+    :param nb_runs: number of processes per module
+    :param out: optional results file (json lines)
+    :param check: return the violations of FORBIDDEN (modules importing a forbidden dependency)
+    """
+    modules = list(FORBIDDEN.keys()) if modules is None else modules
+    writer = benchtools.ResultsWriter(out, verbose=False)
+    violations = []
+    print('%-20s %10s  %s' % ('module', 'ms', 'heavy modules loaded'))
+    for module in modules:
+        runs = [import_once(module) for _ in range(nb_runs)]
+        record = {'name': 'import_%s' % module, 'module': module,
+                  'loaded': runs[0]['loaded'], 'error': runs[0]['error']}
+        record.update(benchtools.time_stats([r['time'] for r in runs]))
+        writer.write(record)
+
+        bad = [m for m in record['loaded'] if m in FORBIDDEN.get(module, [])]
+        if len(bad) > 0:
+            violations.append((module, bad))
+        msg = record['error'] if record['error'] is not None else ', '.join(record['loaded'])
+        print('%-20s %10.1f  %s%s' % (module, 1000 * record['time_median'], msg,
+                                      '  [forbidden: %s]' % ', '.join(bad) if len(bad) > 0 else ''))
+    writer.close()
+    return violations if check else writer.records
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs='+',
+                        dest="modules", default=None,
+                        help="modules to import (default: all the checked modules)")
+    parser.add_argument("--nb_runs", type=int,
+                        dest="nb_runs", default=5,
+                        help="number of cold imports per module")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines)")
+    parser.add_argument("--check", action="store_true",
+                        dest="check", default=False,
+                        help="exit with an error if a module loads a forbidden dependency")
+
+    args = parser.parse_args()
+    result = bench_imports(**vars(args))
+    if args.check and len(result) > 0:
+        sys.exit('forbidden imports: %s' % '; '.join('%s loads %s' % (m, ', '.join(b)) for m, b in result))
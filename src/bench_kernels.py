@@ -0,0 +1,251 @@
+"""
+micro-benchmarks of the VoxelMorph registration kernels, on the CPU with synthetic data
+
+each kernel runs at several volume sizes, and its time, peak memory and op counts are
+written to a json lines results file (see benchtools.py), e.g.:
+    python bench_kernels.py --sizes 32 64 96 --out kernels_<commit>.jsonl
+    python benchtools.py kernels_old.jsonl kernels_new.jsonl
+"""
+
+# python imports
+import os
+import sys
+import re
+import tempfile
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+import tensorflow as tf
+
+# project imports
+import benchtools
+import losses
+import datagenerators
+sys.path.append('../ext/neuron')
+sys.path.append('../ext/pytool-lib')
+sys.path.append('../ext/pynd-lib')
+sys.path.append('../ext/medipy-lib')
+import neuron.utils as nrn_utils
+import pytool.patchlib as pl
+from medipy.metrics import dice
+
+
+###############################################################################
+# tensorflow kernels: build(vol_shape, rng) -> tensor to fetch
+###############################################################################
+
+def _vol_and_loc(vol_shape, rng, max_shift=3):
+    vol = tf.constant(rng.rand(*vol_shape, 1).astype('float32'))
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in vol_shape], indexing='ij'), -1)
+    loc = grid + max_shift * (2 * rng.rand(*vol_shape, len(vol_shape)) - 1)
+    return vol, tf.constant(loc.astype('float32'))
+
+
+def _shift(vol_shape, rng, max_shift=3, batch=False):
+    shift = max_shift * (2 * rng.rand(*vol_shape, len(vol_shape)) - 1)
+    shift = shift[np.newaxis, ...] if batch else shift
+    return tf.constant(shift.astype('float32'))
+
+
+def build_interpn_linear(vol_shape, rng):
+    vol, loc = _vol_and_loc(vol_shape, rng)
+    return nrn_utils.interpn(vol, loc, interp_method='linear')
+
+
+def build_interpn_nearest(vol_shape, rng):
+    vol, loc = _vol_and_loc(vol_shape, rng)
+    return nrn_utils.interpn(vol, loc, interp_method='nearest')
+
+
+def build_transform(vol_shape, rng):
+    vol = tf.constant(rng.rand(*vol_shape, 1).astype('float32'))
+    return nrn_utils.transform(vol, _shift(vol_shape, rng))
+
+
+def build_integrate_ss(vol_shape, rng):
+    return nrn_utils.integrate_vec(_shift(vol_shape, rng), method='ss', nb_steps=7)
+
+
+def build_integrate_quadrature(vol_shape, rng):
+    return nrn_utils.integrate_vec(_shift(vol_shape, rng), method='quadrature', nb_steps=7)
+
+
+def build_integrate_ode(vol_shape, rng):
+    return nrn_utils.integrate_vec(_shift(vol_shape, rng), method='ode',
+                                   ode_args={'rtol': 1e-3, 'atol': 1e-3})
+
+
+def build_affine_to_shift(vol_shape, rng):
+    ndims = len(vol_shape)
+    affine = np.eye(ndims + 1)[:ndims, :] + 0.05 * rng.randn(ndims, ndims + 1)
+    return nrn_utils.affine_to_shift(tf.constant(affine.astype('float32')), vol_shape)
+
+
+def build_ncc(vol_shape, rng):
+    I = tf.constant(rng.rand(1, *vol_shape, 1).astype('float32'))
+    J = tf.constant(rng.rand(1, *vol_shape, 1).astype('float32'))
+    return losses.NCC().loss(I, J)
+
+
+def build_grad_l2(vol_shape, rng):
+    return losses.Grad('l2').loss(None, _shift(vol_shape, rng, batch=True))
+
+
+def build_kl_loss(vol_shape, rng):
+    ndims = len(vol_shape)
+    y_true = tf.zeros((1, *vol_shape, ndims))
+    y_pred = tf.constant(rng.randn(1, *vol_shape, 2 * ndims).astype('float32'))
+    return losses.Miccai2018(0.02, 10).kl_loss(y_true, y_pred)
+
+
+TF_KERNELS = {'interpn_linear': build_interpn_linear,
+              'interpn_nearest': build_interpn_nearest,
+              'transform': build_transform,
+              'integrate_vec_ss': build_integrate_ss,
+              'integrate_vec_quadrature': build_integrate_quadrature,
+              'integrate_vec_ode': build_integrate_ode,
+              'affine_to_shift': build_affine_to_shift,
+              'ncc_loss': build_ncc,
+              'grad_l2_loss': build_grad_l2,
+              'kl_loss': build_kl_loss}
+
+
+###############################################################################
+# numpy kernels and data loaders: make(vol_shape, rng, tmp_dir) -> fn
+###############################################################################
+
+def make_dice(vol_shape, rng, tmp_dir):
+    labels = np.arange(1, 31)
+    seg1 = rng.randint(0, 31, vol_shape)
+    seg2 = seg1.copy()
+    seg2[rng.rand(*vol_shape) < 0.2] = 0
+    return lambda: dice(seg1, seg2, labels=labels)
+
+
+def make_quilt(vol_shape, rng, tmp_dir):
+    patch_size = [8] * len(vol_shape)
+    patch_stride = 4
+    grid_size = [(s - p) // patch_stride + 1 for s, p in zip(vol_shape, patch_size)]
+    patches = rng.rand(int(np.prod(grid_size)), int(np.prod(patch_size)))
+    return lambda: pl.quilt(patches, patch_size, grid_size, patch_stride=patch_stride)
+
+
+def _npz_files(vol_shape, rng, tmp_dir, nb_files=4):
+    filenames = []
+    for i in range(nb_files):
+        filename = os.path.join(tmp_dir, 'vol_%s_%d.npz' % ('x'.join(str(s) for s in vol_shape), i))
+        if not os.path.isfile(filename):
+            np.savez_compressed(filename, vol_data=rng.rand(*vol_shape).astype('float32'))
+        filenames.append(filename)
+    return filenames
+
+
+def make_load_volfile(vol_shape, rng, tmp_dir):
+    filename = _npz_files(vol_shape, rng, tmp_dir)[0]
+    return lambda: datagenerators.load_volfile(filename)
+
+
+def make_load_volfile_uint8(vol_shape, rng, tmp_dir):
+    filename = _npz_files(vol_shape, rng, tmp_dir)[0]
+    return lambda: datagenerators.load_volfile(filename, packed=True, pack_dtype='uint8')
+
+
+def make_example_gen(vol_shape, rng, tmp_dir):
+    gen = datagenerators.example_gen(_npz_files(vol_shape, rng, tmp_dir), batch_size=2)
+    return lambda: next(gen)
+
+
+NP_KERNELS = {'dice': make_dice,
+              'quilt': make_quilt,
+              'load_volfile': make_load_volfile,
+              'load_volfile_uint8': make_load_volfile_uint8,
+              'example_gen_batch2': make_example_gen}
+
+
+###############################################################################
+# runners
+###############################################################################
+
+def bench_tf_kernel(name, vol_shape, nb_repeats=10, nb_threads=None, seed=0):
+    """ time, peak memory and op counts of a tensorflow kernel, in its own graph and session """
+    rng = np.random.RandomState(seed)
+    graph = tf.Graph()
+    with graph.as_default():
+        fetches = TF_KERNELS[name](vol_shape, rng)
+        init = tf.global_variables_initializer()
+    record = {'name': '%s_%s' % (name, 'x'.join(str(s) for s in vol_shape)),
+              'kernel': name, 'vol_shape': list(vol_shape), 'backend': 'tensorflow'}
+    record.update(benchtools.tf_graph_stats(graph))
+
+    with benchtools.cpu_session(graph, nb_threads) as sess:
+        sess.run(init)
+        record.update(benchtools.measure(lambda: sess.run(fetches), nb_repeats=nb_repeats))
+        record.update(benchtools.tf_run_stats(sess, fetches))
+    return record
+
+
+def bench_np_kernel(name, vol_shape, tmp_dir, nb_repeats=10, seed=0):
+    """ time and peak python memory of a numpy kernel or data loader """
+    rng = np.random.RandomState(seed)
+    fn = NP_KERNELS[name](vol_shape, rng, tmp_dir)
+    record = {'name': '%s_%s' % (name, 'x'.join(str(s) for s in vol_shape)),
+              'kernel': name, 'vol_shape': list(vol_shape), 'backend': 'numpy'}
+    record.update(benchtools.measure(fn, nb_repeats=nb_repeats))
+    record['peak_bytes'] = benchtools.python_peak_memory(fn)
+    return record
+
+
+def bench_kernels(sizes, out=None, kernels=None, nb_repeats=10, nb_threads=None, tmp_dir=None):
+    """
+    run the kernel benchmarks
+    :param sizes: list of volume shapes
+    :param out: results file (json lines)
+    :param kernels: optional regular expression selecting the kernels to run
+    :param nb_repeats: number of timed repeats per case
+    :param nb_threads: optional number of tensorflow CPU threads
+    :param tmp_dir: directory for the synthetic data files (default: a temporary directory)
+    """
+    names = list(TF_KERNELS.keys()) + list(NP_KERNELS.keys())
+    if kernels is not None:
+        names = [n for n in names if re.search(kernels, n)]
+
+    writer = benchtools.ResultsWriter(out)
+    with tempfile.TemporaryDirectory() as default_tmp_dir:
+        tmp_dir = default_tmp_dir if tmp_dir is None else tmp_dir
+        for vol_shape in sizes:
+            for name in names:
+                if name in TF_KERNELS:
+                    record = bench_tf_kernel(name, vol_shape, nb_repeats=nb_repeats, nb_threads=nb_threads)
+                else:
+                    record = bench_np_kernel(name, vol_shape, tmp_dir, nb_repeats=nb_repeats)
+                writer.write(record)
+    writer.close()
+    return writer.records
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=str, nargs='+',
+                        dest="sizes", default=['32', '64', '96'],
+                        help="volume sizes, e.g. 64 or 160x192x224")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines)")
+    parser.add_argument("--kernels", type=str,
+                        dest="kernels", default=None,
+                        help="regular expression selecting the kernels")
+    parser.add_argument("--nb_repeats", type=int,
+                        dest="nb_repeats", default=10,
+                        help="number of timed repeats")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of tensorflow CPU threads")
+    parser.add_argument("--tmp_dir", type=str,
+                        dest="tmp_dir", default=None,
+                        help="directory for the synthetic data files")
+
+    args = parser.parse_args()
+    args.sizes = [benchtools.parse_size(s) for s in args.sizes]
+    bench_kernels(**vars(args))
@@ -0,0 +1,216 @@
+"""
+end-to-end latency of registering one subject, phase by phase, with cold and warm starts
+
+the test.py (cvpr2018) and test_miccai2018.py flows are run in fresh processes (cold starts),
+each of which times:
+    import, session, build, load_weights, load_data, first_predict, first_warp, first_dice
+and then repeats the prediction, segmentation warp and Dice in the same process (warm):
+    predict, warp, dice
+The distributions over runs (cold phases) and repeats (warm phases) are printed and
+written to a json lines results file (see benchtools.py), e.g.:
+    python bench_latency.py --flows cvpr2018 miccai2018 --nb_runs 5 --out latency.jsonl
+"""
+
+# python imports
+import os
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+
+# project imports
+import benchtools
+
+
+FLOWS = {'cvpr2018': {'model_file': '../models/cvpr2018_vm1_cc.h5',
+                      'nf_enc': [16, 32, 32, 32],
+                      'nf_dec': [32, 32, 32, 32, 8, 8]},
+         'miccai2018': {'model_file': '../models/miccai2018_10_02_init1.h5',
+                        'nf_enc': [16, 32, 32, 32],
+                        'nf_dec': [32, 32, 32, 32, 16, 3]}}
+
+COLD_PHASES = ['import', 'session', 'build', 'load_weights', 'load_data',
+               'first_predict', 'first_warp', 'first_dice']
+WARM_PHASES = ['predict', 'warp', 'dice']
+
+
+def run_once(flow, model_file=None, atlas_file='../data/atlas_norm.npz',
+             vol_file='../data/test_vol.npz', seg_file='../data/test_seg.npz',
+             nb_warm=5, nb_threads=None):
+    """
+    one cold registration of the flow (as in test.py or test_miccai2018.py) and nb_warm
+    warm repeats, in this process. Should be called in a fresh process, before tensorflow
+    is imported, for the import and first call times to be cold.
+
+    Returns:
+        dict of phase: time in seconds (cold phases) or list of times (warm phases)
+    """
+    times = {}
+    model_file = FLOWS[flow]['model_file'] if model_file is None else model_file
+    vol_size = (160, 192, 224)
+
+    tstart = time.perf_counter()
+    import tensorflow as tf
+    import keras
+    import scipy.io as sio
+    from keras.backend.tensorflow_backend import set_session
+    from scipy.interpolate import interpn
+    import networks
+    import datagenerators
+    sys.path.append('../ext/medipy-lib')
+    from medipy.metrics import dice
+    times['import'] = time.perf_counter() - tstart
+
+    tstart = time.perf_counter()
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    set_session(tf.Session(config=config))
+    times['session'] = time.perf_counter() - tstart
+
+    tstart = time.perf_counter()
+    nf_enc, nf_dec = FLOWS[flow]['nf_enc'], FLOWS[flow]['nf_dec']
+    if flow == 'cvpr2018':
+        net = networks.cvpr2018_net(vol_size, nf_enc, nf_dec)
+    else:
+        net = networks.miccai2018_net(vol_size, nf_enc, nf_dec, use_miccai_int=False, indexing='ij')
+        nn_trf_model = networks.nn_trf(vol_size, indexing='ij')
+    times['build'] = time.perf_counter() - tstart
+
+    tstart = time.perf_counter()
+    net.load_weights(model_file)
+    if flow == 'miccai2018':
+        net = keras.models.Model(net.inputs, net.get_layer('diffflow').output)
+    times['load_weights'] = time.perf_counter() - tstart
+
+    tstart = time.perf_counter()
+    labels = sio.loadmat('../data/labels.mat')['labels'][0]
+    X_vol, X_seg = datagenerators.load_example_by_name(vol_file, seg_file)
+    if os.path.isfile(atlas_file):
+        atlas = np.load(atlas_file)
+        atlas_vol = atlas['vol'][np.newaxis, ..., np.newaxis]
+        atlas_seg = atlas['seg']
+    else:
+        # latency does not depend on the image content: register the subject to itself
+        atlas_vol, atlas_seg = X_vol, X_seg[0, ..., 0]
+    times['load_data'] = time.perf_counter() - tstart
+
+    if flow == 'cvpr2018':
+        xx = np.arange(vol_size[1])
+        yy = np.arange(vol_size[0])
+        zz = np.arange(vol_size[2])
+        grid = np.rollaxis(np.array(np.meshgrid(xx, yy, zz)), 0, 4)
+
+    def predict():
+        pred = net.predict([X_vol, atlas_vol])
+        return pred[1] if flow == 'cvpr2018' else pred
+
+    def warp(flow_field):
+        if flow == 'cvpr2018':
+            sample = flow_field[0] + grid
+            sample = np.stack((sample[:, :, :, 1], sample[:, :, :, 0], sample[:, :, :, 2]), 3)
+            return interpn((yy, xx, zz), X_seg[0, :, :, :, 0], sample, method='nearest',
+                           bounds_error=False, fill_value=0)
+        return nn_trf_model.predict([X_seg, flow_field])[0, ..., 0]
+
+    for i in range(nb_warm + 1):
+        prefix = 'first_' if i == 0 else ''
+        tstart = time.perf_counter()
+        flow_field = predict()
+        tpred = time.perf_counter()
+        warp_seg = warp(flow_field)
+        twarp = time.perf_counter()
+        vals = dice(warp_seg, atlas_seg, labels=labels)
+        tdice = time.perf_counter()
+        for phase, t in zip(['predict', 'warp', 'dice'], [tpred - tstart, twarp - tpred, tdice - twarp]):
+            if i == 0:
+                times[prefix + phase] = t
+            else:
+                times.setdefault(phase, []).append(t)
+    times['dice_mean'] = float(np.mean(vals))
+    return times
+
+
+def bench_latency(flows=('cvpr2018', 'miccai2018'), nb_runs=5, nb_warm=5, nb_threads=None,
+                  gpu_id='', atlas_file='../data/atlas_norm.npz', out=None):
+    """
+    run nb_runs fresh processes per flow, and summarize the distributions of the phases
+
+    :param flows: cvpr2018 and/or miccai2018
+    :param nb_runs: number of cold runs (processes) per flow
+    :param nb_warm: number of warm repeats per run
+    :param nb_threads: optional number of tensorflow threads
+    :param gpu_id: CUDA_VISIBLE_DEVICES of the runs, by default the CPU
+    :param atlas_file: atlas (vol and seg), by default the subject itself if the file is missing
+    :param out: optional results file (json lines)
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES=gpu_id)
+    writer = benchtools.ResultsWriter(out)
+    for flow in flows:
+        runs = []
+        for _ in range(nb_runs):
+            cmd = [sys.executable, os.path.abspath(__file__), '--child', flow,
+                   '--nb_warm', str(nb_warm), '--atlas_file', atlas_file]
+            if nb_threads is not None:
+                cmd += ['--nb_threads', str(nb_threads)]
+            tstart = time.perf_counter()
+            output = subprocess.check_output(cmd, cwd=src_dir, env=env).decode()
+            run = json.loads(output.strip().split('\n')[-1])
+            run['process'] = time.perf_counter() - tstart
+            runs.append(run)
+
+        for phase in ['process'] + COLD_PHASES:
+            record = {'name': 'latency_%s_%s' % (flow, phase), 'flow': flow, 'phase': phase, 'start': 'cold'}
+            record.update(benchtools.time_stats([r[phase] for r in runs]))
+            writer.write(record)
+        for phase in WARM_PHASES if nb_warm > 0 else []:
+            record = {'name': 'latency_%s_%s' % (flow, phase), 'flow': flow, 'phase': phase, 'start': 'warm'}
+            record.update(benchtools.time_stats(sum([r[phase] for r in runs], [])))
+            writer.write(record)
+        print('%s: mean dice %.3f' % (flow, np.mean([r['dice_mean'] for r in runs])))
+    writer.close()
+    return writer.records
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--flows", type=str, nargs='+',
+                        dest="flows", default=['cvpr2018', 'miccai2018'],
+                        choices=list(FLOWS.keys()), help="test flows to time")
+    parser.add_argument("--nb_runs", type=int,
+                        dest="nb_runs", default=5,
+                        help="number of cold runs (processes) per flow")
+    parser.add_argument("--nb_warm", type=int,
+                        dest="nb_warm", default=5,
+                        help="number of warm repeats per run")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of tensorflow CPU threads")
+    parser.add_argument("--gpu", type=str, default='',
+                        dest="gpu_id", help="gpu id number (default: CPU)")
+    parser.add_argument("--atlas_file", type=str,
+                        dest="atlas_file", default='../data/atlas_norm.npz',
+                        help="atlas file, with vol and seg")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines)")
+    parser.add_argument("--child", type=str,
+                        dest="child", default=None,
+                        help="internal: run one flow in this process and print its times")
+
+    args = parser.parse_args()
+    if args.child is not None:
+        times = run_once(args.child, atlas_file=args.atlas_file, nb_warm=args.nb_warm,
+                         nb_threads=args.nb_threads)
+        print(json.dumps(times))
+    else:
+        del args.child
+        bench_latency(**vars(args))
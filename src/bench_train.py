@@ -0,0 +1,215 @@
+"""
+end-to-end training throughput of the VoxelMorph models, on synthetic data
+
+the cvpr2018 (vm1, vm2, vm2double) or miccai2018 model is trained for a fixed number of steps,
+with a fixed seed, on moving images made by warping a smooth random atlas with smooth random
+fields (see benchtools.synthetic_pairs), so no MRI data is needed. Reports steps/s, voxels/s,
+the fraction of the step time spent waiting on data and the peak resident memory, e.g.:
+    python bench_train.py --model vm2 --vol_size 160x192x224 --nb_steps 50 --out train_vm2.jsonl
+With --checkpoint, segments of the network are recomputed in backprop: comparing the steps/s and
+peak memory with and without it gives the time / memory trade-off of gradient checkpointing
+(planner.py --checkpoint predicts it).
+"""
+
+# python imports
+import os
+import sys
+import time
+import resource
+import tempfile
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+import tensorflow as tf
+from keras.backend.tensorflow_backend import set_session
+from keras.optimizers import Adam
+
+# project imports
+import benchtools
+import datagenerators
+import networks
+import losses
+sys.path.append('../ext/neuron')
+import neuron.callbacks as nrn_gen
+
+
+def build_model(model, vol_size, reg_param=0.01, image_sigma=0.02, prior_lambda=10, checkpoint=()):
+    """
+    model with the train scripts' architecture and losses, with the checkpoint segments
+    recomputed in backprop
+
+    Returns:
+        (model, losses, loss weights)
+    """
+    if model == 'miccai2018':
+        nf_enc = [16, 32, 32, 32]
+        nf_dec = [32, 32, 32, 32, 16, 3]
+        net = networks.miccai2018_net(vol_size, nf_enc, nf_dec, checkpoint=checkpoint)
+        flow_vol_shape = net.outputs[-1].shape[1:-1]
+        loss_class = losses.Miccai2018(image_sigma, prior_lambda, flow_vol_shape=flow_vol_shape)
+        return net, [loss_class.recon_loss, loss_class.kl_loss], [1, 1]
+
+    nf_enc = [16, 32, 32, 32]
+    if model == 'vm1':
+        nf_dec = [32, 32, 32, 32, 8, 8]
+    elif model == 'vm2':
+        nf_dec = [32, 32, 32, 32, 32, 16, 16]
+    else:  # 'vm2double'
+        nf_enc = [f * 2 for f in nf_enc]
+        nf_dec = [f * 2 for f in [32, 32, 32, 32, 32, 16, 16]]
+    net = networks.cvpr2018_net(vol_size, nf_enc, nf_dec, checkpoint=checkpoint)
+    return net, ['mse', losses.Grad('l2').loss], [1.0, reg_param]
+
+
+def pool_gen(moving, batch_size=1, seed=0):
+    """ example_gen-like generator of random batches of the synthetic moving images """
+    rng = np.random.RandomState(seed)
+    while True:
+        idx = rng.randint(0, moving.shape[0], batch_size)
+        yield (moving[idx],)
+
+
+def bench_train(model='vm2',
+                vol_size=(160, 192, 224),
+                nb_steps=50,
+                nb_warmup=5,
+                batch_size=1,
+                nb_pairs=8,
+                lr=1e-4,
+                seed=0,
+                nb_threads=None,
+                gpu_id='',
+                out=None,
+                profile_file=None,
+                checkpoint=()):
+    """
+    train for nb_warmup (untimed, graph building and first allocations) and then nb_steps steps
+
+    :param model: vm1, vm2, vm2double or miccai2018
+    :param vol_size: volume size
+    :param nb_steps: number of timed steps
+    :param nb_warmup: number of untimed steps
+    :param batch_size: batch size
+    :param nb_pairs: number of synthetic moving images
+    :param seed: seed of the synthetic data, the weights and the batch order
+    :param nb_threads: optional number of tensorflow threads
+    :param gpu_id: CUDA_VISIBLE_DEVICES, by default the CPU
+    :param out: optional results file (json lines, see benchtools.py)
+    :param profile_file: optional per-step profile (see neuron.callbacks.StepProfiler)
+    :param checkpoint: segments recomputed in backprop (gradient checkpointing): head, warp, int
+    """
+    assert model in ['vm1', 'vm2', 'vm2double', 'miccai2018'], 'unknown model %s' % model
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+    vol_size = tuple(vol_size)
+
+    # synthetic data
+    tstart = time.perf_counter()
+    atlas, moving, _ = benchtools.synthetic_pairs(vol_size, nb_pairs=nb_pairs, seed=seed)
+    data_time = time.perf_counter() - tstart
+    atlas_vol_bs = np.repeat(atlas, batch_size, axis=0)
+
+    # session, seeded
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    set_session(tf.Session(config=config))
+
+    net, model_losses, loss_weights = build_model(model, vol_size, checkpoint=checkpoint)
+    net.compile(optimizer=Adam(lr=lr), loss=model_losses, loss_weights=loss_weights)
+
+    example_gen = pool_gen(moving, batch_size=batch_size, seed=seed)
+    if model == 'miccai2018':
+        train_gen = datagenerators.miccai2018_gen(example_gen, atlas_vol_bs, batch_size=batch_size)
+    else:
+        train_gen = datagenerators.cvpr2018_gen(example_gen, atlas_vol_bs, batch_size=batch_size)
+
+    # warmup
+    if nb_warmup > 0:
+        net.fit_generator(train_gen, epochs=1, steps_per_epoch=nb_warmup, verbose=0)
+
+    # timed steps
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = profile_file if profile_file is not None else os.path.join(tmp_dir, 'profile.jsonl')
+        profiler = nrn_gen.StepProfiler(filepath, summary_every=max(nb_steps, 1), verbose=False)
+        train_gen = nrn_gen.profile_generator(train_gen, profiler)
+        tstart = time.perf_counter()
+        net.fit_generator(train_gen, epochs=1, steps_per_epoch=nb_steps, callbacks=[profiler], verbose=0)
+        train_time = time.perf_counter() - tstart
+
+    summ = profiler.summary(profiler.records)
+    voxels = batch_size * int(np.prod(vol_size))
+    name = 'train_%s_%s_bs%d' % (model, 'x'.join(str(s) for s in vol_size), batch_size)
+    record = {'name': name + ''.join('_ckpt_%s' % c for c in checkpoint),
+              'model': model,
+              'checkpoint': list(checkpoint),
+              'vol_shape': list(vol_size),
+              'batch_size': batch_size,
+              'nb_steps': nb_steps,
+              'seed': seed,
+              'nb_params': int(net.count_params()),
+              'time_median': float(np.median([r['wait'] + r['train'] for r in profiler.records])),
+              'steps_per_sec': nb_steps / train_time,
+              'voxels_per_sec': nb_steps * voxels / train_time,
+              'wait_frac': float(summ['wait_frac']),
+              'train_frac': float(summ['train_frac']),
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+              'data_time': data_time}
+
+    writer = benchtools.ResultsWriter(out, verbose=False)
+    writer.write(record)
+    writer.close()
+    print('%s: %.3f steps/s, %.3g voxels/s, data wait %.1f%%, peak rss %.0f MB' %
+          (record['name'], record['steps_per_sec'], record['voxels_per_sec'],
+           100 * record['wait_frac'], record['peak_rss_mb']))
+    return record
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, dest="model",
+                        choices=['vm1', 'vm2', 'vm2double', 'miccai2018'], default='vm2',
+                        help="model to train")
+    parser.add_argument("--vol_size", type=benchtools.parse_size,
+                        dest="vol_size", default=(160, 192, 224),
+                        help="volume size, e.g. 64 or 160x192x224")
+    parser.add_argument("--nb_steps", type=int,
+                        dest="nb_steps", default=50,
+                        help="number of timed steps")
+    parser.add_argument("--nb_warmup", type=int,
+                        dest="nb_warmup", default=5,
+                        help="number of untimed warmup steps")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=1,
+                        help="batch size")
+    parser.add_argument("--nb_pairs", type=int,
+                        dest="nb_pairs", default=8,
+                        help="number of synthetic moving images")
+    parser.add_argument("--lr", type=float,
+                        dest="lr", default=1e-4, help="learning rate")
+    parser.add_argument("--seed", type=int,
+                        dest="seed", default=0,
+                        help="random seed")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of tensorflow CPU threads")
+    parser.add_argument("--gpu", type=str, default='',
+                        dest="gpu_id", help="gpu id number (default: CPU)")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines)")
+    parser.add_argument("--profile_file", type=str,
+                        dest="profile_file", default=None,
+                        help="per-step profile file (.csv or .jsonl)")
+    parser.add_argument("--checkpoint", type=str, nargs='+',
+                        dest="checkpoint", default=[], choices=['head', 'warp', 'int'],
+                        help="segments recomputed in backprop (gradient checkpointing)")
+
+    args = parser.parse_args()
+    bench_train(**vars(args))
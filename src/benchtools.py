@@ -0,0 +1,263 @@
+"""
+shared tools for the VoxelMorph benchmarks (bench_*.py)
+
+results are json lines files: one 'env' record (commit, host, library versions), then one
+record per benchmark case, so that files from different commits or machines can be compared
+with compare_results, or from the command line:
+    python benchtools.py old_results.jsonl new_results.jsonl
+"""
+
+# python imports
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tracemalloc
+import subprocess
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+
+
+def measure(fn, nb_warmup=2, nb_repeats=10, min_time=0):
+    """
+    time repeated calls of fn() with perf_counter, after nb_warmup untimed calls.
+    Repeats at least nb_repeats times, and until min_time seconds have been measured.
+
+    Returns:
+        dict of times in seconds (see time_stats)
+    """
+    for _ in range(nb_warmup):
+        fn()
+
+    times = []
+    while len(times) < nb_repeats or sum(times) < min_time:
+        tstart = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tstart)
+    return time_stats(times)
+
+
+def time_stats(times):
+    """ dict of statistics of a list of times: median, mean, min, p90, max, and nb_repeats """
+    return {'time_median': float(np.median(times)),
+            'time_mean': float(np.mean(times)),
+            'time_min': float(np.min(times)),
+            'time_p90': float(np.percentile(times, 90)),
+            'time_max': float(np.max(times)),
+            'nb_repeats': len(times)}
+
+
+def python_peak_memory(fn):
+    """ peak memory in bytes of the python (and numpy) allocations of one call of fn() """
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def tf_run_stats(sess, fetches, feed_dict=None):
+    """
+    run fetches once with a full trace, and return the peak memory (bytes, the max over
+    allocators) and the number of executed ops
+    """
+    import tensorflow as tf
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+    peak_bytes = 0
+    nb_ops = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        nb_ops += len(dev_stats.node_stats)
+        for node in dev_stats.node_stats:
+            for mem in node.memory:
+                peak_bytes = max(peak_bytes, mem.peak_bytes)
+    return {'peak_bytes': int(peak_bytes), 'nb_ops_run': nb_ops}
+
+
+def tf_graph_stats(graph):
+    """ number of ops in a graph, and its float operations when the shapes are static """
+    import tensorflow as tf
+    stats = {'nb_ops_graph': len(graph.get_operations()), 'flops': None}
+    try:
+        opts = tf.profiler.ProfileOptionBuilder.float_operation()
+        opts['output'] = 'none'
+        stats['flops'] = int(tf.profiler.profile(graph, options=opts).total_float_ops)
+    except Exception:
+        pass
+    return stats
+
+
+def cpu_session(graph, nb_threads=None):
+    """ tensorflow session on the CPU only """
+    import tensorflow as tf
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    return tf.Session(graph=graph, config=config)
+
+
+def synthetic_pairs(vol_size, nb_pairs=4, seed=0, max_disp=4, smooth_factor=16):
+    """
+    synthetic registration pairs: a smooth random atlas image, and moving images that are
+    the atlas warped by smooth random displacement fields (with neuron's SpatialTransformer,
+    in a graph of its own)
+
+    Parameters:
+        vol_size: volume size
+        nb_pairs: number of moving images
+        seed: random seed
+        max_disp: maximum displacement, in voxels
+        smooth_factor: the random fields and image blobs vary over about vol_size / smooth_factor
+
+    Returns:
+        atlas [1, *vol_size, 1], moving images [nb_pairs, *vol_size, 1] and
+        fields [nb_pairs, *vol_size, ndims], all float32
+    """
+    import scipy.ndimage
+    import tensorflow as tf
+    import keras
+    sys.path.append('../ext/neuron')
+    import neuron.layers as nrn_layers
+
+    rng = np.random.RandomState(seed)
+    ndims = len(vol_size)
+    coarse = [int(np.ceil(s / smooth_factor)) + 1 for s in vol_size]
+
+    # smooth blobs
+    atlas = scipy.ndimage.gaussian_filter(rng.rand(*vol_size), [s / smooth_factor for s in vol_size])
+    atlas = (atlas - atlas.min()) / (atlas.max() - atlas.min())
+
+    # smooth fields, upsampled from a coarse grid
+    fields = np.zeros((nb_pairs, *vol_size, ndims), 'float32')
+    for i in range(nb_pairs):
+        for d in range(ndims):
+            coarse_field = rng.randn(*coarse)
+            zoom = [s / c for s, c in zip(vol_size, coarse)]
+            fields[i, ..., d] = scipy.ndimage.zoom(coarse_field, zoom, order=3)[tuple(slice(0, s) for s in vol_size)]
+    fields *= max_disp / max(np.max(np.abs(fields)), 1e-6)
+
+    atlas = atlas[np.newaxis, ..., np.newaxis].astype('float32')
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        keras.backend.set_session(sess)
+        vol_in = keras.layers.Input((*vol_size, 1))
+        flow_in = keras.layers.Input((*vol_size, ndims))
+        warped = nrn_layers.SpatialTransformer(interp_method='linear', indexing='ij')([vol_in, flow_in])
+        warp_model = keras.models.Model([vol_in, flow_in], warped)
+        moving = np.concatenate([warp_model.predict([atlas, fields[i:i + 1]]) for i in range(nb_pairs)], 0)
+    keras.backend.clear_session()
+
+    return atlas, moving.astype('float32'), fields
+
+
+def parse_size(size):
+    """ '64' -> (64, 64, 64), '160x192x224' -> (160, 192, 224) """
+    dims = [int(s) for s in size.split('x')]
+    return tuple(dims * 3) if len(dims) == 1 else tuple(dims)
+
+
+def env_info():
+    """ commit, host and library versions of this run """
+    info = {'type': 'env',
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__}
+    try:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=src_dir,
+                                                 stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    for lib in ['tensorflow', 'keras']:
+        if lib in sys.modules:
+            info[lib] = sys.modules[lib].__version__
+    return info
+
+
+class ResultsWriter():
+    """ json lines results file, starting with the env_info record """
+
+    def __init__(self, filename, verbose=True):
+        self.filename = filename
+        self.verbose = verbose
+        self.records = []
+        self._file = open(filename, 'w') if filename is not None else None
+        self._env_written = False
+
+    def write(self, record):
+        if self._file is not None:
+            if not self._env_written:
+                self._file.write(json.dumps(env_info()) + '\n')
+                self._env_written = True
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+        self.records.append(record)
+        if self.verbose:
+            print(format_record(record))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def format_record(record):
+    """ one line summary of a result record """
+    mem = record.get('peak_bytes')
+    mem = '%9.1f MB' % (mem / 2**20) if mem is not None else '%12s' % '-'
+    ops = record.get('nb_ops_run', record.get('nb_ops_graph'))
+    ops = '%6d ops' % ops if ops is not None else '%10s' % '-'
+    return '%-40s %10.3f ms %s %s' % (record['name'], 1000 * record['time_median'], mem, ops)
+
+
+def load_results(filename):
+    """ (env record, list of result records) of a results file """
+    env, records = None, []
+    with open(filename, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('type') == 'env':
+                env = record
+            else:
+                records.append(record)
+    return env, records
+
+
+def compare_results(old_file, new_file, key='time_median'):
+    """ print the ratio new / old of key for the cases (names) in both files """
+    old_env, old = load_results(old_file)
+    new_env, new = load_results(new_file)
+    old = {r['name']: r for r in old}
+    print('old: %s (%s)\nnew: %s (%s)' % (old_env.get('commit'), old_env.get('host'),
+                                          new_env.get('commit'), new_env.get('host')))
+    print('%-40s %12s %12s %8s' % ('name', 'old', 'new', 'new/old'))
+    ratios = []
+    for r in new:
+        if r['name'] in old and old[r['name']].get(key):
+            ratio = r[key] / old[r['name']][key]
+            ratios.append(ratio)
+            print('%-40s %12.4g %12.4g %8.3f' % (r['name'], old[r['name']][key], r[key], ratio))
+    if len(ratios) > 0:
+        print('geometric mean of new/old: %.3f' % np.exp(np.mean(np.log(ratios))))
+    return ratios
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("old_file", type=str, help="baseline results file")
+    parser.add_argument("new_file", type=str, help="new results file")
+    parser.add_argument("--key", type=str, dest="key", default='time_median',
+                        help="result to compare")
+    args = parser.parse_args()
+    compare_results(args.old_file, args.new_file, key=args.key)
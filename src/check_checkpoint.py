@@ -0,0 +1,112 @@
+"""
+check that gradient checkpointing does not change the gradients
+
+a cvpr2018 model is built with and without the --checkpoint segments (recomputed in backprop,
+see neuron.layers.Recompute and neuron.utils.recompute_grad), with the same weights, and the
+gradients of the training loss on a small synthetic batch (see benchtools.synthetic_pairs) are
+compared, e.g.:
+    python check_checkpoint.py --model vm2 --vol_size 32 --checkpoint head warp
+They should agree up to float32 rounding.
+"""
+
+# python imports
+import os
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+import tensorflow as tf
+import keras.backend as K
+from keras.optimizers import Adam
+
+# project imports
+import benchtools
+from bench_train import build_model
+
+
+def loss_gradients(net, model_losses, loss_weights, moving, atlas):
+    """
+    loss and gradients of the trainable weights of a model, on one batch
+
+    Returns:
+        (loss, list of gradient arrays)
+    """
+    net.compile(optimizer=Adam(), loss=model_losses, loss_weights=loss_weights)
+    zeros = np.zeros([moving.shape[0], *net.outputs[-1].shape.as_list()[1:]])
+    x, y, sample_weights = net._standardize_user_data([moving, atlas], [atlas, zeros])
+
+    # the same inputs as the keras train function, in the training phase
+    grads = K.gradients(net.total_loss, net._collected_trainable_weights)
+    fn = K.function(net._feed_inputs + net._feed_targets + net._feed_sample_weights + [K.learning_phase()],
+                    [net.total_loss] + grads)
+    outs = fn(x + y + sample_weights + [1])
+    return outs[0], outs[1:]
+
+
+def check_checkpoint(model='vm2',
+                     vol_size=(32, 32, 32),
+                     checkpoint=('head', 'warp'),
+                     batch_size=1,
+                     seed=0):
+    """
+    compare the gradients of a model with and without gradient checkpointing
+
+    :param model: vm1, vm2 or vm2double
+    :param vol_size: volume size
+    :param checkpoint: segments recomputed in backprop: head, warp
+    :param batch_size: batch size
+    :param seed: seed of the synthetic data and the weights
+
+    Returns:
+        max absolute and max relative gradient differences
+    """
+    vol_size = tuple(vol_size)
+    atlas, moving, _ = benchtools.synthetic_pairs(vol_size, nb_pairs=batch_size, seed=seed)
+    atlas_bs = np.repeat(atlas, batch_size, axis=0)
+
+    np.random.seed(seed)
+    tf.set_random_seed(seed)
+    net, model_losses, loss_weights = build_model(model, vol_size)
+    loss, grads = loss_gradients(net, model_losses, loss_weights, moving, atlas_bs)
+
+    # same weights, in the same (topological) order
+    ckpt_net, model_losses, loss_weights = build_model(model, vol_size, checkpoint=checkpoint)
+    ckpt_net.set_weights(net.get_weights())
+    ckpt_loss, ckpt_grads = loss_gradients(ckpt_net, model_losses, loss_weights, moving, atlas_bs)
+
+    assert len(grads) == len(ckpt_grads), "%d gradients without checkpointing, %d with" % \
+        (len(grads), len(ckpt_grads))
+    max_abs = 0
+    max_rel = 0
+    for grad, ckpt_grad in zip(grads, ckpt_grads):
+        assert grad.shape == ckpt_grad.shape, "gradient shapes %s and %s" % (grad.shape, ckpt_grad.shape)
+        diff = np.max(np.abs(grad - ckpt_grad))
+        max_abs = max(max_abs, diff)
+        max_rel = max(max_rel, diff / max(np.max(np.abs(grad)), 1e-12))
+
+    print('loss %.6g without, %.6g with checkpointing of %s' % (loss, ckpt_loss, ', '.join(checkpoint)))
+    print('%d gradients: max abs diff %.3g, max rel diff %.3g' % (len(grads), max_abs, max_rel))
+    return max_abs, max_rel
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, dest="model",
+                        choices=['vm1', 'vm2', 'vm2double'], default='vm2',
+                        help="voxelmorph 1 or 2")
+    parser.add_argument("--vol_size", type=benchtools.parse_size,
+                        dest="vol_size", default=(32, 32, 32),
+                        help="volume size, e.g. 32 or 32x40x48")
+    parser.add_argument("--checkpoint", type=str, nargs='+',
+                        dest="checkpoint", default=['head', 'warp'], choices=['head', 'warp'],
+                        help="network segments recomputed in backprop")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=1,
+                        help="batch size")
+    parser.add_argument("--seed", type=int,
+                        dest="seed", default=0,
+                        help="random seed")
+
+    args = parser.parse_args()
+    check_checkpoint(**vars(args))
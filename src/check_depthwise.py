@@ -0,0 +1,155 @@
+"""
+check the depth-slice decomposition of neuron.layers.DepthwiseConv3D
+
+DepthwiseConv3D computes a 3D depthwise convolution ('same' padding, as tensorflow) as the sum,
+over the kernel depth offsets, of depthwise 2D convolutions of the strided depth slices.
+That decomposition is re-implemented here in NumPy and compared to a direct 3D depthwise
+convolution, for odd and even sizes and strides 1 and 2. With --layer, the keras layer
+itself (needs tensorflow) is also compared to the direct convolution. E.g.:
+    python check_depthwise.py --vol_size 8x10x6 7x9x5 --strides 1 2 --layer
+"""
+
+# python imports
+import sys
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+
+# project imports
+import benchtools
+sys.path.append('../ext/neuron')
+
+
+def same_pad(size, kernel, stride):
+    """ (before, after) 'same' padding of an axis, as tensorflow pads strided convolutions """
+    out = -(-size // stride)
+    pad = max((out - 1) * stride + kernel - size, 0)
+    return pad // 2, pad - pad // 2
+
+
+def depthwise_conv2d(x, kernel, strides):
+    """ [batch, h, w, feats] * [kh, kw, feats] depthwise convolution, 'same' padding """
+    out_shape = [-(-s // st) for s, st in zip(x.shape[1:3], strides)]
+    pads = [same_pad(s, k, st) for s, k, st in zip(x.shape[1:3], kernel.shape[:2], strides)]
+    x = np.pad(x, [(0, 0), *pads, (0, 0)], 'constant')
+    out = np.zeros((x.shape[0], *out_shape, x.shape[-1]))
+    for i in range(kernel.shape[0]):
+        for j in range(kernel.shape[1]):
+            x_ij = x[:, i:i + strides[0] * (out_shape[0] - 1) + 1:strides[0],
+                     j:j + strides[1] * (out_shape[1] - 1) + 1:strides[1]]
+            out += x_ij * kernel[i, j]
+    return out
+
+
+def depthwise_conv3d_slices(x, kernel, strides):
+    """ DepthwiseConv3D.call in NumPy: [batch, *vol_shape, feats] * [kd, kh, kw, feats] """
+    vol_shape = x.shape[1:-1]
+    nb_feats = x.shape[-1]
+    out_depth = -(-vol_shape[0] // strides[0])
+    kd, sd = kernel.shape[0], strides[0]
+    x = np.pad(x, [(0, 0), same_pad(vol_shape[0], kd, sd), (0, 0), (0, 0), (0, 0)], 'constant')
+
+    out = 0
+    for k in range(kd):
+        x_k = x[:, k:k + sd * (out_depth - 1) + 1:sd]
+        x_k = x_k.reshape(-1, *vol_shape[1:], nb_feats)
+        out = out + depthwise_conv2d(x_k, kernel[k], strides[1:])
+    return out.reshape(-1, out_depth, *out.shape[1:])
+
+
+def depthwise_conv3d_direct(x, kernel, strides):
+    """ direct 3D depthwise convolution, 'same' padding """
+    pads = [same_pad(s, k, st) for s, k, st in zip(x.shape[1:-1], kernel.shape[:3], strides)]
+    x_pad = np.pad(x, [(0, 0), *pads, (0, 0)], 'constant')
+    out_shape = [-(-s // st) for s, st in zip(x.shape[1:-1], strides)]
+    out = np.zeros((x.shape[0], *out_shape, x.shape[-1]))
+    for d in range(out_shape[0]):
+        for h in range(out_shape[1]):
+            for w in range(out_shape[2]):
+                patch = x_pad[:, d * strides[0]:d * strides[0] + kernel.shape[0],
+                              h * strides[1]:h * strides[1] + kernel.shape[1],
+                              w * strides[2]:w * strides[2] + kernel.shape[2]]
+                out[:, d, h, w] = np.sum(patch * kernel, axis=(1, 2, 3))
+    return out
+
+
+def layer_output(x, kernel, strides):
+    """ output of the keras DepthwiseConv3D layer (without bias), with the given kernel """
+    # tensorflow is only needed for this check
+    import keras
+    import neuron.layers as nrn_layers
+
+    layer = nrn_layers.DepthwiseConv3D(kernel_size=kernel.shape[:3], strides=strides, use_bias=False)
+    x_in = keras.layers.Input(shape=x.shape[1:])
+    model = keras.models.Model(x_in, layer(x_in))
+    layer.set_weights([kernel[..., np.newaxis]])
+    return model.predict(x.astype('float32'))
+
+
+def check_depthwise(vol_sizes=((8, 10, 6), (7, 9, 5)),
+                    strides=(1, 2),
+                    kernel_size=3,
+                    nb_feats=2,
+                    batch_size=2,
+                    layer=False,
+                    seed=0):
+    """
+    compare the depth-slice decomposition (and optionally the keras layer) to a direct
+    3D depthwise convolution
+
+    :param vol_sizes: volume sizes to check
+    :param strides: (isotropic) strides to check
+    :param kernel_size: (isotropic) kernel size
+    :param nb_feats: number of channels
+    :param batch_size: batch size
+    :param layer: also check the keras DepthwiseConv3D layer (needs tensorflow)
+    :param seed: random seed
+
+    Returns:
+        the largest absolute difference
+    """
+    rng = np.random.RandomState(seed)
+    max_err = 0
+    for vol_size in vol_sizes:
+        for stride in strides:
+            x = rng.randn(batch_size, *vol_size, nb_feats)
+            kernel = rng.randn(*(kernel_size,) * 3, nb_feats)
+            st = (stride,) * 3
+            direct = depthwise_conv3d_direct(x, kernel, st)
+            errs = [np.max(np.abs(depthwise_conv3d_slices(x, kernel, st) - direct))]
+            if layer:
+                errs.append(np.max(np.abs(layer_output(x, kernel, st) - direct)))
+            max_err = max([max_err] + errs)
+            print('%-12s stride %d: output %-12s max abs diff %s' %
+                  ('x'.join(str(s) for s in vol_size), stride, 'x'.join(str(s) for s in direct.shape[1:-1]),
+                   ', '.join('%.3g' % e for e in errs)))
+    return max_err
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--vol_size", type=benchtools.parse_size, nargs='+',
+                        dest="vol_sizes", default=[(8, 10, 6), (7, 9, 5)],
+                        help="volume sizes, e.g. 8x10x6 7x9x5")
+    parser.add_argument("--strides", type=int, nargs='+',
+                        dest="strides", default=[1, 2],
+                        help="strides to check")
+    parser.add_argument("--kernel_size", type=int,
+                        dest="kernel_size", default=3,
+                        help="kernel size")
+    parser.add_argument("--nb_feats", type=int,
+                        dest="nb_feats", default=2,
+                        help="number of channels")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=2,
+                        help="batch size")
+    parser.add_argument("--layer", action='store_true',
+                        dest="layer",
+                        help="also check the keras layer (needs tensorflow)")
+    parser.add_argument("--seed", type=int,
+                        dest="seed", default=0,
+                        help="random seed")
+
+    args = parser.parse_args()
+    check_depthwise(**vars(args))
@@ -7,8 +7,14 @@ and segmentations. All of our papers use npz formated data.
 """
 
 import os, sys
+import json
+import collections
 import numpy as np
 
+# named timers (reported by the train scripts' --timer_report)
+sys.path.append('../ext/pytool-lib')
+import pytool.timer as timer
+
 
 def cvpr2018_gen(gen, atlas_vol_bs, batch_size=1):
     """ generator used for cvpr 2018 model """
@@ -33,6 +39,36 @@ def cvpr2018_gen_s2s(gen, batch_size=1):
         yield ([X1, X2], [X2, zeros])
 
 
+def cvpr2018_gen_s2s_pool(pair_pool, batch_size=1, report_every=None):
+    """
+    generator used for cvpr 2018 model for subject 2 subject registration,
+    drawing pairs from a PairPool of decoded volumes instead of loading two volumes per step.
+    Every report_every batches, the statistics of the pairs so far are printed (see PairPool.stats)
+    """
+    zeros = None
+    nb_batches = 0
+    while True:
+        X1, X2 = pair_pool.next_pairs(batch_size)
+        nb_batches += 1
+        if report_every is not None and nb_batches % report_every == 0:
+            print(pair_pool.format_stats())
+
+        if zeros is None:
+            volshape = X1.shape[1:-1]
+            zeros = np.zeros((batch_size, *volshape, len(volshape)))
+        yield ([X1, X2], [X2, zeros])
+
+
+def distill_gen(gen, teacher_net):
+    """
+    generator used for distillation: the batches of a cvpr2018_gen-like generator,
+    with the flow predicted by teacher_net (a [moving, fixed] -> flow model) as an added target
+    """
+    while True:
+        inputs, outputs = next(gen)
+        yield (inputs, outputs + [teacher_net.predict(inputs)])
+
+
 def miccai2018_gen(gen, atlas_vol_bs, batch_size=1, bidir=False):
     """ generator used for miccai 2018 model """
     volshape = atlas_vol_bs.shape[1:-1]
@@ -45,13 +81,21 @@ def miccai2018_gen(gen, atlas_vol_bs, batch_size=1, bidir=False):
             yield ([X, atlas_vol_bs], [atlas_vol_bs, zeros])
 
 
-def example_gen(vol_names, batch_size=1, return_segs=False, seg_dir=None):
+def example_gen(vol_names, batch_size=1, return_segs=False, seg_dir=None, scale_factors=None,
+                pack_dtype=None, seg_pack_dtype=None, cache=None, sampler=None):
     """
     generate examples
 
     Parameters:
         vol_names: a list or tuple of filenames
         batch_size: the size of the batch (default: 1)
+        scale_factors: optional dictionary {filename: scale} of intensity scale factors,
+            e.g. computed by neuron.dataproc.prctle_scale_factors
+        pack_dtype: optional reduced-precision type ('uint8' or 'float16') to hold volumes in
+            memory, see load_volfile. Volumes are only upcast to float32 when the batch is assembled.
+        seg_pack_dtype: optional type ('uint8' or 'uint16') to hold segmentations in memory
+        cache: optional VolCache, to keep (packed) volumes in memory across batches
+        sampler: optional EpochSampler. By default, examples are sampled uniformly with replacement.
 
         The following are fairly specific to our data structure, please change to your own
         return_segs: logical on whether to return segmentations
@@ -59,35 +103,246 @@ def example_gen(vol_names, batch_size=1, return_segs=False, seg_dir=None):
     """
 
     while True:
-        idxes = np.random.randint(len(vol_names), size=batch_size)
-
-        X_data = []
-        for idx in idxes:
-            X = load_volfile(vol_names[idx]) # -> 160x192x224
-            X = X[np.newaxis, ..., np.newaxis] # -> 1x160x192x224x1
-            X_data.append(X)
-
-        if batch_size > 1:
-            return_vals = [np.concatenate(X_data, 0)]
+        if sampler is None:
+            idxes = np.random.randint(len(vol_names), size=batch_size)
         else:
-            return_vals = [X_data[0]]  # -> 1x1x160c192x224x1
+            idxes = sampler.next_batch(batch_size)
 
-        # also return segmentations
-        if return_segs:
+        # load packed volumes, and only upcast when assembling the batch
+        # (timed outside of the yield, so that the timer does not include the training step)
+        with timer.Timer('example_gen', False):
             X_data = []
             for idx in idxes:
-                X_seg = load_volfile(vol_names[idx].replace('norm', 'aseg'))
-                X_seg = X_seg[np.newaxis, ..., np.newaxis]
-                X_data.append(X_seg)
-            
-            if batch_size > 1:
-                return_vals.append(np.concatenate(X_data, 0))
-            else:
-                return_vals.append(X_data[0])
+                X = _load_packed(vol_names[idx], cache, scale_factors=scale_factors, pack_dtype=pack_dtype)
+                X_data.append(X)  # -> 160x192x224 (packed)
+            return_vals = [unpack_batch(X_data)]  # -> batch_sizex160x192x224x1
+
+            # also return segmentations
+            if return_segs:
+                X_data = []
+                for idx in idxes:
+                    X_seg = _load_packed(vol_names[idx].replace('norm', 'aseg'), cache,
+                                         labels=True, pack_dtype=seg_pack_dtype)
+                    X_data.append(X_seg)
+                return_vals.append(unpack_batch(X_data, dtype=None))
 
         yield tuple(return_vals)
 
 
+class EpochSampler():
+    """
+    epoch-based sampler of example indices, without replacement within an epoch.
+
+    Each epoch is a permutation of range(nb_examples) drawn from (seed, epoch), so every example
+    is seen once per epoch. For data parallelism, the permutation is split across nb_shards
+    ranks (rank takes perm[rank::nb_shards], padded so all shards have the same length),
+    so processes sharing a seed never overlap within an epoch.
+
+    The state is just the number of indices drawn so far, and can be saved next to the
+    checkpoints (see neuron.callbacks.SamplerCheckpoint) to resume a run exactly.
+    """
+
+    def __init__(self, nb_examples, seed=0, rank=0, nb_shards=1):
+        assert nb_examples > 0, "EpochSampler needs at least one example"
+        assert 0 <= rank < nb_shards, "rank %d out of range for %d shards" % (rank, nb_shards)
+        self.nb_examples = nb_examples
+        self.seed = seed
+        self.rank = rank
+        self.nb_shards = nb_shards
+        self.shard_len = int(np.ceil(nb_examples / nb_shards))
+        self.nb_drawn = 0
+        self._epoch = None
+        self._order = None
+
+    def epoch_order(self, epoch):
+        """ the indices of this rank for a given epoch """
+        rng = np.random.RandomState([self.seed, epoch])
+        perm = rng.permutation(self.nb_examples)
+        # pad by wrapping, so that all shards have shard_len entries
+        perm = np.resize(perm, self.shard_len * self.nb_shards)
+        return perm[self.rank::self.nb_shards]
+
+    def next_batch(self, batch_size):
+        """ the next batch_size indices (may straddle two epochs) """
+        idxes = np.zeros(batch_size, dtype=int)
+        for i in range(batch_size):
+            epoch, pos = divmod(self.nb_drawn, self.shard_len)
+            if epoch != self._epoch:
+                self._epoch = epoch
+                self._order = self.epoch_order(epoch)
+            idxes[i] = self._order[pos]
+            self.nb_drawn += 1
+        return idxes
+
+    def state_dict(self, nb_drawn=None):
+        """ sampler state. nb_drawn overrides the current count (e.g. ignoring prefetched batches) """
+        return {'nb_examples': self.nb_examples,
+                'seed': self.seed,
+                'rank': self.rank,
+                'nb_shards': self.nb_shards,
+                'nb_drawn': self.nb_drawn if nb_drawn is None else nb_drawn}
+
+    def load_state_dict(self, state):
+        for key in ['nb_examples', 'seed', 'rank', 'nb_shards']:
+            assert state[key] == getattr(self, key), \
+                "sampler state is for %s %d, found %d" % (key, state[key], getattr(self, key))
+        self.nb_drawn = state['nb_drawn']
+        self._epoch = None
+
+    def save(self, filename, nb_drawn=None):
+        with open(filename, 'w') as f:
+            json.dump(self.state_dict(nb_drawn), f)
+
+    def load(self, filename):
+        with open(filename, 'r') as f:
+            self.load_state_dict(json.load(f))
+
+
+class PairPool():
+    """
+    pair-sampling engine for subject-to-subject registration.
+
+    Keeps a rotating pool of pool_size decoded (packed, see load_volfile) volumes, and emits
+    (A, B) pairs from it: all ordered pairs of pool volumes are visited in random order (both
+    (A, B) and (B, A) if bidir), and every refresh_every pairs the nb_refresh oldest volumes are
+    replaced by new ones from the sampler. Each load is therefore amortized over
+    refresh_every / nb_refresh pairs, instead of loading two volumes per pair.
+
+    stats() reports the statistics of the pairs emitted so far (format_stats() as one line,
+    printed periodically by cvpr2018_gen_s2s_pool).
+    """
+
+    def __init__(self, vol_names, pool_size=8, refresh_every=16, nb_refresh=1, bidir=True,
+                 sampler=None, seed=None, **load_kwargs):
+        """
+        Parameters:
+            vol_names: list of filenames
+            pool_size: number of volumes kept decoded in memory (at least 2)
+            refresh_every: number of pairs emitted between pool refreshes
+            nb_refresh: number of (oldest) volumes replaced at each refresh
+            bidir: use both (A, B) and (B, A). Otherwise each unordered pair is used once,
+                in a random direction, per pass over the pool
+            sampler: EpochSampler for the volumes entering the pool (default: EpochSampler(seed))
+            seed: seed of the pair order
+            **load_kwargs: arguments to load_volfile, e.g. pack_dtype or scale_factors
+        """
+        assert len(vol_names) >= 2, "the pool needs at least two subjects, found %d" % len(vol_names)
+        assert pool_size >= 2, "the pool needs at least two volumes"
+        self.vol_names = vol_names
+        self.pool_size = min(pool_size, len(vol_names))
+        assert 1 <= nb_refresh <= self.pool_size, "nb_refresh should be in [1, %d]" % self.pool_size
+        self.refresh_every = refresh_every
+        self.nb_refresh = nb_refresh
+        self.bidir = bidir
+        self.sampler = EpochSampler(len(vol_names), seed=0 if seed is None else seed) \
+            if sampler is None else sampler
+        self.rng = np.random.RandomState(seed)
+        self.load_kwargs = load_kwargs
+
+        # statistics
+        self.nb_loads = 0
+        self.nb_pairs = 0
+        self.nb_shared_consecutive = 0
+        self.pair_counts = collections.Counter()
+        self.subject_counts = collections.Counter()
+        self._last_pair = None
+
+        # initial pool: list of (subject index, packed volume)
+        self.pool = [self._load() for _ in range(self.pool_size)]
+        self.pairs_since_refresh = 0
+        self._pair_queue = self._make_pairs()
+
+    def next_pairs(self, batch_size=1):
+        """
+        Returns:
+            X1, X2: float32 batches [batch_size, *vol_shape, 1] of moving and fixed volumes
+        """
+        X1, X2 = [], []
+        for _ in range(batch_size):
+            a, b = self._next_pair()
+            X1.append(self.pool[a][1])
+            X2.append(self.pool[b][1])
+        return unpack_batch(X1), unpack_batch(X2)
+
+    def stats(self):
+        """
+        statistics of the emitted pairs: number of pairs and loads, pairs per load,
+        fraction of distinct ordered pairs, repeated pairs, per-subject usage
+        and fraction of consecutive pairs sharing a subject
+        """
+        usage = np.array(list(self.subject_counts.values())) if self.subject_counts else np.zeros(1)
+        nb_possible = len(self.vol_names) * (len(self.vol_names) - 1)
+        return {'nb_pairs': self.nb_pairs,
+                'nb_loads': self.nb_loads,
+                'pairs_per_load': self.nb_pairs / max(self.nb_loads, 1),
+                'nb_distinct_pairs': len(self.pair_counts),
+                'frac_distinct_pairs': len(self.pair_counts) / max(self.nb_pairs, 1),
+                'coverage_of_all_pairs': len(self.pair_counts) / max(nb_possible, 1),
+                'max_pair_repeats': max(self.pair_counts.values()) if self.pair_counts else 0,
+                'nb_subjects_seen': len(self.subject_counts),
+                'subject_usage_mean': float(np.mean(usage)),
+                'subject_usage_std': float(np.std(usage)),
+                'subject_usage_min': int(np.min(usage)),
+                'subject_usage_max': int(np.max(usage)),
+                'frac_consecutive_shared': self.nb_shared_consecutive / max(self.nb_pairs - 1, 1)}
+
+    def format_stats(self):
+        """ one line summary of stats() """
+        stats = self.stats()
+        return ('pairs: %d from %d loads (%.1f pairs/load), %.1f%% distinct, %.1f%% of all pairs, '
+                'max repeats %d, subject usage %.1f +- %.1f [%d, %d] over %d subjects, '
+                '%.1f%% consecutive pairs share a subject' %
+                (stats['nb_pairs'], stats['nb_loads'], stats['pairs_per_load'],
+                 100 * stats['frac_distinct_pairs'], 100 * stats['coverage_of_all_pairs'],
+                 stats['max_pair_repeats'], stats['subject_usage_mean'], stats['subject_usage_std'],
+                 stats['subject_usage_min'], stats['subject_usage_max'], stats['nb_subjects_seen'],
+                 100 * stats['frac_consecutive_shared']))
+
+    def _load(self):
+        idx = self.sampler.next_batch(1)[0]
+        self.nb_loads += 1
+        return (idx, load_volfile(self.vol_names[idx], packed=True, **self.load_kwargs))
+
+    def _make_pairs(self):
+        """ random order of pool slot pairs, skipping pairs of the same subject """
+        n = len(self.pool)
+        if self.bidir:
+            pairs = [(a, b) for a in range(n) for b in range(n) if a != b]
+        else:
+            pairs = [(a, b) if self.rng.rand() < 0.5 else (b, a) for a in range(n) for b in range(a + 1, n)]
+        pairs = [p for p in pairs if self.pool[p[0]][0] != self.pool[p[1]][0]]
+        order = self.rng.permutation(len(pairs))
+        return [pairs[i] for i in order]
+
+    def _refresh(self):
+        # the pool is kept oldest-first
+        self.pool = self.pool[self.nb_refresh:] + [self._load() for _ in range(self.nb_refresh)]
+        self.pairs_since_refresh = 0
+        self._pair_queue = self._make_pairs()
+
+    def _next_pair(self):
+        if self.pairs_since_refresh >= self.refresh_every:
+            self._refresh()
+        while len(self._pair_queue) == 0:  # every pair of the pool was used: reuse, or refresh if needed
+            self._pair_queue = self._make_pairs()
+            if len(self._pair_queue) == 0:
+                self._refresh()
+
+        a, b = self._pair_queue.pop()
+        self.pairs_since_refresh += 1
+
+        # statistics on subjects
+        pair = (self.pool[a][0], self.pool[b][0])
+        self.nb_pairs += 1
+        self.pair_counts[pair] += 1
+        self.subject_counts[pair[0]] += 1
+        self.subject_counts[pair[1]] += 1
+        if self._last_pair is not None and len(set(pair) & set(self._last_pair)) > 0:
+            self.nb_shared_consecutive += 1
+        self._last_pair = pair
+        return a, b
+
+
 def load_example_by_name(vol_name, seg_name):
     """
     load a specific volume and segmentation
@@ -105,26 +360,144 @@ def load_example_by_name(vol_name, seg_name):
     return tuple(return_vals)
 
 
-def load_volfile(datafile):
+@timer.timed()
+def load_volfile(datafile, scale_factors=None, packed=False, pack_dtype=None, labels=False):
     """
     load volume file
     formats: nii, nii.gz, mgz, npz
     if it's a npz (compressed numpy), assume variable names 'vol_data' 
+
+    npz files written in reduced precision by neuron.dataproc.pack_vol can also hold
+    'vol_scale' and 'vol_offset', such that the volume is vol_data * vol_scale + vol_offset.
+
+    Parameters:
+        datafile: the filename
+        scale_factors: optional dictionary {filename: scale} (see neuron.dataproc.prctle_scale_factors).
+            The volume is multiplied by the scale of its (base) filename.
+        packed: if True, return the compact tuple (vol_data, scale, offset), without upcasting
+            vol_data. See unpack_batch.
+        pack_dtype: if packed, optionally reduce the in-memory precision of full-precision volumes:
+            'uint8' (quantized with a per-volume scale and offset) or 'float16' for intensities,
+            'uint8' or 'uint16' for labels
+        labels: whether the volume is a segmentation (labels are never scaled or quantized)
+
+    Returns:
+        the volume, upcast to float32 if it was stored with a scale (or scale_factors are given).
+        or, if packed, the tuple (vol_data, scale, offset)
     """
     assert datafile.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file'
 
+    scale, offset = 1.0, 0.0
     if datafile.endswith(('.nii', '.nii.gz', '.mgz')):
-        # import nibabel
-        if 'nibabel' not in sys.modules:
-            try :
-                import nibabel as nib  
-            except:
-                print('Failed to import nibabel. need nibabel library for these data file types.')
+        # nibabel is only imported for these file types
+        try:
+            import nibabel as nib
+        except ImportError:
+            print('Failed to import nibabel. need nibabel library for these data file types.')
+            raise
 
         X = nib.load(datafile).get_data()
         
     else: # npz
-        X = np.load(datafile)['vol_data']
+        npz = np.load(datafile)
+        X = npz['vol_data']
+        if 'vol_scale' in npz:
+            scale, offset = float(npz['vol_scale']), float(npz['vol_offset'])
+
+    if scale_factors is not None and not labels:
+        factor = scale_factors[os.path.basename(datafile)]
+        scale, offset = scale * factor, offset * factor
+
+    if packed:
+        if pack_dtype is not None and X.dtype != pack_dtype:
+            X, scale, offset = _pack(X, scale, offset, pack_dtype, labels)
+        return (X, scale, offset)
+
+    if scale != 1 or offset != 0:
+        X = unpack_batch([(X, scale, offset)])[0, ..., 0]
 
     return X
 
+
+@timer.timed()
+def unpack_batch(packed_vols, dtype='float32'):
+    """
+    assemble a batch from packed (vol_data, scale, offset) volumes (see load_volfile),
+    upcasting to dtype only here.
+
+    Parameters:
+        packed_vols: list of (vol_data, scale, offset) tuples
+        dtype: batch dtype. None keeps the type of the first vol_data (e.g. for labels)
+
+    Returns:
+        batch of shape [len(packed_vols), *vol_shape, 1]
+    """
+    shape = packed_vols[0][0].shape
+    if dtype is None:
+        dtype = packed_vols[0][0].dtype
+
+    batch = np.empty((len(packed_vols), *shape, 1), dtype)
+    for i, (X, scale, offset) in enumerate(packed_vols):
+        vol = batch[i, ..., 0]
+        vol[...] = X
+        if scale != 1:
+            vol *= scale
+        if offset != 0:
+            vol += offset
+    return batch
+
+
+class VolCache():
+    """
+    in-memory least-recently-used cache of packed volumes (see load_volfile),
+    bounded by a number of bytes. Holding volumes in reduced precision (pack_dtype) 
+    keeps a 4-8x larger working set resident.
+    """
+
+    def __init__(self, max_bytes=8 * 2**30):
+        self.max_bytes = max_bytes
+        self.vols = collections.OrderedDict()
+        self.nbytes = 0
+
+    def get(self, filename, **kwargs):
+        """ get the packed volume of filename, loading it with load_volfile(filename, packed=True, **kwargs) """
+        if filename in self.vols:
+            self.vols.move_to_end(filename)
+            return self.vols[filename]
+
+        vol = load_volfile(filename, packed=True, **kwargs)
+        self.vols[filename] = vol
+        self.nbytes += vol[0].nbytes
+        while self.nbytes > self.max_bytes and len(self.vols) > 1:
+            _, old_vol = self.vols.popitem(last=False)
+            self.nbytes -= old_vol[0].nbytes
+        return vol
+
+
+def _load_packed(filename, cache=None, **kwargs):
+    if cache is not None:
+        return cache.get(filename, **kwargs)
+    return load_volfile(filename, packed=True, **kwargs)
+
+
+def _pack(X, scale, offset, pack_dtype, labels):
+    """
+    reduce the in-memory precision of a volume, with the same rules as (and rejecting the
+    same inputs as) neuron.dataproc.pack_vol
+    """
+    if labels:
+        # labels are stored as is, and have to fit the integer type
+        assert pack_dtype in ['uint8', 'uint16'], "labels should be packed as uint8 or uint16, found %s" % pack_dtype
+        assert np.min(X) >= 0 and np.max(X) <= np.iinfo(pack_dtype).max, \
+            "labels do not fit in %s" % pack_dtype
+        return np.round(X).astype(pack_dtype), scale, offset
+
+    if pack_dtype == 'float16':
+        # float16 keeps the scale
+        return X.astype(pack_dtype), scale, offset
+
+    assert pack_dtype == 'uint8', "intensities can be packed as uint8 or float16, found %s" % pack_dtype
+    vmin, vmax = float(np.min(X)), float(np.max(X))
+    qscale = (vmax - vmin) / 255 if vmax > vmin else 1.0
+    X = np.round((X - vmin) * (1 / qscale)).astype('uint8')
+    return X, scale * qscale, scale * vmin + offset
@@ -0,0 +1,272 @@
+"""
+background validation of VoxelMorph training checkpoints
+
+watches model_dir for new checkpoints (e.g. written by train.py or train_miccai2018.py), and
+evaluates each one on a validation set: the validation volumes are registered to the atlas,
+their segmentations are warped, and Dice with the atlas segmentation and statistics of the
+flow are appended to a csv log. It runs in its own process and session (by default on the CPU),
+so training never pauses for evaluation.
+
+example:
+    python eval_checkpoints.py /my/models --val_list val_examples.txt --model vm2
+where val_examples.txt has a "vol_file,seg_file" line per validation subject
+"""
+
+# python imports
+import os
+import sys
+import glob
+import time
+from argparse import ArgumentParser
+
+# third-party imports
+import tensorflow as tf
+import numpy as np
+import scipy.io as sio
+import keras
+from keras.backend.tensorflow_backend import set_session
+
+# project imports
+import datagenerators
+import networks
+sys.path.append('../ext/medipy-lib')
+from medipy.metrics import dice
+
+
+LOG_FIELDS = ['checkpoint', 'epoch', 'dice_mean', 'dice_std', 'jac_neg_frac', 'disp_mean', 'disp_max',
+              'grad_l2', 'eval_sec']
+
+
+def eval_checkpoints(model_dir,
+                     val_list,
+                     model='vm2',
+                     atlas_file='../data/atlas_norm.npz',
+                     labels_file='../data/labels.mat',
+                     log_file=None,
+                     gpu_id='',
+                     nb_threads=None,
+                     max_examples=None,
+                     last_epoch=None,
+                     poll_sec=30,
+                     settle_sec=5,
+                     once=False,
+                     parent_pid=None):
+    """
+    evaluate the checkpoints of model_dir as they appear
+    :param model_dir: directory of the epoch checkpoints ('%02d.h5' % epoch)
+    :param val_list: text file with a "vol_file,seg_file" line per validation subject
+    :param model: vm1, vm2, vm2double (cvpr2018 models) or miccai2018
+    :param atlas_file: npz file with the atlas 'vol' and 'seg'
+    :param labels_file: mat file with the 'labels' to compute Dice on
+    :param log_file: csv file the results are appended to (default: model_dir/val_metrics.csv)
+    :param gpu_id: gpu to evaluate on ('' for the CPU, to leave the GPUs to training)
+    :param nb_threads: optional number of CPU threads of the session
+    :param max_examples: optional number of validation subjects to use
+    :param last_epoch: stop once this epoch's checkpoint is evaluated (e.g. nb_epochs of training)
+    :param poll_sec: seconds between scans of model_dir
+    :param settle_sec: only evaluate checkpoints that have not changed for settle_sec seconds
+    :param once: evaluate the current checkpoints and return
+    :param parent_pid: pid of the training process that started the evaluation. Once it is gone
+        (the parent pid changed), the checkpoints left are evaluated and the evaluation returns
+    """
+    if log_file is None:
+        log_file = os.path.join(model_dir, 'val_metrics.csv')
+
+    # cache the validation set and atlas
+    with open(val_list, 'r') as f:
+        val_pairs = [line.strip().split(',') for line in f if len(line.strip()) > 0]
+    if max_examples is not None:
+        val_pairs = val_pairs[:max_examples]
+    val_data = [datagenerators.load_example_by_name(vol_name, seg_name) for vol_name, seg_name in val_pairs]
+    labels = sio.loadmat(labels_file)['labels'][0]
+    atlas = np.load(atlas_file)
+    atlas_vol = atlas['vol'][np.newaxis, ..., np.newaxis]
+    atlas_seg = atlas['seg']
+    vol_size = atlas_vol.shape[1:-1]
+    print('cached %d validation subjects' % len(val_data))
+
+    # own session
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    if nb_threads is not None:
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
+    set_session(tf.Session(config=config))
+
+    # the flow model is built once, and each checkpoint's weights loaded into it
+    net, flow_net = _flow_model(model, vol_size)
+    nn_trf_model = networks.nn_trf(vol_size, indexing='ij')
+
+    done = _logged_checkpoints(log_file)
+    while True:
+        # checked before the scan, so that the checkpoints written before the exit are evaluated
+        parent_gone = parent_pid is not None and os.getppid() != parent_pid
+
+        for filename in _new_checkpoints(model_dir, done, settle_sec):
+            tstart = time.time()
+            try:
+                net.load_weights(filename)
+            except (OSError, IOError, KeyError) as e:
+                # removed by checkpoint retention, or still being written
+                print('could not load %s: %s' % (filename, e), file=sys.stderr)
+                continue
+
+            stats = evaluate(flow_net, nn_trf_model, val_data, atlas_vol, atlas_seg, labels)
+            stats['checkpoint'] = os.path.basename(filename)
+            stats['epoch'] = _checkpoint_epoch(filename)
+            stats['eval_sec'] = time.time() - tstart
+            _append_log(log_file, stats)
+            done.add(stats['checkpoint'])
+            print('%s: dice %5.3f, negative jacobian %6.4f%% (%.1f sec)' %
+                  (stats['checkpoint'], stats['dice_mean'], 100 * stats['jac_neg_frac'], stats['eval_sec']))
+
+            if last_epoch is not None and stats['epoch'] >= last_epoch:
+                return
+
+        if once:
+            return
+        if parent_gone:
+            print('training process %d exited, stopping' % parent_pid)
+            return
+        time.sleep(poll_sec)
+
+
+def evaluate(flow_net, nn_trf_model, val_data, atlas_vol, atlas_seg, labels):
+    """
+    register each validation subject to the atlas, and average the Dice of the warped
+    segmentations and the flow statistics
+    """
+    dice_vals = np.zeros((len(val_data), len(labels)))
+    flow_vals = []
+    for k, (X_vol, X_seg) in enumerate(val_data):
+        flow = flow_net.predict([X_vol, atlas_vol])
+        warp_seg = nn_trf_model.predict([X_seg, flow])[0, ..., 0]
+        dice_vals[k, :] = dice(warp_seg, atlas_seg, labels=labels)
+        flow_vals.append(flow_stats(flow[0, ...]))
+
+    stats = {'dice_mean': np.mean(dice_vals), 'dice_std': np.std(np.mean(dice_vals, 1))}
+    for key in flow_vals[0].keys():
+        stats[key] = np.mean([f[key] for f in flow_vals])
+    return stats
+
+
+def flow_stats(flow):
+    """
+    statistics of a dense displacement field of shape [*vol_shape, ndims]:
+    fraction of voxels with a non-positive jacobian determinant (folding),
+    mean and max displacement norm, and mean squared spatial gradient
+    """
+    ndims = flow.shape[-1]
+    grads = [np.gradient(flow[..., d]) for d in range(ndims)]  # grads[d][e] = d flow_d / d x_e
+    jac = np.empty(flow.shape[:-1] + (ndims, ndims), flow.dtype)
+    for d in range(ndims):
+        for e in range(ndims):
+            jac[..., d, e] = grads[d][e] + (d == e)
+    det = np.linalg.det(jac)
+
+    disp = np.sqrt(np.sum(flow ** 2, -1))
+    grad_l2 = np.mean([np.mean(g ** 2) for gd in grads for g in gd])
+    return {'jac_neg_frac': np.mean(det <= 0), 'disp_mean': np.mean(disp), 'disp_max': np.max(disp),
+            'grad_l2': grad_l2}
+
+
+def _flow_model(model, vol_size):
+    """ (network to load the weights into, model from [moving, atlas] to the dense flow) """
+    if model == 'miccai2018':
+        net = networks.miccai2018_net(vol_size, [16, 32, 32, 32], [32, 32, 32, 32, 16, 3])
+        flow_net = keras.models.Model(net.inputs, net.get_layer('diffflow').output)
+    else:
+        nf_enc = [16, 32, 32, 32]
+        if model == 'vm1':
+            nf_dec = [32, 32, 32, 32, 8, 8]
+        elif model == 'vm2':
+            nf_dec = [32, 32, 32, 32, 32, 16, 16]
+        else:  # 'vm2double'
+            nf_enc = [f * 2 for f in nf_enc]
+            nf_dec = [f * 2 for f in [32, 32, 32, 32, 32, 16, 16]]
+        net = networks.cvpr2018_net(vol_size, nf_enc, nf_dec)
+        flow_net = keras.models.Model(net.inputs, net.outputs[1])
+    return net, flow_net
+
+
+def _checkpoint_epoch(filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return int(name) if name.isdigit() else -1
+
+
+def _new_checkpoints(model_dir, done, settle_sec):
+    """ epoch checkpoints not evaluated yet, and not modified in the last settle_sec seconds """
+    now = time.time()
+    filenames = [f for f in glob.glob(os.path.join(model_dir, '*.h5'))
+                 if _checkpoint_epoch(f) >= 0 and os.path.basename(f) not in done]
+    settled = []
+    for f in filenames:
+        try:
+            if now - os.path.getmtime(f) > settle_sec:
+                settled.append(f)
+        except OSError:
+            # deleted by the checkpoint retention since the glob
+            pass
+    return sorted(settled, key=_checkpoint_epoch)
+
+
+def _logged_checkpoints(log_file):
+    """ checkpoints already in the log, so that the evaluator can be restarted """
+    if not os.path.isfile(log_file):
+        return set()
+    with open(log_file, 'r') as f:
+        return set(line.split(',')[0] for line in f.readlines()[1:])
+
+
+def _append_log(log_file, stats):
+    new_file = not os.path.isfile(log_file)
+    with open(log_file, 'a') as f:
+        if new_file:
+            f.write(','.join(LOG_FIELDS) + '\n')
+        f.write(','.join(str(stats[k]) for k in LOG_FIELDS) + '\n')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("model_dir", type=str,
+                        help="models folder")
+    parser.add_argument("--val_list", type=str, required=True,
+                        dest="val_list",
+                        help="text file with a vol_file,seg_file line per validation subject")
+    parser.add_argument("--model", type=str, dest="model",
+                        choices=['vm1', 'vm2', 'vm2double', 'miccai2018'], default='vm2',
+                        help="voxelmorph model")
+    parser.add_argument("--atlas_file", type=str,
+                        dest="atlas_file", default='../data/atlas_norm.npz',
+                        help="atlas npz file with vol and seg")
+    parser.add_argument("--labels_file", type=str,
+                        dest="labels_file", default='../data/labels.mat',
+                        help="mat file with the labels to compute Dice on")
+    parser.add_argument("--log_file", type=str,
+                        dest="log_file", default=None,
+                        help="csv log (default: model_dir/val_metrics.csv)")
+    parser.add_argument("--gpu", type=str, default='',
+                        dest="gpu_id", help="gpu id number ('' for the CPU)")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of CPU threads")
+    parser.add_argument("--max_examples", type=int,
+                        dest="max_examples", default=None,
+                        help="number of validation subjects to use")
+    parser.add_argument("--last_epoch", type=int,
+                        dest="last_epoch", default=None,
+                        help="stop after evaluating this epoch")
+    parser.add_argument("--poll_sec", type=float,
+                        dest="poll_sec", default=30,
+                        help="seconds between scans of model_dir")
+    parser.add_argument("--once", action="store_true",
+                        dest="once",
+                        help="evaluate the current checkpoints and exit")
+    parser.add_argument("--parent_pid", type=int,
+                        dest="parent_pid", default=None,
+                        help="pid of the training process: exit once it is gone")
+
+    args = parser.parse_args()
+    eval_checkpoints(**vars(args))
@@ -31,7 +31,7 @@ import neuron.utils as nrn_utils
 import losses
 
 
-def unet_core(vol_size, enc_nf, dec_nf, full_size=True):
+def unet_core(vol_size, enc_nf, dec_nf, full_size=True, conv_type='dense', skip_nf=None, recompute_head=False):
     """
     unet architecture for voxelmorph models presented in the CVPR 2018 paper. 
     You may need to modify this code (e.g., number of layers) to suit your project needs.
@@ -40,6 +40,11 @@ def unet_core(vol_size, enc_nf, dec_nf, full_size=True):
     :param enc_nf: list of encoder filters. right now it needs to be 1x4.
            e.g. [16,32,32,32]
     :param dec_nf: list of decoder filters. right now it must be 1x6 (like voxelmorph-1) or 1x7 (voxelmorph-2)
+    :param conv_type: convolutions of the blocks, see conv_block: 'dense', 'separable' or 'factorized'
+    :param skip_nf: optional number of channels the encoder skip connections are reduced to
+           (with a 1x1x1 convolution) before they are concatenated in the decoder
+    :param recompute_head: recompute the blocks of the last decoder level (the output resolution)
+           during backprop instead of keeping their activations (gradient checkpointing)
     :return: the keras model e.g. [32, 32, 32, 32, 32, 16, 16]
     """
     ndims = len(vol_size)  # -> 3
@@ -58,37 +63,39 @@ def unet_core(vol_size, enc_nf, dec_nf, full_size=True):
     # down-sample path (encoder)
     x_enc = [x_in]
     for i in range(len(enc_nf)):
-        x_enc.append(conv_block(x_enc[-1], enc_nf[i], 2))
+        x_enc.append(conv_block(x_enc[-1], enc_nf[i], 2, conv_type=conv_type))
+
+    # optional channel reduction of the skip connections (the input itself is kept)
+    x_skip = list(x_enc)
+    if skip_nf is not None:
+        x_skip[1:-1] = [conv_block(x, skip_nf, kernel_size=1) for x in x_enc[1:-1]]
 
     # up-sample path (decoder)
-    x = conv_block(x_enc[-1], dec_nf[0])
-    x = upsample_layer()(x)
-    x = concatenate([x, x_enc[-2]])
-    x = conv_block(x, dec_nf[1])
+    x = conv_block(x_enc[-1], dec_nf[0], conv_type=conv_type)
     x = upsample_layer()(x)
-    x = concatenate([x, x_enc[-3]])
-    x = conv_block(x, dec_nf[2])
+    x = concatenate([x, x_skip[-2]])
+    x = conv_block(x, dec_nf[1], conv_type=conv_type)
     x = upsample_layer()(x)
-    x = concatenate([x, x_enc[-4]])
-    x = conv_block(x, dec_nf[3])
-    x = conv_block(x, dec_nf[4])
+    x = concatenate([x, x_skip[-3]])
+    x = conv_block(x, dec_nf[2], conv_type=conv_type)
+    x = up_conv_block(x, x_skip[-4], dec_nf[3], conv_type=conv_type, recompute=recompute_head and not full_size)
+    x = conv_block(x, dec_nf[4], conv_type=conv_type, recompute=recompute_head and not full_size)
     
     # only upsampleto full dim if full_size
     # here we explore architectures where we essentially work with flow fields 
     # that are 1/2 size 
     if full_size:
-        x = upsample_layer()(x)
-        x = concatenate([x, x_enc[0]])
-        x = conv_block(x, dec_nf[5])
+        x = up_conv_block(x, x_skip[0], dec_nf[5], conv_type=conv_type, recompute=recompute_head)
 
     # optional convolution at output resolution (used in voxelmorph-2)
     if len(dec_nf) == 7:
-        x = conv_block(x, dec_nf[6])
+        x = conv_block(x, dec_nf[6], conv_type=conv_type, recompute=recompute_head)
     # print(x.shape) (?, 160, 192, 224, 16)
     return Model(inputs=[src, tgt], outputs=[x])
 
 
-def cvpr2018_net(vol_size, enc_nf, dec_nf, full_size=True, indexing='ij'):
+def cvpr2018_net(vol_size, enc_nf, dec_nf, full_size=True, indexing='ij', conv_type='dense', skip_nf=None,
+                 checkpoint=()):
     """
     unet architecture for voxelmorph models presented in the CVPR 2018 paper. 
     You may need to modify this code (e.g., number of layers) to suit your project needs.
@@ -97,13 +104,21 @@ def cvpr2018_net(vol_size, enc_nf, dec_nf, full_size=True, indexing='ij'):
     :param enc_nf: list of encoder filters. right now it needs to be 1x4.
            e.g. [16,32,32,32]
     :param dec_nf: list of decoder filters. right now it must be 1x6 (like voxelmorph-1) or 1x7 (voxelmorph-2)
+    :param full_size: if False, the flow is predicted at half resolution (dec_nf[5] is then unused)
+           and upsampled to vol_size, as in miccai2018_net
+    :param conv_type: convolutions of the unet blocks: 'dense', 'separable' or 'factorized'
+    :param skip_nf: optional number of channels of the skip connections, see unet_core
+    :param checkpoint: segments recomputed during backprop instead of kept (gradient checkpointing):
+           'head' (last decoder level blocks) and/or 'warp' (flow upsampling and spatial transform)
     :return: the keras model e.g.[32, 32, 32, 32, 32, 16, 16]
     """
     ndims = len(vol_size) # -> 3
     assert ndims in [1, 2, 3], "ndims should be one of 1, 2, or 3. found: %d" % ndims
 
     # get the core model
-    unet_model = unet_core(vol_size, enc_nf, dec_nf, full_size=full_size)
+    assert all(c in ['head', 'warp'] for c in checkpoint), 'checkpoint segments should be head or warp'
+    unet_model = unet_core(vol_size, enc_nf, dec_nf, full_size=full_size, conv_type=conv_type, skip_nf=skip_nf,
+                           recompute_head='head' in checkpoint)
     [src, tgt] = unet_model.inputs
     x = unet_model.output
 
@@ -112,9 +127,16 @@ def cvpr2018_net(vol_size, enc_nf, dec_nf, full_size=True, indexing='ij'):
     flow = Conv(ndims, kernel_size=3, padding='same', name='flow',
                   kernel_initializer=RandomNormal(mean=0.0, stddev=1e-5))(x)
 
+    # get up to final resolution (displacements in full resolution voxels)
+    if not full_size:
+        flow = Lambda(interp_upsampling, output_shape=vol_size + (ndims,), name='pre_fullflow',
+                      arguments={'recompute': 'warp' in checkpoint})(flow)
+        flow = Lambda(lambda arg: arg*2, name='fullflow')(flow)
+
     # warp the source with the flow
     # indexing = 'ij'
-    y = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing)([src, flow])
+    y = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing,
+                                      recompute='warp' in checkpoint)([src, flow])
     # print(y.shape) (?, 160, 192, 224, 1)
     # src: ?x160x192x224x1  flow: ?x160x192x224x3
     # prepare model
@@ -122,7 +144,8 @@ def cvpr2018_net(vol_size, enc_nf, dec_nf, full_size=True, indexing='ij'):
     return model
 
 
-def miccai2018_net(vol_size, enc_nf, dec_nf, int_steps=7, use_miccai_int=False, indexing='ij', bidir=False):
+def miccai2018_net(vol_size, enc_nf, dec_nf, int_steps=7, use_miccai_int=False, indexing='ij', bidir=False,
+                   conv_type='dense', skip_nf=None, checkpoint=()):
     """
     architecture for probabilistic diffeomoprhic VoxelMorph presented in the MICCAI 2018 paper. 
     You may need to modify this code (e.g., number of layers) to suit your project needs.
@@ -141,13 +164,20 @@ def miccai2018_net(vol_size, enc_nf, dec_nf, int_steps=7, use_miccai_int=False,
     :param indexing: xy or ij indexing. we recommend ij indexing if training from scratch. 
             miccai 2018 runs were done with xy indexing.
             **This param will be phased out (set to 'ij' behavior)**
+    :param conv_type: convolutions of the unet blocks: 'dense', 'separable' or 'factorized'
+    :param skip_nf: optional number of channels of the skip connections, see unet_core
+    :param checkpoint: segments recomputed during backprop instead of kept (gradient checkpointing):
+           'head' (last decoder level blocks), 'warp' (flow upsampling and spatial transforms)
+           and/or 'int' (the warp of each integration step)
     :return: the keras model
     """    
     ndims = len(vol_size)
     assert ndims in [1, 2, 3], "ndims should be one of 1, 2, or 3. found: %d" % ndims
 
     # get unet
-    unet_model = unet_core(vol_size, enc_nf, dec_nf, full_size=False)
+    assert all(c in ['head', 'warp', 'int'] for c in checkpoint), 'checkpoint segments should be head, warp or int'
+    unet_model = unet_core(vol_size, enc_nf, dec_nf, full_size=False, conv_type=conv_type, skip_nf=skip_nf,
+                           recompute_head='head' in checkpoint)
     [src, tgt] = unet_model.inputs
     x_out = unet_model.outputs[-1]
 
@@ -172,30 +202,37 @@ def miccai2018_net(vol_size, enc_nf, dec_nf, int_steps=7, use_miccai_int=False,
         # was manually composed of a Transform and and Add Layer.
         v = flow
         for _ in range(int_steps):
-            v1 = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing)([v, v])
+            v1 = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing,
+                                               recompute='int' in checkpoint)([v, v])
             v = keras.layers.add([v, v1])
         flow = v
 
     else:
         # new implementation in neuron is cleaner.
         z_sample = flow
-        flow = nrn_layers.VecInt(method='ss', name='flow-int', int_steps=int_steps)(z_sample)
+        flow = nrn_layers.VecInt(method='ss', name='flow-int', int_steps=int_steps,
+                                 recompute='int' in checkpoint)(z_sample)
         if bidir:
             rev_z_sample = Lambda(lambda x: -x)(z_sample)
-            neg_flow = nrn_layers.VecInt(method='ss', name='neg_flow-int', int_steps=int_steps)(rev_z_sample)
+            neg_flow = nrn_layers.VecInt(method='ss', name='neg_flow-int', int_steps=int_steps,
+                                         recompute='int' in checkpoint)(rev_z_sample)
 
     # get up to final resolution
-    flow = Lambda(interp_upsampling, output_shape=vol_size + (ndims,), name='pre_diffflow')(flow)
+    flow = Lambda(interp_upsampling, output_shape=vol_size + (ndims,), name='pre_diffflow',
+                  arguments={'recompute': 'warp' in checkpoint})(flow)
     flow = Lambda(lambda arg: arg*2, name='diffflow')(flow)
 
     if bidir:
-        neg_flow = Lambda(interp_upsampling, output_shape=vol_size + (ndims,), name='neg_pre_diffflow')(neg_flow)
+        neg_flow = Lambda(interp_upsampling, output_shape=vol_size + (ndims,), name='neg_pre_diffflow',
+                          arguments={'recompute': 'warp' in checkpoint})(neg_flow)
         neg_flow = Lambda(lambda arg: arg*2, name='neg_diffflow')(neg_flow)
 
     # transform
-    y = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing)([src, flow])
+    y = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing,
+                                      recompute='warp' in checkpoint)([src, flow])
     if bidir:
-        y_tgt = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing)([tgt, neg_flow])
+        y_tgt = nrn_layers.SpatialTransformer(interp_method='linear', indexing=indexing,
+                                              recompute='warp' in checkpoint)([tgt, neg_flow])
 
     # prepare outputs and losses
     outputs = [y, flow_params]
@@ -225,18 +262,83 @@ def nn_trf(vol_size, indexing='xy'):
 
 
 # Helper functions
-def conv_block(x_in, nf, strides=1):
+def conv_block(x_in, nf, strides=1, conv_type='dense', kernel_size=3, recompute=False):
     """
     specific convolution module including convolution followed by leakyrelu
+
+    conv_type is the convolution:
+        'dense': a kernel_size^ndims convolution
+        'separable': a depthwise kernel_size^ndims convolution followed by a 1x1x1 convolution
+        'factorized': a kernel_size x 1 x 1, then 1 x kernel_size x 1, then 1 x 1 x kernel_size
+            convolution (strided along their own axis), with nf filters each
+    with recompute, the block's intermediate outputs are recomputed during backprop
+    (see neuron.layers.Recompute)
     """
     ndims = len(x_in.get_shape()) - 2
     assert ndims in [1, 2, 3], "ndims should be one of 1, 2, or 3. found: %d" % ndims
 
+    block = conv_block_layers(ndims, nf, strides=strides, conv_type=conv_type, kernel_size=kernel_size)
+    if recompute:
+        return nrn_layers.Recompute(lambda apply, x: _sequential(apply, block, x), block)(x_in)
+    return _sequential(_call, block, x_in)
+
+
+def up_conv_block(x_in, x_skip, nf, conv_type='dense', recompute=False):
+    """
+    decoder module: upsampling of x_in, concatenation with the skip connection x_skip,
+    and conv_block. With recompute, only x_in, x_skip and the output are kept for backprop.
+    """
+    ndims = len(x_in.get_shape()) - 2
+    upsample = getattr(KL, 'UpSampling%dD' % ndims)()
+    concat = KL.Concatenate()
+    block = conv_block_layers(ndims, nf, conv_type=conv_type)
+
+    def fn(apply, x):
+        return _sequential(apply, block, apply(concat, [apply(upsample, x[0]), x[1]]))
+
+    if recompute:
+        return nrn_layers.Recompute(fn, [upsample, concat] + block)([x_in, x_skip])
+    return fn(_call, [x_in, x_skip])
+
+
+def conv_block_layers(ndims, nf, strides=1, conv_type='dense', kernel_size=3):
+    """ the (not yet called) layers of conv_block, in order """
     Conv = getattr(KL, 'Conv%dD' % ndims)
-    x_out = Conv(nf, kernel_size=3, padding='same',
-                 kernel_initializer='he_normal', strides=strides)(x_in)
-    x_out = LeakyReLU(0.2)(x_out)
-    return x_out
+    if conv_type == 'dense':
+        block = [Conv(nf, kernel_size=kernel_size, padding='same',
+                      kernel_initializer='he_normal', strides=strides)]
+
+    elif conv_type == 'separable':
+        assert ndims in [2, 3], "separable convolutions need 2 or 3 dimensions. found: %d" % ndims
+        if ndims == 3:
+            depthwise = nrn_layers.DepthwiseConv3D(kernel_size, strides=strides)
+        else:
+            depthwise = KL.DepthwiseConv2D(kernel_size, padding='same', strides=strides,
+                                           depthwise_initializer='he_normal')
+        block = [depthwise, Conv(nf, kernel_size=1, padding='same', kernel_initializer='he_normal')]
+
+    else:
+        assert conv_type == 'factorized', "conv_type should be dense, separable or factorized. found: %s" % conv_type
+        block = []
+        for d in range(ndims):
+            kernel = [1] * ndims
+            kernel[d] = kernel_size
+            axis_strides = [1] * ndims
+            axis_strides[d] = strides
+            block.append(Conv(nf, kernel_size=kernel, padding='same',
+                              kernel_initializer='he_normal', strides=axis_strides))
+
+    return block + [LeakyReLU(0.2)]
+
+
+def _call(layer, x):
+    return layer(x)
+
+
+def _sequential(apply, layers, x):
+    for layer in layers:
+        x = apply(layer, x)
+    return x
 
 
 def sample(args):
@@ -250,9 +352,9 @@ def sample(args):
     return z
 
 
-def interp_upsampling(V):
+def interp_upsampling(V, recompute=False):
     """ 
-    upsample a field by a factor of 2
+    upsample a field by a factor of 2 (with recompute, the interpolation is recomputed during backprop)
     TODO: should switch this to use neuron.utils.interpn()
     """
 
@@ -262,5 +364,5 @@ def interp_upsampling(V):
     offset = tf.stack(grid, len(grid) + 1)
 
     # V = nrn_utils.transform(V, offset)
-    V = nrn_layers.SpatialTransformer(interp_method='linear')([V, offset])
+    V = nrn_layers.SpatialTransformer(interp_method='linear', recompute=recompute)([V, offset])
     return V
@@ -0,0 +1,401 @@
+"""
+pure NumPy inference of trained VoxelMorph models (cvpr2018_net and miccai2018_net),
+without tensorflow or keras
+
+the keras h5 weights (of model.save or model.save_weights) are read with h5py, the 3x3x3
+convolutions run as blocked im2col + GEMM (so they use numpy's multi-threaded BLAS) and the
+spatial transform reproduces neuron.utils.transform ('ij' indexing). E.g.:
+    python npinfer.py ../models/cvpr2018_vm1_cc.h5 moving.npz atlas.npz --out_flow flow.npz
+
+BLAS threads are set with --nb_threads (needs threadpoolctl) or the OMP_NUM_THREADS /
+OPENBLAS_NUM_THREADS / MKL_NUM_THREADS environment variables.
+"""
+
+# python imports
+import sys
+import time
+import itertools
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+import h5py
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+###############################################################################
+# weights
+###############################################################################
+
+def load_weights(filename):
+    """
+    the weights of a keras h5 file (saved model or weights), in the model's layer order
+
+    Returns:
+        list of (layer name, [weight arrays]) for the layers with weights
+    """
+    layers = []
+    with h5py.File(filename, 'r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+        for name in f.attrs['layer_names']:
+            name = name.decode('utf8') if isinstance(name, bytes) else name
+            group = f[name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n
+                            for n in group.attrs['weight_names']]
+            if len(weight_names) > 0:
+                layers.append((name, [np.asarray(group[w], dtype='float32') for w in weight_names]))
+    return layers
+
+
+###############################################################################
+# layers
+###############################################################################
+
+def conv(x, kernel, bias, strides=1, block_bytes=2**26, in_scales=None):
+    """
+    'same' convolution of x [*vol_shape, C] with kernel [*kernel_size, C, F] (tensorflow's
+    padding for strides > 1), as im2col + GEMM over blocks of the first axis, so that the
+    column buffer stays under about block_bytes. x can be int8 with per channel scales
+    in_scales [C], which are folded into the kernel.
+
+    Returns:
+        [*out_shape, F] array
+    """
+    ndims = x.ndim - 1
+    kernel_size = kernel.shape[:ndims]
+    nb_feats = kernel.shape[-1]
+    in_shape = x.shape[:ndims]
+    out_shape = [int(np.ceil(n / strides)) for n in in_shape]
+
+    pads = []
+    for n, o, k in zip(in_shape, out_shape, kernel_size):
+        total = max((o - 1) * strides + k - n, 0)
+        pads.append((total // 2, total - total // 2))
+    xp = np.pad(x, pads + [(0, 0)], mode='constant')
+
+    nb_in = x.shape[-1]
+    nb_cols = int(np.prod(kernel_size)) * nb_in
+    if in_scales is not None:
+        kernel = kernel * in_scales[:, np.newaxis]
+    weights = kernel.reshape(nb_cols, nb_feats)
+    out = np.empty(out_shape + [nb_feats], dtype='float32')
+
+    # rows of the first axis per block
+    row_bytes = int(np.prod(out_shape[1:])) * nb_cols * 4
+    block = int(max(1, min(out_shape[0], block_bytes // row_bytes)))
+    cols = np.empty([block] + out_shape[1:] + [nb_cols], dtype='float32')
+    offsets = list(itertools.product(*[range(k) for k in kernel_size]))
+
+    for start in range(0, out_shape[0], block):
+        end = min(start + block, out_shape[0])
+        block_cols = cols[:end - start]
+        for i, offset in enumerate(offsets):
+            slices = [slice(start * strides + offset[0], (end - 1) * strides + offset[0] + 1, strides)]
+            slices += [slice(o, (n - 1) * strides + o + 1, strides) for o, n in zip(offset[1:], out_shape[1:])]
+            block_cols[..., i * nb_in:(i + 1) * nb_in] = xp[tuple(slices)]
+        block_out = out[start:end].reshape(-1, nb_feats)
+        np.matmul(block_cols.reshape(-1, nb_cols), weights, out=block_out)
+        block_out += bias
+    return out
+
+
+def leaky_relu(x, alpha=0.2):
+    """ in place LeakyReLU """
+    return np.maximum(x, alpha * x, out=x)
+
+
+def upsample(x, factor=2):
+    """ nearest neighbour upsampling of [*vol_shape, C], as keras' UpSamplingND """
+    for d in range(x.ndim - 1):
+        x = x.repeat(factor, axis=d)
+    return x
+
+
+def transform(vol, loc_shift, interp_method='linear', block_size=16):
+    """
+    warp vol [*vol_shape, C] (or [*vol_shape]) at the locations grid + loc_shift
+    [*vol_shape, ndims], as neuron.utils.transform with 'ij' indexing: linear weights
+    use the clipped floor and ceiling locations, nearest rounds and clips. The output is
+    computed in blocks of block_size rows of the first axis, to bound the temporaries.
+
+    Returns:
+        [*vol_shape, C] array
+    """
+    vol_shape = loc_shift.shape[:-1]
+    ndims = len(vol_shape)
+    if vol.ndim == ndims:
+        vol = vol[..., np.newaxis]
+    src_shape = vol.shape[:-1]
+    max_loc = [d - 1 for d in src_shape]
+    vol_flat = vol.reshape(-1, vol.shape[-1])
+
+    dtype = vol.dtype if interp_method == 'nearest' else 'float32'
+    interp_vol = np.zeros(tuple(vol_shape) + (vol.shape[-1],), dtype=dtype)
+    for start in range(0, vol_shape[0], block_size):
+        end = min(start + block_size, vol_shape[0])
+        ranges = [np.arange(start, end, dtype='float32')] + [np.arange(d, dtype='float32') for d in vol_shape[1:]]
+        mesh = np.meshgrid(*ranges, indexing='ij')
+        loc = [mesh[d] + loc_shift[start:end, ..., d] for d in range(ndims)]
+        out = interp_vol[start:end]
+
+        if interp_method == 'nearest':
+            subs = [np.clip(np.round(loc[d]), 0, max_loc[d]).astype('int64') for d in range(ndims)]
+            out[...] = vol_flat[np.ravel_multi_index(subs, src_shape)]
+            continue
+
+        assert interp_method == 'linear', 'interp_method should be linear or nearest'
+        loc0 = [np.clip(np.floor(loc[d]), 0, max_loc[d]) for d in range(ndims)]
+        loc1 = [np.clip(loc0[d] + 1, 0, max_loc[d]) for d in range(ndims)]
+        diff_loc1 = [loc1[d] - loc[d] for d in range(ndims)]
+        weights_loc = [diff_loc1, [1 - w for w in diff_loc1]]
+        locs = [[l.astype('int64') for l in loc0], [l.astype('int64') for l in loc1]]
+
+        for c in itertools.product([0, 1], repeat=ndims):
+            idx = np.ravel_multi_index([locs[c[d]][d] for d in range(ndims)], src_shape)
+            wt = weights_loc[c[0]][0].copy()
+            for d in range(1, ndims):
+                wt *= weights_loc[c[d]][d]
+            out += wt[..., np.newaxis] * vol_flat[idx]
+    return interp_vol
+
+
+###############################################################################
+# network
+###############################################################################
+
+class UNet():
+    """
+    NumPy version of networks.unet_core with the weights of a keras h5 file (see
+    load_weights): 4 stride-2 encoder convolutions and the decoder convolutions
+
+    The encoder outputs (kept for the skip connections) and the decoder activations go
+    through _keep: with act_scales (see quantize.py) they are stored as int8, and stay int8
+    through the upsampling and concatenations into the next convolution. An observer
+    function(name, activation) can be set to look at them (e.g. to calibrate).
+    """
+
+    head_names = []
+
+    def __init__(self, weights, act_scales=None, block_bytes=2**26):
+        """
+        Parameters:
+            weights: keras h5 file, or list of (layer name, [kernel, bias]) as load_weights
+            act_scales: optional dict of activation name: int8 scale
+            block_bytes: size of the im2col blocks (see conv)
+        """
+        layers = load_weights(weights) if isinstance(weights, str) else weights
+        names = [name for name, _ in layers]
+        for name in self.head_names:
+            assert name in names, 'no %s layer, found layers %s' % (name, names)
+        self.heads = {name: w for name, w in layers if name in self.head_names}
+        convs = [w for name, w in layers if name not in self.head_names]
+        self.enc_layers = convs[:4]
+        self.dec_layers = convs[4:]
+        self.act_scales = act_scales
+        self.block_bytes = block_bytes
+        self.observer = None
+
+    def _check_decoder(self, full_size):
+        """ check the skip connections' channels against the kernels """
+        enc_nf = [k.shape[-1] for k, _ in self.enc_layers]
+        dec_in = [k.shape[-2] for k, _ in self.dec_layers]
+        dec_nf = [k.shape[-1] for k, _ in self.dec_layers]
+        expected = [enc_nf[3], dec_nf[0] + enc_nf[2], dec_nf[1] + enc_nf[1], dec_nf[2] + enc_nf[0], dec_nf[3]]
+        if full_size:
+            expected += [dec_nf[4] + 2] + dec_nf[5:6]
+        assert dec_in == expected[:len(dec_in)] and len(dec_in) >= len(expected) - 1, \
+            'decoder inputs %s do not match unet_core (expected %s)' % (dec_in, expected)
+
+    def _conv(self, x, layer, strides=1):
+        if isinstance(x, tuple):
+            # int8 input: its per channel scales are folded into the kernel
+            return conv(x[0], layer[0], layer[1], strides=strides, block_bytes=self.block_bytes,
+                        in_scales=x[1])
+        return conv(x, layer[0], layer[1], strides=strides, block_bytes=self.block_bytes)
+
+    def _keep(self, x, name):
+        """ store activation x (named by its layer): as is, or as (int8 values, per channel scales) """
+        if self.observer is not None:
+            self.observer(name, x)
+        if self.act_scales is None:
+            return x
+        # in place, x is not used after _keep
+        scale = self.act_scales[name]
+        x = np.divide(x, scale, out=x if x.dtype == np.float32 else None)
+        np.clip(np.round(x, out=x), -127, 127, out=x)
+        return (x.astype('int8'), np.full(x.shape[-1], scale, dtype='float32'))
+
+    def _use(self, x):
+        """ float32 activation of a stored (_keep) activation """
+        if isinstance(x, tuple):
+            return x[0].astype('float32') * x[1]
+        return x
+
+    def _upsample(self, x):
+        if isinstance(x, tuple):
+            return (upsample(x[0]), x[1])
+        return upsample(x)
+
+    def _concat(self, xs):
+        if all(isinstance(x, tuple) for x in xs):
+            return (np.concatenate([x[0] for x in xs], -1), np.concatenate([x[1] for x in xs]))
+        return np.concatenate([self._use(x) for x in xs], -1)
+
+    def unet(self, x_in, full_size=True):
+        """ the unet_core output for input [*vol_shape, 2], as stored by _keep """
+        x_enc = [self._keep(x_in, 'input')]
+        for i, layer in enumerate(self.enc_layers):
+            x_enc.append(self._keep(leaky_relu(self._conv(x_enc[-1], layer, strides=2)), 'enc%d' % i))
+
+        dec = self.dec_layers
+        x = self._keep(leaky_relu(self._conv(x_enc[-1], dec[0])), 'dec0')
+        for i, skip in zip([1, 2, 3], [x_enc[-2], x_enc[-3], x_enc[-4]]):
+            x = self._concat([self._upsample(x), skip])
+            x = self._keep(leaky_relu(self._conv(x, dec[i])), 'dec%d' % i)
+        x = self._keep(leaky_relu(self._conv(x, dec[4])), 'dec4')
+
+        # only upsample to full dim if full_size
+        if full_size:
+            x = self._concat([self._upsample(x), x_enc[0]])
+            x = self._keep(leaky_relu(self._conv(x, dec[5])), 'dec5')
+
+        # optional convolution at output resolution (used in voxelmorph-2)
+        if len(dec) == 7:
+            x = self._keep(leaky_relu(self._conv(x, dec[6])), 'dec6')
+        return x
+
+    def predict(self, inputs):
+        """
+        [src, tgt] batches -> [warped src, flow] batches, registered pair by pair with the
+        subclass' register(src, tgt): warped src [*vol_shape, 1] and flow [*vol_shape, ndims]
+        of one pair of [*vol_shape, 1] volumes
+        """
+        src, tgt = inputs
+        outputs = [self.register(src[b], tgt[b]) for b in range(src.shape[0])]
+        return [np.stack([o[0] for o in outputs], 0), np.stack([o[1] for o in outputs], 0)]
+
+
+class CVPR2018Net(UNet):
+    """
+    NumPy version of networks.cvpr2018_net (full_size, 'ij' indexing): 6 (vm1) or 7 (vm2)
+    decoder convolutions, and the 'flow' convolution
+
+    Use:
+        net = CVPR2018Net('../models/cvpr2018_vm1_cc.h5')
+        warped, flow = net.predict([moving, atlas])
+    """
+
+    head_names = ['flow']
+
+    def __init__(self, weights, **kwargs):
+        super(CVPR2018Net, self).__init__(weights, **kwargs)
+        assert len(self.dec_layers) in [6, 7], \
+            'expected the 6 (vm1) or 7 (vm2) decoder convolutions of cvpr2018_net, found %d' % len(self.dec_layers)
+        self._check_decoder(full_size=True)
+
+    def register(self, src, tgt):
+        x = self.unet(np.concatenate([src, tgt], -1).astype('float32'), full_size=True)
+        flow = self._conv(x, self.heads['flow'])
+        return transform(src.astype('float32'), flow), flow
+
+
+class MICCAI2018Net(UNet):
+    """
+    NumPy version of networks.miccai2018_net ('ij' indexing, use_miccai_int=False): the half
+    resolution unet, the velocity mean ('flow') and log sigma convolutions, scaling and
+    squaring integration, and the upsampling of the field to full resolution. The flow is
+    that of the 'diffflow' layer (as used by test_miccai2018.py), integrated from the
+    velocity mean, or from a sample of the velocity if sample is True.
+    """
+
+    head_names = ['flow', 'log_sigma']
+
+    def __init__(self, weights, int_steps=7, sample=False, **kwargs):
+        super(MICCAI2018Net, self).__init__(weights, **kwargs)
+        assert len(self.dec_layers) == 5, \
+            'expected the 5 decoder convolutions of miccai2018_net, found %d' % len(self.dec_layers)
+        self._check_decoder(full_size=False)
+        self.int_steps = int_steps
+        self.sample = sample
+
+    def register(self, src, tgt):
+        x = self.unet(np.concatenate([src, tgt], -1).astype('float32'), full_size=False)
+        vel = self._conv(x, self.heads['flow'])
+        if self.sample:
+            log_sigma = self._conv(x, self.heads['log_sigma'])
+            vel += np.exp(log_sigma / 2) * np.random.randn(*vel.shape).astype('float32')
+        flow = 2 * upsample_field(integrate_ss(vel, self.int_steps))
+        return transform(src.astype('float32'), flow), flow
+
+
+def integrate_ss(vec, nb_steps=7):
+    """ scaling and squaring integration of a stationary field, as neuron.utils.integrate_vec """
+    vec = vec / (2 ** nb_steps)
+    for _ in range(nb_steps):
+        vec += transform(vec, vec)
+    return vec
+
+
+def upsample_field(vec):
+    """ linear upsampling of a field by 2, as networks.interp_upsampling (the values are not scaled) """
+    vol_shape = [2 * d for d in vec.shape[:-1]]
+    grid = np.meshgrid(*[np.arange(d, dtype='float32') for d in vol_shape], indexing='ij')
+    offset = np.stack([f / 2 - f for f in grid], -1)
+    return transform(vec, offset)
+
+
+def load_net(weights, **kwargs):
+    """ CVPR2018Net or MICCAI2018Net (if the weights have a log_sigma layer) of an h5 file """
+    layers = load_weights(weights) if isinstance(weights, str) else weights
+    if 'log_sigma' in [name for name, _ in layers]:
+        return MICCAI2018Net(layers, **kwargs)
+    return CVPR2018Net(layers, **kwargs)
+
+
+def _load_vol(filename):
+    """ [*vol_shape, 1] volume of an npz file (vol_data or vol), as datagenerators.load_volfile """
+    npz = np.load(filename)
+    key = 'vol_data' if 'vol_data' in npz else 'vol'
+    return npz[key][..., np.newaxis].astype('float32')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("model_file", type=str, help="keras h5 weights of a cvpr2018_net or miccai2018_net")
+    parser.add_argument("moving_file", type=str, help="moving volume (npz)")
+    parser.add_argument("fixed_file", type=str, help="fixed (atlas) volume (npz)")
+    parser.add_argument("--moving_seg", type=str,
+                        dest="moving_seg", default=None,
+                        help="optional moving segmentation (npz) to warp")
+    parser.add_argument("--out_flow", type=str,
+                        dest="out_flow", default=None,
+                        help="output npz with the flow, warped volume and warped segmentation")
+    parser.add_argument("--nb_threads", type=int,
+                        dest="nb_threads", default=None,
+                        help="number of BLAS threads (needs threadpoolctl)")
+
+    args = parser.parse_args()
+    if args.nb_threads is not None:
+        if threadpool_limits is None:
+            sys.exit('--nb_threads needs threadpoolctl, or set OMP_NUM_THREADS')
+        threadpool_limits(args.nb_threads)
+
+    tstart = time.perf_counter()
+    net = load_net(args.model_file)
+    moving, fixed = _load_vol(args.moving_file), _load_vol(args.fixed_file)
+    print('load: %.3f sec' % (time.perf_counter() - tstart))
+
+    tstart = time.perf_counter()
+    warped, flow = net.register(moving, fixed)
+    print('register: %.3f sec' % (time.perf_counter() - tstart))
+
+    outputs = {'flow': flow, 'warped': warped[..., 0]}
+    if args.moving_seg is not None:
+        outputs['warped_seg'] = transform(_load_vol(args.moving_seg), flow, interp_method='nearest')[..., 0]
+    if args.out_flow is not None:
+        np.savez_compressed(args.out_flow, **outputs)
@@ -0,0 +1,227 @@
+"""
+multi-process CPU data-parallel training for VoxelMorph
+
+N processes (on one host, or several hosts that can reach the first one) each train the
+model on their shard of the data (see datagenerators.EpochSampler) and average their
+gradients, or periodically their weights, with an allreduce over sockets.
+
+launch, e.g. with 4 processes on this host:
+    python parallel.py --nb_procs 4 -- train.py /my/path/to/data --model_dir /my/models
+
+each process is started as
+    train.py <args> --rank r --nb_procs N --master host:port
+"""
+
+# python imports
+import os
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing.connection import Listener, Client
+
+# third-party imports
+import numpy as np
+
+
+class SocketAllreduce():
+    """
+    allreduce (average) of lists of float32 arrays across nb_procs processes.
+
+    rank 0 listens on the master address and every other rank connects to it. Arrays are
+    sent as a single flat buffer (no pickling of the arrays), summed on rank 0 and the mean is
+    sent back (star topology, which is enough for the handful of processes of a CPU node).
+
+    The time spent in allreduce calls is accumulated in comm_time.
+    """
+
+    def __init__(self, rank, nb_procs, master='localhost:29500', authkey=b'voxelmorph', timeout=600):
+        self.rank = rank
+        self.nb_procs = nb_procs
+        self.comm_time = 0
+        self.nb_calls = 0
+
+        host, port = master.rsplit(':', 1)
+        address = (host, int(port))
+        self.conns = []
+        if nb_procs == 1:
+            return
+
+        if rank == 0:
+            listener = Listener(address, authkey=authkey)
+            conns = {}
+            while len(conns) < nb_procs - 1:
+                conn = listener.accept()
+                conns[conn.recv()] = conn
+            self.conns = [conns[r] for r in sorted(conns.keys())]
+            listener.close()
+
+        else:
+            # the master may not be up yet
+            tstart = time.time()
+            while True:
+                try:
+                    conn = Client(address, authkey=authkey)
+                    break
+                except ConnectionRefusedError:
+                    if time.time() - tstart > timeout:
+                        raise
+                    time.sleep(0.5)
+            conn.send(rank)
+            self.conns = [conn]
+
+    def allreduce(self, arrays):
+        """ average a list of arrays across processes. Returns a list of float32 arrays """
+        tstart = time.perf_counter()
+        flat = np.concatenate([np.asarray(a, 'float32').ravel() for a in arrays]) \
+            if len(arrays) > 0 else np.zeros(0, 'float32')
+
+        if self.nb_procs > 1:
+            if self.rank == 0:
+                total = flat.copy()
+                for conn in self.conns:
+                    total += np.frombuffer(conn.recv_bytes(), 'float32')
+                total /= self.nb_procs
+                for conn in self.conns:
+                    conn.send_bytes(total)
+                flat = total
+            else:
+                self.conns[0].send_bytes(flat)
+                flat = np.frombuffer(self.conns[0].recv_bytes(), 'float32')
+
+        out = []
+        pos = 0
+        for a in arrays:
+            size = int(np.prod(np.shape(a)))
+            out.append(flat[pos:pos + size].reshape(np.shape(a)))
+            pos += size
+
+        self.comm_time += time.perf_counter() - tstart
+        self.nb_calls += 1
+        return out
+
+    def broadcast(self, arrays):
+        """ send rank 0's arrays to all processes """
+        if self.nb_procs == 1:
+            return [np.asarray(a, 'float32') for a in arrays]
+        # an allreduce of (rank 0's arrays, zeros elsewhere) * nb_procs
+        if self.rank != 0:
+            arrays = [np.zeros(np.shape(a), 'float32') for a in arrays]
+        return [a * self.nb_procs for a in self.allreduce(arrays)]
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+
+
+def allreduce_optimizer(optimizer, comm):
+    """
+    make a keras optimizer average its gradients across processes before applying them,
+    by wrapping its get_gradients with an in-graph call to comm.allreduce.
+    All processes then apply identical updates (starting from broadcast weights).
+    """
+    import tensorflow as tf
+
+    get_gradients = optimizer.get_gradients
+
+    def allreduce_gradients(loss, params):
+        grads = get_gradients(loss, params)
+        avg_grads = tf.py_func(lambda *g: comm.allreduce(g), grads, [tf.float32] * len(grads),
+                               stateful=True, name='allreduce_gradients')
+        for g, avg_g in zip(grads, avg_grads):
+            avg_g.set_shape(g.get_shape())
+        return avg_grads
+
+    optimizer.get_gradients = allreduce_gradients
+    return optimizer
+
+
+def parallel_callbacks(comm, batch_size, mode='grads', sync_every=1, baseline_examples_per_sec=None,
+                       verbose=True):
+    """
+    keras callbacks for data-parallel training: broadcast the initial weights,
+    average the weights every sync_every batches if mode is 'weights',
+    and report the throughput at the end of every epoch (on rank 0).
+
+    baseline_examples_per_sec is the throughput of one process training alone with the same
+    settings (e.g. a run with nb_procs=1, or bench_train.py's steps_per_sec * batch_size).
+    Only with it is the scaling efficiency reported.
+    """
+    import keras
+
+    class BroadcastWeights(keras.callbacks.Callback):
+        def on_train_begin(self, logs=None):
+            self.model.set_weights(comm.broadcast(self.model.get_weights()))
+
+    class AverageWeights(keras.callbacks.Callback):
+        def on_batch_end(self, batch, logs=None):
+            if np.mod(batch + 1, sync_every) == 0:
+                self.model.set_weights(comm.allreduce(self.model.get_weights()))
+
+    class ScalingReport(keras.callbacks.Callback):
+        """
+        examples_per_sec: the throughput of the N processes
+        comm_fraction: fraction of the epoch time spent in allreduce calls, averaged over
+            processes. It does not see the other scaling losses, e.g. the cores shared
+            between the processes of one host
+        scaling_efficiency (with baseline_examples_per_sec): the throughput of the N
+            processes relative to N times the throughput of one process
+        """
+        def on_epoch_begin(self, epoch, logs=None):
+            self.tstart = time.perf_counter()
+            self.comm_start = comm.comm_time
+            self.nb_steps = 0
+
+        def on_batch_end(self, batch, logs=None):
+            self.nb_steps += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch_time = time.perf_counter() - self.tstart
+            comm_time = comm.comm_time - self.comm_start
+            stats = comm.allreduce([np.array([epoch_time, comm_time])])[0]
+            comm_fraction = stats[1] / stats[0]
+            throughput = comm.nb_procs * self.nb_steps * batch_size / stats[0]
+            logs = logs if logs is not None else {}
+            logs['comm_fraction'] = comm_fraction
+            logs['examples_per_sec'] = throughput
+            msg = '%d processes: %.2f examples/s, %.1f%% of epoch time in allreduce' % \
+                (comm.nb_procs, throughput, 100 * comm_fraction)
+            if baseline_examples_per_sec is not None:
+                logs['scaling_efficiency'] = throughput / (comm.nb_procs * baseline_examples_per_sec)
+                msg += ', scaling efficiency %.3f' % logs['scaling_efficiency']
+            if verbose and comm.rank == 0:
+                print(msg)
+
+    callbacks = [BroadcastWeights()]
+    if mode == 'weights':
+        callbacks.append(AverageWeights())
+    callbacks.append(ScalingReport())
+    return callbacks
+
+
+def launch(script_args, nb_procs, master='localhost:29500'):
+    """ run nb_procs copies of a training script on this host, and wait for them """
+    procs = []
+    for rank in range(nb_procs):
+        cmd = [sys.executable, *script_args,
+               '--rank', str(rank), '--nb_procs', str(nb_procs), '--master', master]
+        procs.append(subprocess.Popen(cmd, env=os.environ.copy()))
+
+    return_codes = [p.wait() for p in procs]
+    return max(return_codes)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--nb_procs", type=int,
+                        dest="nb_procs", default=2,
+                        help="number of processes")
+    parser.add_argument("--master", type=str,
+                        dest="master", default='localhost:29500',
+                        help="address of the rank 0 process")
+    parser.add_argument("script_args", nargs='+',
+                        help="training script and its arguments")
+
+    args = parser.parse_args()
+    sys.exit(launch(args.script_args, args.nb_procs, args.master))
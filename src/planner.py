@@ -0,0 +1,302 @@
+"""
+memory and compute planner for the VoxelMorph networks
+
+walks the keras graph of cvpr2018_net (vm1, vm2, vm2double) or miccai2018_net for a volume
+size, and reports per layer: activation memory, parameter memory, float operations and the
+temporary memory of the warp (SpatialTransformer), integration (VecInt) and resize layers.
+From these it predicts the peak inference and training memory, and the largest batch size
+that fits a memory budget, e.g.:
+    python planner.py --model vm2 --vol_size 160x192x224 --ram_gb 32
+With --checkpoint, the layers recomputed in backprop (gradient checkpointing) are marked with a
+*, and the training memory and compute are compared to those without recomputation.
+
+The estimates are analytic (float32, no framework overhead or fragmentation), so keep a margin;
+bench_train.py measures the actual peak resident memory of a configuration.
+"""
+
+# python imports
+import os
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+# project imports
+import benchtools
+
+
+def build_net(model, vol_size, bidir=False, checkpoint=()):
+    """
+    the network of the train scripts for model (vm1, vm2, vm2double or miccai2018), with the
+    checkpoint segments recomputed in backprop (see networks.cvpr2018_net, miccai2018_net)
+    """
+    import networks
+
+    if model == 'miccai2018':
+        nf_enc = [16, 32, 32, 32]
+        nf_dec = [32, 32, 32, 32, 16, 3]
+        return networks.miccai2018_net(vol_size, nf_enc, nf_dec, bidir=bidir, checkpoint=checkpoint)
+
+    nf_enc = [16, 32, 32, 32]
+    if model == 'vm1':
+        nf_dec = [32, 32, 32, 32, 8, 8]
+    elif model == 'vm2':
+        nf_dec = [32, 32, 32, 32, 32, 16, 16]
+    else:  # 'vm2double'
+        nf_enc = [f * 2 for f in nf_enc]
+        nf_dec = [f * 2 for f in [32, 32, 32, 32, 32, 16, 16]]
+    return networks.cvpr2018_net(vol_size, nf_enc, nf_dec, checkpoint=checkpoint)
+
+
+###############################################################################
+# per layer costs (per example)
+###############################################################################
+
+def conv_flops(out_shape, kernel_size, nb_in, nb_out):
+    """ multiply-adds (x2) and bias adds of a convolution with output shape [*vol, nb_out] """
+    nb_vox = np.prod(out_shape[:-1])
+    return int(nb_vox * nb_out * (2 * np.prod(kernel_size) * nb_in + 1))
+
+
+def warp_cost(vol_shape, nb_feats, interp_method='linear'):
+    """
+    float operations and temporary elements of warping a [*vol_shape, nb_feats] volume
+    (neuron.utils.transform / interpn): the sample locations, and per interpolation corner
+    the indices, weights and gathered values
+
+    Returns:
+        (flops, temporary elements)
+    """
+    ndims = len(vol_shape)
+    nb_vox = np.prod(vol_shape)
+    nb_corners = 2 ** ndims if interp_method == 'linear' else 1
+    flops = nb_vox * (ndims + nb_corners * (2 * ndims + 2 * nb_feats))
+    temp = nb_vox * (ndims + nb_corners * (2 + nb_feats))
+    return int(flops), int(temp)
+
+
+def integrate_cost(vol_shape, int_steps):
+    """ (flops, temporary elements) of scaling and squaring a [*vol_shape, ndims] field """
+    ndims = len(vol_shape)
+    flops, temp = warp_cost(vol_shape, ndims)
+    nb_elems = np.prod(vol_shape) * ndims
+    # each step warps the field by itself and adds; the steps' fields are kept for the gradients
+    return int(int_steps * (flops + nb_elems)), int(temp + int_steps * nb_elems)
+
+
+def layer_cost(layer):
+    """
+    per example cost of a keras layer
+
+    Returns:
+        dict with name, type, shape (output, without batch), act (output elements),
+        params, flops, temp (temporary elements while the layer runs), recompute (whether
+        the temporaries are recomputed in backprop) and kept (the temporary elements kept
+        for backprop)
+    """
+    shape = layer.output_shape
+    shape = shape[0] if isinstance(shape, list) else shape
+    shape = tuple(shape[1:])
+    in_shapes = layer.input_shape if isinstance(layer.input_shape, list) else [layer.input_shape]
+    cls = layer.__class__.__name__
+
+    if cls == 'Recompute':
+        # the block's layers: their outputs, except the last, are the temporaries
+        costs = [_op_cost(sub, sub_in if isinstance(sub_in, list) else [sub_in], tuple(sub_out[1:]))
+                 for sub, sub_in, sub_out in layer.block_shapes]
+        flops = sum(c[0] for c in costs)
+        temp = sum(c[1] for c in costs) + sum(int(np.prod(sub_out[1:])) for _, _, sub_out in layer.block_shapes[:-1])
+        recompute = True
+    else:
+        flops, temp = _op_cost(layer, in_shapes, shape)
+        recompute = getattr(layer, 'recompute', False) or \
+            getattr(layer, 'arguments', None) is not None and layer.arguments.get('recompute', False)
+
+    kept = 0 if recompute else temp
+    if cls == 'VecInt' and recompute:
+        # the fields of the integration steps are kept, their warps are recomputed
+        kept = layer.int_steps * int(np.prod(shape))
+
+    return {'name': layer.name, 'type': cls, 'shape': shape, 'act': int(np.prod(shape)),
+            'params': int(layer.count_params()), 'flops': int(flops), 'temp': int(temp),
+            'recompute': bool(recompute), 'kept': int(kept)}
+
+
+def _op_cost(layer, in_shapes, shape):
+    """ (flops, temporary elements) of a layer with input shapes in_shapes and output shape (without batch) """
+    cls = layer.__class__.__name__
+    flops, temp = 0, 0
+    if cls.startswith('Conv'):
+        flops = conv_flops(shape, layer.kernel_size, in_shapes[0][-1], layer.filters)
+    elif cls.startswith('DepthwiseConv'):
+        # one kernel per channel
+        flops = conv_flops(shape, layer.kernel_size, 1, shape[-1])
+    elif cls == 'SpatialTransformer':
+        flops, temp = warp_cost(shape[:-1], shape[-1], layer.interp_method)
+    elif cls == 'VecInt':
+        flops, temp = integrate_cost(shape[:-1], layer.int_steps)
+    elif cls == 'Lambda' and getattr(layer.function, '__name__', '') == 'interp_upsampling':
+        flops, temp = warp_cost(shape[:-1], shape[-1])
+    elif cls not in ['InputLayer', 'Concatenate', 'Reshape']:
+        # activations, upsampling, adds, sampling: about one operation per output element
+        flops = np.prod(shape)
+    return int(flops), int(temp)
+
+
+###############################################################################
+# plan
+###############################################################################
+
+def plan(model, batch_size=1, optimizer_slots=2, bytes_per_elem=4):
+    """
+    walk the model's graph and estimate its memory and compute
+
+    Inference keeps a tensor from the layer producing it to its last consumer (the skip
+    connections keep the encoder outputs), so its peak is the largest live set. Training
+    keeps all the activations and warp temporaries for the gradients, plus the weights,
+    their gradients and the optimizer slots (2 for Adam). The temporaries of recomputed
+    (checkpointed) layers are not kept: they are recomputed in backprop, one layer at a time,
+    at the cost of their forward flops.
+
+    Parameters:
+        model: keras model
+        batch_size: batch size of the summary
+        optimizer_slots: optimizer variables per weight
+        bytes_per_elem: 4 for float32
+
+    Returns:
+        rows (list of layer_cost dicts, with live: the live elements at that layer),
+        and a summary dict (bytes and flops, per example and for batch_size)
+    """
+    layers = model.layers
+    index = {layer.name: i for i, layer in enumerate(layers)}
+    rows = [layer_cost(layer) for layer in layers]
+
+    # last consumer of each layer's output, in model.layers (topological) order
+    last_use = list(range(len(layers)))
+    for i, layer in enumerate(layers):
+        for node in layer._inbound_nodes:
+            for inbound in node.inbound_layers:
+                if inbound.name in index:
+                    last_use[index[inbound.name]] = max(last_use[index[inbound.name]], i)
+    for output in model.outputs:
+        last_use[index[output._keras_history[0].name]] = len(layers) - 1
+
+    for i, row in enumerate(rows):
+        row['live'] = sum(rows[j]['act'] for j in range(i + 1) if last_use[j] >= i) + row['temp']
+
+    nb_params = sum(r['params'] for r in rows)
+    act_total = sum(r['act'] for r in rows)
+    saved = act_total + sum(r['kept'] for r in rows)
+    recomputed = max([r['temp'] for r in rows if r['recompute']] + [0])
+    fixed_infer = nb_params * bytes_per_elem
+    fixed_train = nb_params * (2 + optimizer_slots) * bytes_per_elem
+    per_example_infer = max(r['live'] for r in rows) * bytes_per_elem
+    # backward: the saved tensors, the largest recomputed temporaries, and the gradients of
+    # the largest layer's output and input
+    per_example_train = (saved + recomputed + 2 * max(r['act'] for r in rows)) * bytes_per_elem
+    flops = sum(r['flops'] for r in rows)
+    recompute_flops = sum(r['flops'] for r in rows if r['recompute'])
+
+    summary = {'batch_size': batch_size,
+               'nb_params': nb_params,
+               'param_bytes': fixed_infer,
+               'act_bytes_per_example': act_total * bytes_per_elem,
+               'fixed_infer_bytes': fixed_infer,
+               'fixed_train_bytes': fixed_train,
+               'infer_bytes_per_example': per_example_infer,
+               'train_bytes_per_example': per_example_train,
+               'peak_infer_bytes': fixed_infer + batch_size * per_example_infer,
+               'peak_train_bytes': fixed_train + batch_size * per_example_train,
+               'flops_per_example': flops,
+               'recompute_flops_per_example': recompute_flops,
+               'train_flops_per_example': 3 * flops + recompute_flops}
+    return rows, summary
+
+
+def max_batch_size(summary, budget_bytes, mode='train', margin=0.1):
+    """ largest batch size with a predicted peak memory under (1 - margin) * budget_bytes, or 0 """
+    fixed = summary['fixed_%s_bytes' % mode]
+    per_example = summary['%s_bytes_per_example' % mode]
+    return max(int(((1 - margin) * budget_bytes - fixed) // per_example), 0)
+
+
+def format_plan(rows, summary, budget_bytes=None, margin=0.1):
+    """ table of the layers, and the summary """
+    mb = 2 ** 20
+    lines = ['%-28s %-20s %-22s %10s %10s %12s %10s' %
+             ('layer', 'type', 'output', 'act MB', 'param MB', 'GFLOPs', 'temp MB')]
+    for r in rows:
+        lines.append('%-28s %-20s %-22s %10.1f %10.3f %12.3f %10.1f' %
+                     (r['name'][:28], (r['type'] + ('*' if r['recompute'] else ''))[:20],
+                      'x'.join(str(s) for s in r['shape']),
+                      4 * r['act'] / mb, 4 * r['params'] / mb, r['flops'] / 1e9, 4 * r['temp'] / mb))
+
+    lines.append('')
+    lines.append('parameters: %d (%.1f MB)' % (summary['nb_params'], summary['param_bytes'] / mb))
+    lines.append('forward: %.1f GFLOPs per example, training step: %.1f GFLOPs per example' %
+                 (summary['flops_per_example'] / 1e9, summary['train_flops_per_example'] / 1e9))
+    if summary['recompute_flops_per_example'] > 0:
+        lines.append('recomputed in backprop (*): %.1f GFLOPs per example' %
+                     (summary['recompute_flops_per_example'] / 1e9))
+    lines.append('per example: inference %.0f MB, training %.0f MB' %
+                 (summary['infer_bytes_per_example'] / mb, summary['train_bytes_per_example'] / mb))
+    lines.append('batch size %d: peak inference %.0f MB, peak training %.0f MB' %
+                 (summary['batch_size'], summary['peak_infer_bytes'] / mb, summary['peak_train_bytes'] / mb))
+    if budget_bytes is not None:
+        lines.append('budget %.1f GB (margin %d%%): largest training batch size %d, inference %d' %
+                     (budget_bytes / 2 ** 30, 100 * margin,
+                      max_batch_size(summary, budget_bytes, 'train', margin),
+                      max_batch_size(summary, budget_bytes, 'infer', margin)))
+    return '\n'.join(lines)
+
+
+def format_tradeoff(base, summary, checkpoint, budget_bytes=None, margin=0.1):
+    """ memory and compute of the checkpointed plan (summary) against the plain one (base) """
+    mb = 2 ** 20
+    lines = ['checkpointing %s: training memory %.0f -> %.0f MB per example (%.2fx), '
+             'training compute %.1f -> %.1f GFLOPs per example (+%.0f%%)' %
+             (', '.join(checkpoint), base['train_bytes_per_example'] / mb, summary['train_bytes_per_example'] / mb,
+              base['train_bytes_per_example'] / summary['train_bytes_per_example'],
+              base['train_flops_per_example'] / 1e9, summary['train_flops_per_example'] / 1e9,
+              100 * (summary['train_flops_per_example'] / base['train_flops_per_example'] - 1))]
+    if budget_bytes is not None:
+        lines.append('budget %.1f GB: largest training batch size %d -> %d' %
+                     (budget_bytes / 2 ** 30, max_batch_size(base, budget_bytes, 'train', margin),
+                      max_batch_size(summary, budget_bytes, 'train', margin)))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=str, dest="model",
+                        choices=['vm1', 'vm2', 'vm2double', 'miccai2018'], default='vm2',
+                        help="network to plan")
+    parser.add_argument("--vol_size", type=benchtools.parse_size,
+                        dest="vol_size", default=(160, 192, 224),
+                        help="volume size, e.g. 64 or 160x192x224")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=1,
+                        help="batch size of the summary")
+    parser.add_argument("--bidir", action="store_true",
+                        dest="bidir", default=False,
+                        help="bidirectional miccai2018 network")
+    parser.add_argument("--checkpoint", type=str, nargs='+',
+                        dest="checkpoint", default=[], choices=['head', 'warp', 'int'],
+                        help="segments recomputed in backprop, compared to no recomputation")
+    parser.add_argument("--ram_gb", type=float,
+                        dest="ram_gb", default=None,
+                        help="memory budget in GB, to recommend a batch size")
+    parser.add_argument("--margin", type=float,
+                        dest="margin", default=0.1,
+                        help="fraction of the budget kept free")
+
+    args = parser.parse_args()
+    net = build_net(args.model, tuple(args.vol_size), bidir=args.bidir, checkpoint=args.checkpoint)
+    rows, summary = plan(net, batch_size=args.batch_size)
+    budget = None if args.ram_gb is None else args.ram_gb * 2 ** 30
+    print(format_plan(rows, summary, budget_bytes=budget, margin=args.margin))
+    if len(args.checkpoint) > 0:
+        _, base = plan(build_net(args.model, tuple(args.vol_size), bidir=args.bidir), batch_size=args.batch_size)
+        print(format_tradeoff(base, summary, args.checkpoint, budget_bytes=budget, margin=args.margin))
@@ -0,0 +1,220 @@
+"""
+post-training int8 quantization of VoxelMorph models (cvpr2018_net and miccai2018_net)
+
+the convolution kernels of a keras h5 file are quantized to int8 with a (symmetric) scale per
+output channel, and the activation scales are calibrated by running the float model (see
+npinfer.py) on a few volumes. The int8 checkpoint runs with npinfer (load_quantized), with
+int8 weights and optionally int8 activations (the skip connections and decoder activations
+are then stored as int8). E.g.:
+    python quantize.py ../models/cvpr2018_vm1_cc.h5 cvpr2018_vm1_cc_int8.h5 \
+        --calib_files ../data/test_vol.npz --report
+
+--report compares the float and int8 paths on data/test_vol.npz / test_seg.npz: Dice, flow
+error, run time, peak memory and weight size.
+"""
+
+# python imports
+import os
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+# third-party imports
+import numpy as np
+import h5py
+import scipy.io as sio
+
+# project imports
+import npinfer
+sys.path.append('../ext/medipy-lib')
+from medipy.metrics import dice
+
+
+def quantize_kernel(kernel):
+    """
+    symmetric int8 quantization of a kernel [..., nb_in, nb_out], per output channel
+
+    Returns:
+        int8 kernel, and float32 scales [nb_out] (kernel ~= int8 kernel * scales)
+    """
+    max_abs = np.max(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0)
+    scales = np.maximum(max_abs, 1e-12) / 127
+    q = np.clip(np.round(kernel / scales), -127, 127).astype('int8')
+    return q, scales.astype('float32')
+
+
+def calibrate(layers, vol_files, atlas_file=None, percentile=99.99, nb_samples=2**20, seed=0):
+    """
+    int8 scales of the activations: the percentile of their absolute values, over the
+    registrations of vol_files to the atlas (or to themselves, without an atlas file)
+
+    Returns:
+        dict of activation name: scale
+    """
+    rng = np.random.RandomState(seed)
+    net = npinfer.load_net(layers)
+    ranges = {}
+
+    def observer(name, x):
+        x = x.ravel()
+        if x.size > nb_samples:
+            x = x[rng.randint(0, x.size, nb_samples)]
+        ranges[name] = max(ranges.get(name, 0), float(np.percentile(np.abs(x), percentile)))
+
+    net.observer = observer
+    for vol_file in vol_files:
+        moving = npinfer._load_vol(vol_file)
+        fixed = moving if atlas_file is None else npinfer._load_vol(atlas_file)
+        net.register(moving, fixed)
+    return {name: max(r, 1e-12) / 127 for name, r in ranges.items()}
+
+
+def save_quantized(filename, layers, act_scales=None):
+    """ int8 checkpoint: per layer, the int8 kernel, its scales and the float32 bias """
+    with h5py.File(filename, 'w') as f:
+        f.attrs['format'] = 'int8_per_channel'
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _ in layers]
+        for name, (kernel, bias) in layers:
+            q, scales = quantize_kernel(kernel)
+            group = f.create_group(name)
+            group.create_dataset('kernel', data=q)
+            group.create_dataset('kernel_scale', data=scales)
+            group.create_dataset('bias', data=bias)
+        if act_scales is not None:
+            names = sorted(act_scales.keys())
+            f.attrs['act_names'] = [n.encode('utf8') for n in names]
+            f.attrs['act_scales'] = np.array([act_scales[n] for n in names], dtype='float32')
+
+
+def load_quantized(filename):
+    """
+    the layers (dequantized to float32, as npinfer.load_weights) and activation scales
+    (or None) of an int8 checkpoint
+    """
+    layers = []
+    with h5py.File(filename, 'r') as f:
+        assert f.attrs.get('format') == 'int8_per_channel', '%s is not an int8 checkpoint' % filename
+        for name in f.attrs['layer_names']:
+            name = _str(name)
+            group = f[name]
+            kernel = group['kernel'][()].astype('float32') * group['kernel_scale'][()]
+            layers.append((name, [kernel, group['bias'][()]]))
+        act_scales = None
+        if 'act_names' in f.attrs:
+            act_scales = dict(zip([_str(n) for n in f.attrs['act_names']],
+                                  [float(s) for s in f.attrs['act_scales']]))
+    return layers, act_scales
+
+
+def quantize(model_file, out_file, calib_files=None, atlas_file=None, percentile=99.99):
+    """
+    quantize a keras h5 model to an int8 checkpoint
+
+    :param model_file: keras h5 weights of a cvpr2018_net or miccai2018_net
+    :param out_file: int8 checkpoint (h5)
+    :param calib_files: optional volume files (npz) to calibrate the activation scales
+    :param atlas_file: optional atlas the calibration volumes are registered to
+    :param percentile: percentile of the absolute activations mapped to 127
+    """
+    layers = npinfer.load_weights(model_file)
+    act_scales = None
+    if calib_files is not None and len(calib_files) > 0:
+        act_scales = calibrate(layers, calib_files, atlas_file=atlas_file, percentile=percentile)
+    save_quantized(out_file, layers, act_scales)
+    return layers, act_scales
+
+
+def _str(name):
+    """ h5 attribute string, as bytes or str depending on the h5py version """
+    return name.decode('utf8') if isinstance(name, bytes) else name
+
+
+def _run(net, moving, fixed):
+    """ register, with the run time and the peak numpy (python) memory """
+    tracemalloc.start()
+    try:
+        tstart = time.perf_counter()
+        warped, flow = net.register(moving, fixed)
+        elapsed = time.perf_counter() - tstart
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return flow, elapsed, peak
+
+
+def report(model_file, quant_file, vol_file='../data/test_vol.npz', seg_file='../data/test_seg.npz',
+           atlas_file=None, labels_file='../data/labels.mat', nb_runs=2):
+    """
+    compare the float model and the int8 checkpoint (int8 weights, and int8 weights and
+    activations if the checkpoint has activation scales): Dice of the warped segmentation
+    (against the atlas', if given, and against the float model's), flow error, time,
+    peak memory and weight size. The time is the fastest of nb_runs registrations.
+    """
+    labels = sio.loadmat(labels_file)['labels'][0]
+    moving = npinfer._load_vol(vol_file)
+    moving_seg = npinfer._load_vol(seg_file)
+    if atlas_file is not None:
+        atlas = np.load(atlas_file)
+        fixed, fixed_seg = atlas['vol'][..., np.newaxis].astype('float32'), atlas['seg']
+    else:
+        fixed, fixed_seg = moving, None
+
+    float_layers = npinfer.load_weights(model_file)
+    quant_layers, act_scales = load_quantized(quant_file)
+    float_bytes = sum(w.nbytes for _, ws in float_layers for w in ws)
+    quant_bytes = sum(w[0].size + 4 * (w[0].shape[-1] + w[1].size) for _, w in quant_layers)
+    print('weights: float32 %.2f MB, int8 %.2f MB (%.1fx smaller), files %.2f / %.2f MB' %
+          (float_bytes / 2**20, quant_bytes / 2**20, float_bytes / quant_bytes,
+           os.path.getsize(model_file) / 2**20, os.path.getsize(quant_file) / 2**20))
+
+    paths = [('float32', npinfer.load_net(float_layers)),
+             ('int8 weights', npinfer.load_net(quant_layers))]
+    if act_scales is not None:
+        paths.append(('int8 weights+acts', npinfer.load_net(quant_layers, act_scales=act_scales)))
+
+    results = []
+    for name, net in paths:
+        runs = [_run(net, moving, fixed) for _ in range(nb_runs)]
+        flow, peak = runs[0][0], runs[0][2]
+        elapsed = min(r[1] for r in runs)
+        warp_seg = npinfer.transform(moving_seg, flow, interp_method='nearest')[..., 0]
+        results.append({'name': name, 'flow': flow, 'warp_seg': warp_seg, 'time': elapsed, 'peak': peak})
+
+    ref = results[0]
+    print('%-18s %9s %9s %9s %10s %10s %10s' %
+          ('path', 'dice', 'dice_ref', 'flow_max', 'flow_mean', 'time (s)', 'peak MB'))
+    for r in results:
+        atlas_dice = np.mean(dice(r['warp_seg'], fixed_seg, labels=labels)) if fixed_seg is not None else np.nan
+        ref_dice = np.mean(dice(r['warp_seg'], ref['warp_seg'], labels=labels))
+        err = np.abs(r['flow'] - ref['flow'])
+        print('%-18s %9.4f %9.4f %9.4f %10.5f %10.2f %10.0f' %
+              (r['name'], atlas_dice, ref_dice, err.max(), err.mean(), r['time'], r['peak'] / 2**20))
+    for r in results[1:]:
+        print('%s: speedup %.2fx, peak memory %.2fx smaller' %
+              (r['name'], ref['time'] / r['time'], ref['peak'] / r['peak']))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("model_file", type=str, help="keras h5 weights of a cvpr2018_net or miccai2018_net")
+    parser.add_argument("out_file", type=str, help="int8 checkpoint (h5)")
+    parser.add_argument("--calib_files", type=str, nargs='+',
+                        dest="calib_files", default=None,
+                        help="volumes (npz) to calibrate the activation scales")
+    parser.add_argument("--atlas_file", type=str,
+                        dest="atlas_file", default=None,
+                        help="atlas (vol and seg) to register to, by default the volumes themselves")
+    parser.add_argument("--percentile", type=float,
+                        dest="percentile", default=99.99,
+                        help="percentile of the absolute activations mapped to 127")
+    parser.add_argument("--report", action="store_true",
+                        dest="report", default=False,
+                        help="compare the float and int8 models on data/test_vol.npz")
+
+    args = parser.parse_args()
+    quantize(args.model_file, args.out_file, calib_files=args.calib_files,
+             atlas_file=args.atlas_file, percentile=args.percentile)
+    if args.report:
+        report(args.model_file, args.out_file, atlas_file=args.atlas_file)
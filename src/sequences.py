@@ -0,0 +1,221 @@
+"""
+keras Sequence data sources for VoxelMorph
+
+RegistrationSequence maps a batch index deterministically to a batch, so it can be used
+by keras directly (e.g. with workers > 1). SharedMemoryLoader runs it in worker processes
+that write the batches into a ring of shared memory buffers (multiprocessing RawArrays),
+so that large volumes are never pickled between processes.
+"""
+
+# python imports
+import itertools
+import queue
+import multiprocessing as mp
+
+# third-party imports
+import numpy as np
+import keras
+
+# project imports
+import datagenerators
+import pytool.timer as timer
+
+
+class RegistrationSequence(keras.utils.Sequence):
+    """
+    atlas-based registration batches for the cvpr2018 or miccai2018 models.
+
+    The examples are drawn like datagenerators.EpochSampler: batch idx of epoch e holds
+    the draws [(e * len(self) + idx) * batch_size, ...) of the (seed, rank, nb_shards) sampler,
+    so the mapping from (epoch, idx) to a batch does not depend on which process computes it.
+    """
+
+    def __init__(self, vol_names, atlas_vol, batch_size=1, steps_per_epoch=None,
+                 model='cvpr2018', bidir=False, seed=0, rank=0, nb_shards=1, epoch=0,
+                 **load_kwargs):
+        """
+        Parameters:
+            vol_names: list of (sorted) filenames
+            atlas_vol: atlas volume of shape [1, *vol_shape, 1]
+            batch_size: batch size
+            steps_per_epoch: number of batches per epoch (default: one pass over this shard)
+            model: 'cvpr2018' or 'miccai2018', to format the outputs like cvpr2018_gen or miccai2018_gen
+            bidir: bidirectional miccai2018 outputs
+            seed, rank, nb_shards: see datagenerators.EpochSampler
+            epoch: initial epoch
+            **load_kwargs: arguments to datagenerators.load_volfile, e.g. pack_dtype or scale_factors
+        """
+        assert model in ['cvpr2018', 'miccai2018'], "unknown model %s" % model
+        self.vol_names = vol_names
+        self.batch_size = batch_size
+        self.model = model
+        self.bidir = bidir
+        self.epoch = epoch
+        self.load_kwargs = load_kwargs
+        self.sampler = datagenerators.EpochSampler(len(vol_names), seed=seed, rank=rank, nb_shards=nb_shards)
+        if steps_per_epoch is None:
+            steps_per_epoch = int(np.ceil(self.sampler.shard_len / batch_size))
+        self.steps_per_epoch = steps_per_epoch
+
+        self.atlas_vol_bs = np.repeat(atlas_vol, batch_size, axis=0).astype('float32')
+        volshape = atlas_vol.shape[1:-1]
+        self.zeros = np.zeros((batch_size, *volshape, len(volshape)), 'float32')
+        self._orders = {}
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __getitem__(self, idx):
+        return self.format_batch(self.load_batch(idx))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def batch_shape(self):
+        """ shape of the moving batch, the only part of a batch that changes """
+        return self.atlas_vol_bs.shape
+
+    def indices(self, idx, epoch=None):
+        """ example indices of batch idx in a given epoch (default: the current one) """
+        epoch = self.epoch if epoch is None else epoch
+        first = (epoch * self.steps_per_epoch + idx) * self.batch_size
+        idxes = np.zeros(self.batch_size, dtype=int)
+        for i in range(self.batch_size):
+            sampler_epoch, pos = divmod(first + i, self.sampler.shard_len)
+            if sampler_epoch not in self._orders:
+                self._orders = {sampler_epoch: self.sampler.epoch_order(sampler_epoch)}
+            idxes[i] = self._orders[sampler_epoch][pos]
+        return idxes
+
+    def load_batch(self, idx, epoch=None, out=None):
+        """
+        load the moving volumes of batch idx, as float32 [batch_size, *vol_shape, 1].
+        out optionally gives the array to write into (e.g. a shared memory buffer)
+        """
+        with timer.Timer('RegistrationSequence.load_batch', False):
+            vols = [datagenerators.load_volfile(self.vol_names[i], packed=True, **self.load_kwargs)
+                    for i in self.indices(idx, epoch)]
+            X = datagenerators.unpack_batch(vols)
+            if out is not None:
+                out[...] = X
+                X = out
+        return X
+
+    def format_batch(self, X):
+        """ model inputs and outputs for a moving batch X """
+        if self.model == 'miccai2018' and self.bidir:
+            return ([X, self.atlas_vol_bs], [self.atlas_vol_bs, X, self.zeros])
+        return ([X, self.atlas_vol_bs], [self.atlas_vol_bs, self.zeros])
+
+
+class SharedMemoryLoader():
+    """
+    multiprocess loader for a RegistrationSequence.
+
+    nb_workers processes load batches into a ring of nb_slots shared memory buffers. Only
+    (epoch, batch index, slot) tuples go through the queues, and batches are delivered in
+    index order, so training is deterministic whatever the number of workers.
+
+    generator() yields batches that are *views* into the shared buffers: a buffer is reused
+    once the next batch is requested. Use it with fit_generator(..., workers=0), so that keras
+    consumes each batch before asking for the next one.
+
+    While waiting for a batch, the workers are checked every poll_sec seconds: if one of them
+    died (e.g. killed when out of memory), a RuntimeError is raised rather than waiting forever.
+    """
+
+    def __init__(self, sequence, nb_workers=4, nb_slots=None, initial_epoch=0, poll_sec=10):
+        self.sequence = sequence
+        self.nb_workers = nb_workers
+        self.nb_slots = 2 * nb_workers if nb_slots is None else nb_slots
+        assert self.nb_slots >= 1, "need at least one slot"
+        self.initial_epoch = initial_epoch
+        self.poll_sec = poll_sec
+
+        # RawArrays can only be shared with the workers as Process arguments
+        self.shape = sequence.batch_shape()
+        self.arrays = [mp.RawArray('f', int(np.prod(self.shape))) for _ in range(self.nb_slots)]
+        self.buffers = [_as_batch(array, self.shape) for array in self.arrays]
+
+        self.task_queue = mp.Queue()
+        self.done_queue = mp.Queue()
+        self.workers = [mp.Process(target=_shm_worker,
+                                   args=(sequence, self.arrays, self.shape, self.task_queue, self.done_queue),
+                                   daemon=True)
+                        for _ in range(nb_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def generator(self):
+        """ infinite generator of batches, epoch after epoch """
+        nb_batches = len(self.sequence)
+        tasks = ((epoch, idx) for epoch in itertools.count(self.initial_epoch) for idx in range(nb_batches))
+        ready = {}  # (epoch, idx) -> slot
+        in_use = None
+
+        for slot in range(self.nb_slots):
+            self.task_queue.put((*next(tasks), slot))
+
+        for key in ((epoch, idx) for epoch in itertools.count(self.initial_epoch) for idx in range(nb_batches)):
+            # the previous batch has been consumed: recycle its slot
+            if in_use is not None:
+                self.task_queue.put((*next(tasks), in_use))
+
+            # the batches are loaded (and timed) in the workers: only the wait is timed here
+            with timer.Timer('SharedMemoryLoader wait', False):
+                while key not in ready:
+                    try:
+                        epoch, idx, slot, err = self.done_queue.get(timeout=self.poll_sec)
+                    except queue.Empty:
+                        self._check_workers(key)
+                        continue
+                    if err is not None:
+                        raise RuntimeError('SharedMemoryLoader worker failed on batch %d: %s' % (idx, err))
+                    ready[(epoch, idx)] = slot
+
+            in_use = ready.pop(key)
+            yield self.sequence.format_batch(self.buffers[in_use])
+
+    def _check_workers(self, key):
+        """ raise if a worker died while batch key = (epoch, idx) is pending """
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                raise RuntimeError('SharedMemoryLoader worker %d (pid %s) died with exit code %s '
+                                   'while batch %d of epoch %d was pending' %
+                                   (i, worker.pid, worker.exitcode, key[1], key[0]))
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.buffers = []
+        self.arrays = []
+
+    def __del__(self):
+        if len(self.workers) > 0:
+            self.close()
+
+
+def _as_batch(array, shape):
+    """ float32 numpy view of a RawArray """
+    return np.frombuffer(array, dtype='float32').reshape(shape)
+
+
+def _shm_worker(sequence, arrays, shape, task_queue, done_queue):
+    """ worker process of SharedMemoryLoader """
+    buffers = [_as_batch(array, shape) for array in arrays]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        epoch, idx, slot = task
+        try:
+            sequence.load_batch(idx, epoch=epoch, out=buffers[slot])
+            done_queue.put((epoch, idx, slot, None))
+        except Exception as e:
+            done_queue.put((epoch, idx, slot, repr(e)))
+
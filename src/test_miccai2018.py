@@ -22,6 +22,8 @@ import networks
 # import util
 from medipy.metrics import dice
 import datagenerators
+sys.path.append('../ext/neuron')
+import neuron.utils as nrn_utils
 
 # Test file and anatomical labels we want to evaluate
 test_brain_file = open('...path/here//test_examples.txt')
@@ -40,11 +42,15 @@ def test(gpu_id, model_dir, iter_num,
          vol_size=(160,192,224),
          nf_enc=[16,32,32,32],
          nf_dec=[32,32,32,32,16,3],
-         save_file=None):
+         save_file=None,
+         trace_dir=None):
     """
     test via segmetnation propagation
     works by iterating over some iamge files, registering them to atlas,
     propagating the warps, then computing Dice with atlas segmentations
+
+    trace_dir: optional directory to write a full tensorflow trace of the first
+    registration (flow prediction) to
     """  
 
     # GPU handling
@@ -80,7 +86,10 @@ def test(gpu_id, model_dir, iter_num,
 
         # predict transform
         with tf.device(gpu):
-            pred = diff_net.predict([X_vol, atlas_vol])
+            if trace_dir is not None and k == 0:
+                pred = nrn_utils.trace_predict(diff_net, [X_vol, atlas_vol], trace_dir, name='miccai2018')
+            else:
+                pred = diff_net.predict([X_vol, atlas_vol])
 
         # Warp segments with flow
         if compute_type == 'CPU':
@@ -100,6 +109,6 @@ def test(gpu_id, model_dir, iter_num,
 if __name__ == "__main__":
     """
     assuming the model is model_dir/iter_num.h5
-    python test_miccai2018.py gpu_id model_dir iter_num
+    python test_miccai2018.py gpu_id model_dir iter_num [trace_dir]
     """
-    test(sys.argv[1], sys.argv[2], sys.argv[3])
+    test(sys.argv[1], sys.argv[2], sys.argv[3], trace_dir=sys.argv[4] if len(sys.argv) > 4 else None)
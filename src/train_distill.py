@@ -0,0 +1,293 @@
+"""
+distill a VoxelMorph teacher (vm2, vm2double or miccai2018) into a small cvpr2018 student
+
+the student is trained with the usual image and smoothness losses, plus the mean squared
+difference between its flow and the teacher's (the 'flow' output of the cvpr2018 models, or
+'diffflow' of miccai2018), predicted on the fly on each training batch. The student has fewer
+filters (see STUDENTS) and optionally predicts its flow at half resolution (--half_res), which is
+then upsampled. After training, the student and teacher are compared on the validation subjects:
+inference time (speedup), Dice with the atlas segmentation (Dice gap) and flow difference, e.g.:
+    python train_distill.py /my/vols --teacher vm2 --teacher_file ../models/cvpr2018_vm2_l2.h5 \
+        --student small --half_res --val_list val_examples.txt --out distill.jsonl
+"""
+
+# python imports
+import os
+import glob
+import sys
+from argparse import ArgumentParser
+
+# third-party imports
+import tensorflow as tf
+import numpy as np
+import scipy.io as sio
+from keras.backend.tensorflow_backend import set_session
+from keras.models import Model
+from keras.layers import Lambda
+from keras.optimizers import Adam
+
+# project imports
+import benchtools
+import datagenerators
+import eval_checkpoints
+import networks
+import losses
+
+sys.path.append('../ext/neuron')
+sys.path.append('../ext/medipy-lib')
+import neuron.callbacks as nrn_gen
+from medipy.metrics import dice
+
+
+# student encoder and decoder filters (cvpr2018_net, 1x6 decoder)
+STUDENTS = {'vm1': ([16, 32, 32, 32], [32, 32, 32, 32, 8, 8]),
+            'small': ([8, 16, 16, 16], [16, 16, 16, 16, 8, 8]),
+            'tiny': ([4, 8, 8, 8], [8, 8, 8, 8, 4, 4])}
+
+
+def student_net(student, vol_size, half_res=False):
+    """ cvpr2018_net with the filters of STUDENTS[student], and a half resolution flow if half_res """
+    nf_enc, nf_dec = STUDENTS[student]
+    return networks.cvpr2018_net(vol_size, nf_enc, nf_dec, full_size=not half_res)
+
+
+def distill_model(net):
+    """
+    training model of a cvpr2018_net: [warped, flow, flow], the last output being matched to
+    the teacher's flow
+    """
+    y, flow = net.outputs
+    match = Lambda(lambda x: x, name='teacher_match')(flow)
+    return Model(inputs=net.inputs, outputs=[y, flow, match])
+
+
+def compare(teacher_net, student_net, val_data, atlas_vol, atlas_seg, labels, nb_repeats=5):
+    """
+    compare the student to the teacher on the validation subjects
+
+    Parameters:
+        teacher_net, student_net: [moving, atlas] -> flow models
+        val_data: list of (vol, seg) of the validation subjects, [1, *vol_size, 1]
+        atlas_vol, atlas_seg: atlas volume [1, *vol_size, 1] and segmentation [*vol_size]
+        labels: labels to compute Dice on
+        nb_repeats: timed predictions per model (on the first subject)
+
+    Returns:
+        dict of the teacher and student Dice, the Dice gap, Dice between the warped
+        segmentations, flow difference, and the inference times and speedup
+    """
+    vol_size = atlas_vol.shape[1:-1]
+    nn_trf_model = networks.nn_trf(vol_size, indexing='ij')
+    teacher_dice, student_dice, agree_dice, flow_err = [], [], [], []
+    for X_vol, X_seg in val_data:
+        flows = [net.predict([X_vol, atlas_vol]) for net in [teacher_net, student_net]]
+        segs = [nn_trf_model.predict([X_seg, flow])[0, ..., 0] for flow in flows]
+        teacher_dice.append(np.mean(dice(segs[0], atlas_seg, labels=labels)))
+        student_dice.append(np.mean(dice(segs[1], atlas_seg, labels=labels)))
+        agree_dice.append(np.mean(dice(segs[1], segs[0], labels=labels)))
+        flow_err.append(np.mean(np.sqrt(np.sum((flows[1] - flows[0]) ** 2, -1))))
+
+    X_vol = val_data[0][0]
+    times = [benchtools.measure(lambda: net.predict([X_vol, atlas_vol]), nb_warmup=1, nb_repeats=nb_repeats)
+             for net in [teacher_net, student_net]]
+    return {'teacher_dice': float(np.mean(teacher_dice)),
+            'student_dice': float(np.mean(student_dice)),
+            'dice_gap': float(np.mean(teacher_dice) - np.mean(student_dice)),
+            'agree_dice': float(np.mean(agree_dice)),
+            'flow_err': float(np.mean(flow_err)),
+            'teacher_time': times[0]['time_median'],
+            'student_time': times[1]['time_median'],
+            'speedup': times[0]['time_median'] / times[1]['time_median'],
+            'teacher_params': int(teacher_net.count_params()),
+            'student_params': int(student_net.count_params())}
+
+
+def train_distill(data_dir,
+                  atlas_file,
+                  teacher,
+                  teacher_file,
+                  student,
+                  half_res,
+                  model_dir,
+                  gpu_id,
+                  lr,
+                  nb_epochs,
+                  reg_param,
+                  distill_weight,
+                  steps_per_epoch,
+                  batch_size,
+                  data_loss,
+                  load_model_file=None,
+                  initial_epoch=0,
+                  val_list=None,
+                  labels_file='../data/labels.mat',
+                  nb_repeats=5,
+                  out=None):
+    """
+    distillation training function
+    :param data_dir: folder with npz files for each subject.
+    :param atlas_file: atlas filename, npz file with a 'vol' (and 'seg', for the comparison) variable
+    :param teacher: vm1, vm2, vm2double (cvpr2018 models) or miccai2018
+    :param teacher_file: h5 weights of the teacher
+    :param student: student filters, see STUDENTS
+    :param half_res: predict the student flow at half resolution, and upsample it
+    :param model_dir: the model directory to save the student checkpoints to
+    :param gpu_id: gpu id number ('' for the CPU)
+    :param lr: learning rate
+    :param nb_epochs: number of epochs (0, or initial_epoch, to only compare a loaded student)
+    :param reg_param: the smoothness/reconstruction tradeoff parameter (lambda in CVPR paper)
+    :param distill_weight: weight of the mean squared difference to the teacher flow
+    :param steps_per_epoch: frequency with which to save models
+    :param batch_size: batch size
+    :param data_loss: 'mse' or 'ncc'
+    :param load_model_file: optional h5 student file to initialize with
+    :param initial_epoch: first epoch
+    :param val_list: text file with a "vol_file,seg_file" line per validation subject
+        (default: data/test_vol.npz and test_seg.npz)
+    :param labels_file: mat file with the 'labels' to compute Dice on
+    :param nb_repeats: timed predictions per model in the comparison
+    :param out: optional results file (json lines) of the comparison
+    """
+    atlas = np.load(atlas_file)
+    atlas_vol = atlas['vol'][np.newaxis, ..., np.newaxis]
+    vol_size = atlas_vol.shape[1:-1]
+    train_vol_names = sorted(glob.glob(os.path.join(data_dir, '*.npz')))
+    assert len(train_vol_names) > 0, "Could not find any training data"
+
+    assert data_loss in ['mse', 'cc', 'ncc'], 'Loss should be one of mse or cc, found %s' % data_loss
+    if data_loss in ['ncc', 'cc']:
+        data_loss = losses.NCC().loss
+
+    if not os.path.isdir(model_dir):
+        os.mkdir(model_dir)
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    set_session(tf.Session(config=config))
+
+    # frozen teacher, used for prediction only
+    teacher_weights_net, teacher_net = eval_checkpoints._flow_model(teacher, vol_size)
+    print('loading teacher', teacher_file)
+    teacher_weights_net.load_weights(teacher_file)
+    teacher_net._make_predict_function()
+
+    net = student_net(student, vol_size, half_res=half_res)
+    if load_model_file is not None:
+        print('loading', load_model_file)
+        net.load_weights(load_model_file)
+    train_net = distill_model(net)
+    net.save(os.path.join(model_dir, '%02d.h5' % initial_epoch))
+
+    if nb_epochs > initial_epoch:
+        train_example_gen = datagenerators.example_gen(train_vol_names, batch_size=batch_size)
+        atlas_vol_bs = np.repeat(atlas_vol, batch_size, axis=0)
+        cvpr2018_gen = datagenerators.cvpr2018_gen(train_example_gen, atlas_vol_bs, batch_size=batch_size)
+        # -> [X, atlas_vol_bs], [atlas_vol_bs, zeros, teacher flow]
+        train_gen = datagenerators.distill_gen(cvpr2018_gen, teacher_net)
+
+        save_callback = nrn_gen.AsyncModelCheckpoint(os.path.join(model_dir, '{epoch:02d}.h5'), save_model=net)
+        train_net.compile(optimizer=Adam(lr=lr),
+                          loss=[data_loss, losses.Grad('l2').loss, 'mse'],
+                          loss_weights=[1.0, reg_param, distill_weight])
+        # the teacher predicts in the generator, so the generator runs in this (the session's) thread
+        train_net.fit_generator(train_gen,
+                                initial_epoch=initial_epoch,
+                                epochs=nb_epochs,
+                                callbacks=[save_callback],
+                                workers=0,
+                                steps_per_epoch=steps_per_epoch,
+                                verbose=1)
+
+    # compare the student to the teacher
+    if val_list is not None:
+        with open(val_list, 'r') as f:
+            val_pairs = [line.strip().split(',') for line in f if len(line.strip()) > 0]
+    else:
+        val_pairs = [('../data/test_vol.npz', '../data/test_seg.npz')]
+    val_data = [datagenerators.load_example_by_name(vol_name, seg_name) for vol_name, seg_name in val_pairs]
+    labels = sio.loadmat(labels_file)['labels'][0]
+    student_flow_net = Model(net.inputs, net.outputs[1])
+    record = compare(teacher_net, student_flow_net, val_data, atlas_vol, atlas['seg'], labels,
+                     nb_repeats=nb_repeats)
+    record.update({'name': 'distill_%s_%s%s' % (teacher, student, '_half' if half_res else ''),
+                   'teacher': teacher, 'student': student, 'half_res': half_res,
+                   'nb_val': len(val_data), 'time_median': record['student_time']})
+    writer = benchtools.ResultsWriter(out, verbose=False)
+    writer.write(record)
+    writer.close()
+
+    print('teacher %s: %d params, dice %.4f, %.3f s' %
+          (teacher, record['teacher_params'], record['teacher_dice'], record['teacher_time']))
+    print('student %s%s: %d params, dice %.4f, %.3f s' %
+          (student, ' (half res)' if half_res else '', record['student_params'], record['student_dice'],
+           record['student_time']))
+    print('speedup %.2fx, dice gap %.4f, student/teacher dice %.4f, flow difference %.3f voxels' %
+          (record['speedup'], record['dice_gap'], record['agree_dice'], record['flow_err']))
+    return record
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument("data_dir", type=str,
+                        help="data folder")
+    parser.add_argument("--atlas_file", type=str,
+                        dest="atlas_file", default='../data/atlas_norm.npz',
+                        help="atlas file, with vol and seg")
+    parser.add_argument("--teacher", type=str, dest="teacher",
+                        choices=['vm1', 'vm2', 'vm2double', 'miccai2018'], default='vm2',
+                        help="teacher network")
+    parser.add_argument("--teacher_file", type=str,
+                        dest="teacher_file", default='../models/cvpr2018_vm2_l2.h5',
+                        help="h5 weights of the teacher")
+    parser.add_argument("--student", type=str, dest="student",
+                        choices=list(STUDENTS.keys()), default='small',
+                        help="student filters")
+    parser.add_argument("--half_res", action="store_true",
+                        dest="half_res", default=False,
+                        help="predict the student flow at half resolution")
+    parser.add_argument("--model_dir", type=str,
+                        dest="model_dir", default='../models/distill/',
+                        help="student models folder")
+    parser.add_argument("--gpu", type=str, default='0',
+                        dest="gpu_id", help="gpu id number")
+    parser.add_argument("--lr", type=float,
+                        dest="lr", default=1e-4, help="learning rate")
+    parser.add_argument("--epochs", type=int,
+                        dest="nb_epochs", default=1500,
+                        help="number of epochs")
+    parser.add_argument("--lambda", type=float,
+                        dest="reg_param", default=0.01,  # recommend 1.0 for ncc, 0.01 for mse
+                        help="regularization parameter")
+    parser.add_argument("--distill_weight", type=float,
+                        dest="distill_weight", default=0.01,
+                        help="weight of the flow difference to the teacher")
+    parser.add_argument("--steps_per_epoch", type=int,
+                        dest="steps_per_epoch", default=100,
+                        help="frequency of model saves")
+    parser.add_argument("--batch_size", type=int,
+                        dest="batch_size", default=1,
+                        help="batch_size")
+    parser.add_argument("--data_loss", type=str,
+                        dest="data_loss", default='mse',
+                        help="data_loss: mse of ncc")
+    parser.add_argument("--load_model_file", type=str,
+                        dest="load_model_file", default=None,
+                        help="optional h5 student file to initialize with")
+    parser.add_argument("--initial_epoch", type=int,
+                        dest="initial_epoch", default=0,
+                        help="first epoch")
+    parser.add_argument("--val_list", type=str,
+                        dest="val_list", default=None,
+                        help="vol_file,seg_file list of the subjects to compare on (default: data/test_vol.npz)")
+    parser.add_argument("--nb_repeats", type=int,
+                        dest="nb_repeats", default=5,
+                        help="timed predictions per model")
+    parser.add_argument("--out", type=str,
+                        dest="out", default=None,
+                        help="results file (json lines) of the comparison")
+
+    args = parser.parse_args()
+    train_distill(**vars(args))
@@ -7,7 +7,7 @@ specifically adding uncertainty estimation and diffeomorphic transforms.
 import os
 import glob
 import sys
-import random
+import subprocess
 from argparse import ArgumentParser
 
 # third-party imports
@@ -15,16 +15,19 @@ import tensorflow as tf
 import numpy as np
 from keras.backend.tensorflow_backend import set_session
 from keras.optimizers import Adam
-from keras.callbacks import ModelCheckpoint
 from keras.utils import multi_gpu_model 
 
 # project imports
 import datagenerators
+import sequences
+import parallel
 import networks
 import losses
 
 sys.path.append('../ext/neuron')
 import neuron.callbacks as nrn_gen
+import neuron.dataproc as nrn_dataproc
+import pytool.timer as timer
 
 
 def train(data_dir,
@@ -39,7 +42,32 @@ def train(data_dir,
           batch_size,
           load_model_file,
           bidir,
-          initial_epoch=0):
+          initial_epoch=0,
+          scale_file=None,
+          pack_dtype=None,
+          cache_gb=0,
+          seed=0,
+          rank=0,
+          nb_shards=1,
+          sampler_state=None,
+          nb_workers=0,
+          nb_procs=1,
+          master='localhost:29500',
+          allreduce='grads',
+          sync_every=1,
+          baseline_examples_per_sec=None,
+          keep_last=None,
+          keep_every=None,
+          keep_best=False,
+          health_every=0,
+          val_list=None,
+          profile_file=None,
+          profile_every=100,
+          timer_report=None,
+          trace_dir=None,
+          trace_start=10,
+          trace_steps=3,
+          checkpoint=()):
     """
     model training function
     :param data_dir: folder with npz files for each subject.
@@ -54,7 +82,43 @@ def train(data_dir,
     :param batch_size: Optional, default of 1. can be larger, depends on GPU memory and volume size
     :param load_model_file: optional h5 model file to initialize with
     :param bidir: logical whether to use bidirectional cost function
+    :param scale_file: optional json file of per-subject intensity scale factors
+        (see neuron.dataproc.prctle_scale_factors)
+    :param pack_dtype: optional reduced in-memory precision of the volumes ('uint8' or 'float16')
+    :param cache_gb: size of the in-memory volume cache, in GB (0 for no cache). Only with nb_workers=0
+    :param seed: seed of the epoch sampler, shared by all ranks
+    :param rank: rank of this process, for data parallel training
+    :param nb_shards: number of processes the data is split across
+    :param sampler_state: optional sampler state file saved next to a checkpoint, to resume from.
+        Only with nb_workers=0: the worker batches are resumed from initial_epoch
+    :param nb_workers: number of data loading processes. If > 0, batches come from a
+        sequences.RegistrationSequence through shared memory, otherwise from an in-process generator
+    :param nb_procs: number of data-parallel training processes (see parallel.py). Each process
+        trains on its shard of the data, so the effective batch size is nb_procs * batch_size
+    :param master: host:port of the rank 0 process, for nb_procs > 1
+    :param allreduce: average the gradients at every step ('grads') or the weights every
+        sync_every steps ('weights')
+    :param sync_every: steps between weight averaging, for allreduce='weights'
+    :param baseline_examples_per_sec: optional throughput of a single process with the same settings,
+        to report the scaling efficiency of nb_procs > 1 (see parallel.parallel_callbacks)
+    :param keep_last: number of most recent checkpoints to keep (None: keep all)
+    :param keep_every: also keep the checkpoints of every keep_every epochs
+    :param keep_best: also keep the checkpoint with the lowest training loss
+    :param health_every: check in-graph that weights and gradients are finite every
+        health_every steps (0 for no check)
+    :param val_list: optional text file of vol_file,seg_file validation subjects, to evaluate
+        the checkpoints in a background process (see eval_checkpoints.py)
+    :param profile_file: optional csv or jsonl file of per-step wait/load/train/callback times
+    :param profile_every: number of steps between printed profile summaries
+    :param timer_report: optional file to write the report of the named pytool timers to
+    :param trace_dir: optional directory to write full tensorflow traces of a few train steps to
+    :param trace_start: first traced step
+    :param trace_steps: number of traced steps
+    :param checkpoint: segments of the network recomputed during backprop instead of kept
+        (gradient checkpointing, see networks.py and planner.py --checkpoint): head, warp, int
     """
+    if timer_report is not None:
+        timer.enable()
     
     # load atlas from provided files. The atlas we used is 160x192x224.
     atlas_vol = np.load(atlas_file)['vol'][np.newaxis, ..., np.newaxis]
@@ -63,8 +127,8 @@ def train(data_dir,
     # for the CVPR and MICCAI papers, we have data arranged in train/validate/test folders
     # inside each folder is a /vols/ and a /asegs/ folder with the volumes
     # and segmentations. All of our papers use npz formated data.
-    train_vol_names = glob.glob(os.path.join(data_dir, '*.npz'))
-    random.shuffle(train_vol_names)  # shuffle volume list
+    # sorted, so that all ranks agree. The sampler shuffles the examples every epoch
+    train_vol_names = sorted(glob.glob(os.path.join(data_dir, '*.npz')))
     assert len(train_vol_names) > 0, "Could not find any training data"
 
     # Diffeomorphic network architecture used in MICCAI 2018 paper
@@ -81,21 +145,42 @@ def train(data_dir,
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
     config.allow_soft_placement = True
+    if nb_procs > 1:
+        # processes on one host share its cores
+        nb_threads = max(1, os.cpu_count() // nb_procs)
+        config.intra_op_parallelism_threads = nb_threads
+        config.inter_op_parallelism_threads = nb_threads
     set_session(tf.Session(config=config))
 
+    # data-parallel processes: each one trains on its own shard
+    comm = None
+    if nb_procs > 1:
+        assert allreduce in ['grads', 'weights'], 'allreduce should be grads or weights'
+        comm = parallel.SocketAllreduce(rank, nb_procs, master=master)
+        nb_shards = nb_procs
+
+    # background validation of the checkpoints, in its own process and on the CPU.
+    # it is stopped if training fails, and otherwise exits after the last epoch's checkpoint,
+    # or once this process is gone (after evaluating the checkpoints left)
+    evaluator = None
+    if val_list is not None and rank == 0:
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        evaluator = subprocess.Popen([sys.executable, 'eval_checkpoints.py', os.path.abspath(model_dir),
+                                      '--val_list', os.path.abspath(val_list), '--model', 'miccai2018',
+                                      '--atlas_file', os.path.abspath(atlas_file),
+                                      '--last_epoch', str(nb_epochs), '--parent_pid', str(os.getpid())],
+                                     cwd=src_dir)
+
     # prepare the model
     with tf.device(gpu):
         # the MICCAI201 model takes in [image_1, image_2] and outputs [warped_image_1, velocity_stats]
         # in these experiments, we use image_2 as atlas
-        model = networks.miccai2018_net(vol_size, nf_enc, nf_dec, bidir=bidir)
+        model = networks.miccai2018_net(vol_size, nf_enc, nf_dec, bidir=bidir, checkpoint=checkpoint)
 
         # load initial weights
         if load_model_file is not None:
             model.load_weights(load_model_file)
 
-        # save first iteration
-        model.save(os.path.join(model_dir, '%02d.h5' % initial_epoch))
-
         # compile
         # note: best to supply vol_shape here than to let tf figure it out.
         flow_vol_shape = model.outputs[-1].shape[1:-1]
@@ -114,36 +199,116 @@ def train(data_dir,
         'batch_size should be a multiple of the nr. of gpus. ' + \
         'Got batch_size %d, %d gpus' % (batch_size, nb_gpus)
 
-    train_example_gen = datagenerators.example_gen(train_vol_names, batch_size=batch_size)
-    atlas_vol_bs = np.repeat(atlas_vol, batch_size, axis=0)
-    miccai2018_gen = datagenerators.miccai2018_gen(train_example_gen,
-                                                   atlas_vol_bs,
-                                                   batch_size=batch_size,
-                                                   bidir=bidir)
-
+    scale_factors = None
+    if scale_file is not None:
+        scale_factors = nrn_dataproc.load_scale_factors(scale_file)
+    cache = None
+    if cache_gb > 0:
+        cache = datagenerators.VolCache(max_bytes=int(cache_gb * 2**30))
     # prepare callbacks
     save_file_name = os.path.join(model_dir, '{epoch:02d}.h5')
+    callbacks = []
+
+    if nb_workers > 0:
+        assert cache is None and sampler_state is None, \
+            "cache_gb and sampler_state are not supported with nb_workers > 0"
+        # multiprocess Sequence, with batches passed through shared memory.
+        # the batch of a given (epoch, step) is deterministic, so resuming only needs initial_epoch
+        train_seq = sequences.RegistrationSequence(train_vol_names, atlas_vol, batch_size=batch_size,
+                                                   steps_per_epoch=steps_per_epoch, model='miccai2018',
+                                                   bidir=bidir, seed=seed, rank=rank, nb_shards=nb_shards,
+                                                   epoch=initial_epoch, scale_factors=scale_factors,
+                                                   pack_dtype=pack_dtype)
+        loader = sequences.SharedMemoryLoader(train_seq, nb_workers=nb_workers, initial_epoch=initial_epoch)
+        miccai2018_gen = loader.generator()
+
+    else:
+        # without-replacement epoch sampler, resumed from a saved state or the initial epoch
+        sampler = datagenerators.EpochSampler(len(train_vol_names), seed=seed, rank=rank, nb_shards=nb_shards)
+        if sampler_state is not None:
+            sampler.load(sampler_state)
+        else:
+            sampler.nb_drawn = initial_epoch * steps_per_epoch * batch_size
+        train_example_gen = datagenerators.example_gen(train_vol_names, batch_size=batch_size,
+                                                       scale_factors=scale_factors,
+                                                       pack_dtype=pack_dtype,
+                                                       cache=cache,
+                                                       sampler=sampler)
+        atlas_vol_bs = np.repeat(atlas_vol, batch_size, axis=0)
+        miccai2018_gen = datagenerators.miccai2018_gen(train_example_gen,
+                                                       atlas_vol_bs,
+                                                       batch_size=batch_size,
+                                                       bidir=bidir)
+
+        sampler_file = '{epoch:02d}_sampler.json' if nb_shards == 1 else '{epoch:02d}_sampler_rank%d.json' % rank
+        callbacks.append(nrn_gen.SamplerCheckpoint(os.path.join(model_dir, sampler_file),
+                                                   sampler, steps_per_epoch * batch_size))
 
     # fit generator
     with tf.device(gpu):
 
         # multi-gpu support
         if nb_gpus > 1:
-            save_callback = nrn_gen.ModelCheckpointParallel(save_file_name)
             mg_model = multi_gpu_model(model, gpus=nb_gpus)
         
         # single gpu
         else:
-            save_callback = ModelCheckpoint(save_file_name)
             mg_model = model
 
-        mg_model.compile(optimizer=Adam(lr=lr), loss=model_losses, loss_weights=loss_weights)
-        mg_model.fit_generator(miccai2018_gen, 
-                               initial_epoch=initial_epoch,
-                               epochs=nb_epochs,
-                               callbacks=[save_callback],
-                               steps_per_epoch=steps_per_epoch,
-                               verbose=1)
+        # weights are written in the background, with retention of older checkpoints
+        save_callback = nrn_gen.AsyncModelCheckpoint(save_file_name, keep_last=keep_last,
+                                                     keep_every=keep_every, keep_best=keep_best,
+                                                     save_model=model)
+
+        # save first iteration (weights only, atomically and under the same retention)
+        if rank == 0:
+            save_callback.save_initial(initial_epoch)
+
+        # data-parallel: the processes keep identical weights, and only rank 0 saves them
+        optimizer = Adam(lr=lr)
+        if comm is not None:
+            if allreduce == 'grads':
+                optimizer = parallel.allreduce_optimizer(optimizer, comm)
+            callbacks = parallel.parallel_callbacks(comm, batch_size, mode=allreduce,
+                                                    sync_every=sync_every,
+                                                    baseline_examples_per_sec=baseline_examples_per_sec) + callbacks
+        if rank == 0:
+            callbacks = [save_callback] + callbacks
+
+        mg_model.compile(optimizer=optimizer, loss=model_losses, loss_weights=loss_weights)
+        if health_every > 0:
+            callbacks.append(nrn_gen.ModelHealthCheck(mg_model, every=health_every))
+        if trace_dir is not None:
+            callbacks.append(nrn_gen.StepTracer(trace_dir, start_step=trace_start, nb_steps=trace_steps))
+
+        # per-step profile, around the other callbacks
+        if profile_file is not None:
+            profiler = nrn_gen.StepProfiler(profile_file, callbacks=callbacks, summary_every=profile_every)
+            callbacks = [profiler]
+            miccai2018_gen = nrn_gen.profile_generator(miccai2018_gen, profiler)
+
+        # fit
+        trained = False
+        try:
+            mg_model.fit_generator(miccai2018_gen, 
+                                   initial_epoch=initial_epoch,
+                                   epochs=nb_epochs,
+                                   callbacks=callbacks,
+                                   workers=0 if nb_workers > 0 else 1,
+                                   steps_per_epoch=steps_per_epoch,
+                                   verbose=1)
+            trained = True
+        finally:
+            if evaluator is not None and not trained:
+                evaluator.terminate()
+                evaluator.wait()
+
+    if nb_workers > 0:
+        loader.close()
+    if comm is not None:
+        comm.close()
+    if timer_report is not None:
+        print(timer.report(file=timer_report))
 
 
 if __name__ == "__main__":
@@ -187,5 +352,92 @@ if __name__ == "__main__":
                         dest="initial_epoch", default=0,
                         help="first epoch")
 
+    parser.add_argument("--scale_file", type=str,
+                        dest="scale_file", default=None,
+                        help="optional json file of per-subject intensity scale factors")
+    parser.add_argument("--pack_dtype", type=str,
+                        dest="pack_dtype", default=None, choices=['uint8', 'float16'],
+                        help="optional reduced in-memory precision of the volumes")
+    parser.add_argument("--cache_gb", type=float,
+                        dest="cache_gb", default=0,
+                        help="size of the in-memory volume cache in GB (0 for no cache, "
+                             "only without --nb_workers)")
+    parser.add_argument("--seed", type=int,
+                        dest="seed", default=0,
+                        help="seed of the epoch sampler")
+    parser.add_argument("--rank", type=int,
+                        dest="rank", default=0,
+                        help="rank of this process, for data parallel training")
+    parser.add_argument("--nb_shards", type=int,
+                        dest="nb_shards", default=1,
+                        help="number of processes the data is split across")
+    parser.add_argument("--sampler_state", type=str,
+                        dest="sampler_state", default=None,
+                        help="optional sampler state file to resume from, e.g. model_dir/10_sampler.json "
+                             "(only without --nb_workers)")
+    parser.add_argument("--nb_workers", type=int,
+                        dest="nb_workers", default=0,
+                        help="number of data loading processes (0: load in the training process)")
+
+    parser.add_argument("--nb_procs", type=int,
+                        dest="nb_procs", default=1,
+                        help="number of data-parallel training processes (see parallel.py)")
+    parser.add_argument("--master", type=str,
+                        dest="master", default='localhost:29500',
+                        help="host:port of the rank 0 process, for data-parallel training")
+    parser.add_argument("--allreduce", type=str,
+                        dest="allreduce", default='grads', choices=['grads', 'weights'],
+                        help="average gradients every step, or weights every sync_every steps")
+    parser.add_argument("--sync_every", type=int,
+                        dest="sync_every", default=1,
+                        help="steps between weight averaging, for --allreduce weights")
+    parser.add_argument("--baseline_examples_per_sec", type=float,
+                        dest="baseline_examples_per_sec", default=None,
+                        help="examples/s of a single process with the same settings, to report the scaling efficiency")
+
+    parser.add_argument("--keep_last", type=int,
+                        dest="keep_last", default=None,
+                        help="number of most recent checkpoints to keep (default: all)")
+    parser.add_argument("--keep_every", type=int,
+                        dest="keep_every", default=None,
+                        help="also keep the checkpoints of every keep_every epochs")
+    parser.add_argument("--keep_best", action="store_true",
+                        dest="keep_best",
+                        help="also keep the checkpoint with the lowest training loss")
+
+    parser.add_argument("--health_every", type=int,
+                        dest="health_every", default=0,
+                        help="steps between in-graph checks of finite weights and gradients (0: no check)")
+    parser.add_argument("--val_list", type=str,
+                        dest="val_list", default=None,
+                        help="optional vol_file,seg_file list of validation subjects, evaluated in the background")
+
+    parser.add_argument("--profile_file", type=str,
+                        dest="profile_file", default=None,
+                        help="optional csv or jsonl file of per-step timings")
+    parser.add_argument("--profile_every", type=int,
+                        dest="profile_every", default=100,
+                        help="steps between profile summaries")
+
+    parser.add_argument("--timer_report", type=str,
+                        dest="timer_report", default=None,
+                        help="optional file to write the aggregated timer report to")
+
+    parser.add_argument("--trace_dir", type=str,
+                        dest="trace_dir", default=None,
+                        help="optional directory for tensorflow traces of a few train steps")
+    parser.add_argument("--trace_start", type=int,
+                        dest="trace_start", default=10,
+                        help="first traced step")
+    parser.add_argument("--trace_steps", type=int,
+                        dest="trace_steps", default=3,
+                        help="number of traced steps")
+
+    parser.add_argument("--checkpoint", type=str, nargs='+',
+                        dest="checkpoint", default=[], choices=['head', 'warp', 'int'],
+                        help="network segments recomputed in backprop, to train with less memory")
+
     args = parser.parse_args()
+    if args.nb_workers > 0 and (args.cache_gb > 0 or args.sampler_state is not None):
+        parser.error("--cache_gb and --sampler_state are not supported with --nb_workers > 0")
     train(**vars(args))